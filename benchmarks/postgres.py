@@ -0,0 +1,81 @@
+#
+# Throwaway Postgres cluster for benchmark runs: initdb into a temporary directory, listen only on
+# a Unix socket in that directory and remove everything on stop. Needs the server binaries
+# (initdb, pg_ctl) on PATH or in --pg-bin.
+#
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+
+import psycopg2
+
+
+def find_pg_bin(pg_bin: str = None) -> str:
+    if pg_bin:
+        return pg_bin
+    initdb = shutil.which("initdb")
+    if initdb:
+        return os.path.dirname(initdb)
+    # Debian/Ubuntu keep the server binaries out of PATH.
+    candidates = sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"))
+    if candidates:
+        return os.path.dirname(candidates[-1])
+    raise RuntimeError("initdb not found; install the Postgres server or pass --pg-bin")
+
+
+class EphemeralPostgres():
+
+    def __init__(self, pg_bin: str = None, db_name: str = "message", db_user: str = "message"):
+        self.pg_bin = find_pg_bin(pg_bin)
+        self.db_name = db_name
+        self.db_user = db_user
+        self.directory = None
+
+    def _run(self, *args):
+        subprocess.run([os.path.join(self.pg_bin, args[0]), *args[1:]], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def start(self) -> dict:
+        """
+
+        Creates and starts the cluster and an empty database in it.
+
+        :return: A database config (db_name, db_host, db_user, db_pass) for the data services.
+        """
+        self.directory = tempfile.mkdtemp(prefix="messages-bench-")
+        data = os.path.join(self.directory, "data")
+        self._run("initdb", "-D", data, "-U", self.db_user, "-A", "trust", "-E", "UTF8")
+        # No TCP listener, so the default port can't collide with a server already running.
+        options = f"-k {self.directory} -c listen_addresses='' -c fsync=off -c synchronous_commit=off"
+        self._run("pg_ctl", "-D", data, "-o", options, "-l", os.path.join(self.directory, "server.log"), "-w", "start")
+
+        config = {
+            "db_name": self.db_name,
+            "db_host": self.directory,
+            "db_user": self.db_user,
+            "db_pass": "",
+        }
+        conn = psycopg2.connect(dbname="postgres", host=self.directory, user=self.db_user)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"""CREATE DATABASE \"{self.db_name}\";""")
+        conn.close()
+
+        return config
+
+    def stop(self):
+        if self.directory is None:
+            return
+        try:
+            self._run("pg_ctl", "-D", os.path.join(self.directory, "data"), "-m", "fast", "-w", "stop")
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self) -> dict:
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,325 @@
+#
+# Load test for the service: seeds a dataset, runs the ASGI app in-process (lifespan included) and
+# drives each endpoint with concurrent clients. Requests go straight into the app as ASGI calls,
+# so the numbers cover routing, resources, the database and serialization but no HTTP client or
+# socket overhead. Results are JSON; pass --baseline to compare against an earlier run.
+#
+#   python -m benchmarks.run --ephemeral --output bench.json
+#   python -m benchmarks.run --ephemeral --baseline bench.json
+#   python -m benchmarks.run --backend memory
+#
+# Run from the repository root (main.py serves static/ and templates/ relative to it).
+#
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from benchmarks.postgres import EphemeralPostgres
+from benchmarks.seed import seed, seed_memory, thread_participants
+from resources.database.database_data_service import DatabaseDataService
+from resources.database.migrations import MigrationRunner
+
+
+HEADERS = [(b"host", b"benchmark"), (b"content-type", b"application/json"), (b"accept", b"application/json")]
+
+# Lower is better for all of these except throughput.
+COMPARED_METRICS = ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "alloc_peak_bytes")
+
+
+async def call(app, method: str, path: str, body: bytes = None) -> tuple:
+    """
+
+    Sends one request through the ASGI app.
+
+    :return: (status, response body size, failed). GraphQL reports errors in a 200 body, so for
+        /graphql the body is parsed and a non-empty "errors" counts as a failure too.
+    """
+    url = urlsplit(path)
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": url.path,
+        "raw_path": url.path.encode(),
+        "query_string": url.query.encode(),
+        "root_path": "",
+        "headers": HEADERS,
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    sent = False
+    response = {"status": None, "size": 0}
+    graphql = url.path == "/graphql"
+    chunks = []
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body or b"", "more_body": False}
+        # The client never disconnects; the app stops listening once the response is done.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["size"] += len(message.get("body", b""))
+            if graphql:
+                chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+
+    status = response["status"]
+    failed = status is None or status >= 400
+    if graphql and not failed:
+        try:
+            failed = bool(json.loads(b"".join(chunks)).get("errors"))
+        except ValueError:
+            failed = True
+    return status, response["size"], failed
+
+
+def _graphql(query: str, variables: dict) -> bytes:
+    return json.dumps({"query": query, "variables": variables}).encode()
+
+
+def get_scenarios(users: int, threads: int) -> dict:
+    """
+
+    :return: {endpoint name: factory(rng) -> (method, path, body)}. Reads come first because the
+        write scenario grows the threads the reads look at.
+    """
+    def participant(rng):
+        messageThreadID = rng.randint(1, threads)
+        return rng.choice(thread_participants(messageThreadID, users)), messageThreadID
+
+    def thread_messages(rng):
+        userID, messageThreadID = participant(rng)
+        return "GET", f"/api/messages/{userID}/{messageThreadID}", None
+
+    def user(rng):
+        return "GET", f"/api/users/{rng.randint(1, users)}", None
+
+    def messages_page(rng):
+        return "GET", f"/api/messages?messageThreadID={rng.randint(1, threads)}&limit=50", None
+
+    def graphql_messages(rng):
+        return "POST", "/graphql", _graphql(
+            "query($t: Int!) { messages(messageThreadID: $t, limit: 50) { userMessageID messageContents creationDT author { firstName lastName } } }",
+            {"t": rng.randint(1, threads)})
+
+    def graphql_user(rng):
+        return "POST", "/graphql", _graphql(
+            "query($u: Int!) { user(userID: $u) { userID firstName lastName messages { userMessageID messageID } } }",
+            {"u": rng.randint(1, users)})
+
+    def new_message(rng):
+        userID, messageThreadID = participant(rng)
+        body = {"userMessageID": 0, "userID": userID, "messageID": messageThreadID, "messageContents": "Benchmark reply"}
+        return "POST", "/api/messages/newMessage", json.dumps(body).encode()
+
+    return {
+        "GET /api/messages/{userID}/{messageThreadID}": thread_messages,
+        "GET /api/users/{userID}": user,
+        "GET /api/messages?messageThreadID&limit=50": messages_page,
+        "POST /graphql messages": graphql_messages,
+        "POST /graphql user": graphql_user,
+        "POST /api/messages/newMessage": new_message,
+    }
+
+
+def percentile(ordered: list, p: float) -> float:
+    # Nearest rank.
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+async def run_scenario(app, factory, rng, requests: int, concurrency: int, warmup: int, alloc_requests: int) -> dict:
+    for _ in range(warmup):
+        await call(app, *factory(rng))
+
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def client():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            request = factory(rng)
+            start = time.perf_counter()
+            _, _, failed = await call(app, *request)
+            latencies.append(time.perf_counter() - start)
+            if failed:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    # Allocations are measured in a separate sequential pass; tracemalloc would skew the timings.
+    allocations = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_requests):
+            request = factory(rng)
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await call(app, *request)
+            allocations.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(ms[-1], 3) if ms else 0.0,
+        "alloc_peak_bytes": int(sum(allocations) / len(allocations)) if allocations else 0,
+    }
+
+
+async def run(args, config: dict) -> dict:
+    import main as service
+
+    service.DATABASE_CONFIG = dict(config, db_pool_max=args.pool_max)
+    scenarios = get_scenarios(args.users, args.threads)
+    selected = args.endpoints or list(scenarios)
+    rng = random.Random(args.seed)
+
+    endpoints = {}
+    async with service.lifespan(service.app):
+        if args.backend == "memory":
+            seed_memory(service.database, args.users, args.threads, args.messages)
+        for name in selected:
+            endpoints[name] = await run_scenario(service.app, scenarios[name], rng, args.requests, args.concurrency, args.warmup, args.alloc_requests)
+            print(f"{name}: p50 {endpoints[name]['p50_ms']} ms, p99 {endpoints[name]['p99_ms']} ms, {endpoints[name]['throughput_rps']} req/s", file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "dataset": {"users": args.users, "threads": args.threads, "messages_per_thread": args.messages},
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "pool_max": args.pool_max,
+            "backend": args.backend,
+            "seed": args.seed,
+        },
+        "endpoints": endpoints,
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> tuple:
+    """
+
+    :return: ({endpoint: {metric: relative change}}, [regressions beyond tolerance])
+    """
+    comparison = {}
+    regressions = []
+    for name, current in result["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        changes = {}
+        for metric in COMPARED_METRICS:
+            if not before.get(metric):
+                continue
+            change = current[metric] / before[metric] - 1
+            changes[metric] = round(change, 4)
+            worse = change < -tolerance if metric == "throughput_rps" else change > tolerance
+            if worse:
+                regressions.append(f"{name}: {metric} {change:+.1%}")
+        comparison[name] = changes
+    return comparison, regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed a dataset and load-test the service in-process.")
+    parser.add_argument("--backend", choices=("postgres", "memory"), default="postgres", help="data backend to serve from (memory is always freshly seeded)")
+    parser.add_argument("--ephemeral", action="store_true", help="start a throwaway Postgres cluster for the run")
+    parser.add_argument("--pg-bin", help="directory with initdb / pg_ctl (for --ephemeral)")
+    parser.add_argument("--db", default="message")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="message")
+    parser.add_argument("--password", default="message")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the data already in the database")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=50, help="messages per thread")
+    parser.add_argument("--requests", type=int, default=2000, help="timed requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--alloc-requests", type=int, default=50)
+    parser.add_argument("--pool-max", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--endpoints", nargs="*", help="names of the endpoints to run (default: all)")
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON result to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    postgres = EphemeralPostgres(args.pg_bin) if args.ephemeral and args.backend == "postgres" else None
+    try:
+        if args.backend == "memory":
+            config = {"data_backend": "memory"}
+        elif postgres is not None:
+            config = postgres.start()
+        else:
+            config = {"db_name": args.db, "db_host": args.host, "db_user": args.user, "db_pass": args.password}
+
+        if args.backend == "postgres" and not args.no_seed:
+            database = DatabaseDataService(dict(config, db_pool_max=2))
+            MigrationRunner(database).run()
+            seed(database, args.users, args.threads, args.messages)
+            database.close()
+
+        result = asyncio.run(run(args, config))
+    finally:
+        if postgres is not None:
+            postgres.stop()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            result["comparison"], regressions = compare(result, json.load(f), args.tolerance)
+        result["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#
+# Deterministic benchmark dataset: users x threads x messages, generated inside Postgres with
+# generate_series so seeding a million rows is a few statements rather than a million round trips.
+# Thread t (1-based) is a conversation between two users, thread_participants(t, users).
+#
+from datetime import datetime, timedelta
+
+from resources.database.database_data_service import DatabaseDataService
+from resources.database.memory_database_data_service import MemoryDatabaseDataService
+
+
+SEED_START = "2023-01-01 00:00:00"
+
+
+def thread_participants(messageThreadID: int, users: int) -> tuple:
+    t = messageThreadID - 1
+    return 1 + (2 * t) % users, 1 + (2 * t + 1) % users
+
+
+def seed(database: DatabaseDataService, users: int, threads: int, messages: int):
+    """
+
+    Replaces the contents of the message tables with the benchmark dataset. The schema must be
+    migrated already.
+
+    :param users: Number of users, with userIDs 1..users.
+    :param threads: Number of threads, with messageIDs 1..threads.
+    :param messages: Messages per thread, alternating between the thread's two participants, one
+        second apart.
+    """
+    with database.transaction() as cursor:
+        cursor.execute("""TRUNCATE \"userMessages\", \"threadParticipants\", \"messageThread\", \"messageUsers\" RESTART IDENTITY;""")
+        cursor.execute("""INSERT INTO \"messageUsers\" (\"firstName\", \"lastName\", \"isAdmin\")
+        SELECT 'User', 'No. ' || g, g = 1 FROM generate_series(1, %s) g;""", (users,))
+        cursor.execute("""INSERT INTO \"messageThread\" (\"creationDT\")
+        SELECT %s::timestamp FROM generate_series(1, %s);""", (SEED_START, threads))
+        cursor.execute("""INSERT INTO \"userMessages\" (\"userID\", \"messageID\", \"messageContents\", \"creationDT\")
+        SELECT 1 + (2 * t + i %% 2) %% %s, t + 1, 'Benchmark message ' || i || ' in thread ' || (t + 1),
+            %s::timestamp + (t * %s + i) * interval '1 second'
+        FROM generate_series(0, %s - 1) t, generate_series(0, %s - 1) i
+        ORDER BY t, i;""", (users, SEED_START, messages, threads, messages))
+    database.execute_query("""ANALYZE \"messageUsers\", \"messageThread\", \"userMessages\", \"threadParticipants\";""")
+
+
+def seed_memory(database: MemoryDatabaseDataService, users: int, threads: int, messages: int):
+    """
+
+    The same dataset as seed(), loaded into an empty MemoryDatabaseDataService.
+    """
+    start = datetime.fromisoformat(SEED_START)
+    for g in range(1, users + 1):
+        database.insert_user({"userID": database.next_id("userID"), "firstName": "User", "lastName": f"No. {g}", "isAdmin": g == 1})
+    for t in range(threads):
+        database.ensure_thread(t + 1)
+        database.threads[t + 1]["creationDT"] = start
+        for i in range(messages):
+            database.insert_message({
+                "userMessageID": database.next_id("userMessageID"),
+                "userID": 1 + (2 * t + i % 2) % users,
+                "messageID": t + 1,
+                "messageContents": f"Benchmark message {i} in thread {t + 1}",
+                "creationDT": start + timedelta(seconds=t * messages + i),
+            })
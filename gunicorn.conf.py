@@ -0,0 +1,22 @@
+#
+# gunicorn settings for production (see app.yaml): one uvicorn worker per core, with the app
+# imported once in the master and shared by the forked workers. No connections exist at import;
+# each worker opens its own pool in main.lifespan after the fork, sized by
+# resources.runtime.pool_max().
+#
+import os
+
+from resources import runtime
+
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", "8080"))
+workers = runtime.worker_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# Let in-flight requests and streams finish on deploys and restarts.
+graceful_timeout = 30
+timeout = 60
+
+# Workers read the same value, so pool_max() divides the budget by the real worker count.
+os.environ["WEB_CONCURRENCY"] = str(workers)
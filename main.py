@@ -6,29 +6,93 @@ from fastapi import FastAPI, Response, HTTPException, Request
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
+from fastapi.responses import StreamingResponse
 
 from fastapi.staticfiles import StaticFiles
-from typing import List, Union
+from typing import AsyncGenerator, List, Literal, Union
+from datetime import datetime
+from contextlib import asynccontextmanager
+import dataclasses
 from fastapi import Depends, FastAPI, HTTPException
 import strawberry
 from strawberry.asgi import GraphQL
+from strawberry.dataloader import DataLoader
+from strawberry.types import Info
 
 
 # I like to launch directly and not use the standard FastAPI startup process.
 # So, I include uvicorn
 import uvicorn
 
-from resources.messages.message_data_service import MessageDataService
+from resources.messages.message_data_service import AsyncMessageDataService, MemoryMessageDataService
 from resources.messages.message_resource import MessageRspModel, MessageModel, MessageResource
-from resources.users.users_data_service import UserDataService
+from resources.messages.message_models import MessageSearchRspModel
+from resources.messages.message_events import MessageEventBroker
+from resources.messages.message_write_queue import MessageWriteQueue, QueueFull
+from resources.messages.message_cache import MessageResponseCache
+from resources.messages.message_archive import MessageArchive
+from resources.threads.thread_data_service import AsyncThreadDataService, MemoryThreadDataService
+from resources.threads.thread_resource import ThreadResource
+from resources.threads.thread_models import ThreadSummaryRspModel
+from resources.users.users_data_service import AsyncUserDataService, CachedUserDataService, MemoryUserDataService
+from resources.cache import LRUCache, RedisCache, TieredCache
 from resources.users.users_resource import UserResource
 from resources.users.users_models import UserRspModel, UserModel
+from resources.database.async_database_data_service import AsyncDatabaseDataService
+from resources.database.routing_database_data_service import RoutingDatabaseDataService, StickyReadsMiddleware, primary_reads
+from resources.database.memory_database_data_service import MemoryDatabaseDataService
+from resources.rest_models import TrustedJSONResponse, etag_matches
+from resources.streaming import NDJSON_MEDIA_TYPE, ndjson_stream, json_array_stream
+from resources import columnar
+from resources import metrics
+from resources import runtime
 from pydantic import BaseModel
 
 LOCAL = False
-
-import strawberry
-from pydantic import BaseModel
+# Development only: restart on code changes (single process).
+RELOAD = False
+STREAM_BATCH_SIZE = 1000
+READY_TIMEOUT = 2
+
+# User profiles are cached in-process (other workers' adds and deletes reach it via LISTEN/NOTIFY);
+# set CACHE_REDIS_URL to also share them across workers.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60
+CACHE_REDIS_URL = None
+
+# Queries slower than this many seconds are logged to the "slow_query" logger; None disables.
+SLOW_QUERY_SECONDS = None
+
+# Connection strings of read replicas; GET endpoints and GraphQL queries read from them.
+DB_REPLICA_DSNS = []
+# How long (seconds) a user's reads stay on the primary after their own write.
+DB_REPLICA_STICKY_SECONDS = 5
+
+# When set, used instead of the LOCAL / Cloud SQL settings (e.g. by the benchmark runner).
+DATABASE_CONFIG = None
+
+# "postgres", or "memory" to keep all data in-process (development and benchmarks; nothing is
+# persisted and every worker has its own copy).
+DATA_BACKEND = "postgres"
+
+# Bytes of serialized thread responses each worker keeps (see message_cache.py); 0 disables.
+MESSAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Write-behind for POST /api/messages/newMessage: messages are journaled to WRITE_QUEUE_JOURNAL_DIR
+# (which must be on persistent disk) and answered with 202 and their userMessageID right away,
+# then inserted in batches of up to WRITE_QUEUE_BATCH_SIZE at least every WRITE_QUEUE_FLUSH_INTERVAL
+# seconds. With WRITE_QUEUE_SIZE messages outstanding, requests wait up to WRITE_QUEUE_PUT_TIMEOUT
+# seconds for room and then get 503.
+WRITE_BEHIND = False
+WRITE_QUEUE_JOURNAL_DIR = "journal"
+WRITE_QUEUE_SIZE = 10000
+WRITE_QUEUE_BATCH_SIZE = 500
+WRITE_QUEUE_FLUSH_INTERVAL = 0.05
+WRITE_QUEUE_PUT_TIMEOUT = 1
+
+# Where "python -m resources.database.partitions archive" puts the months it drops from
+# "userMessages"; served by GET /api/messages/archive.
+ARCHIVE_DIR = "archive"
 
 @strawberry.type
 class User:
@@ -37,6 +101,10 @@ class User:
     lastName: str
     isAdmin: bool
 
+    @strawberry.field
+    async def messages(self, info: Info) -> list["Message"]:
+        return await info.context["user_messages_loader"].load(self.userID)
+
 
 @strawberry.type
 class Message:
@@ -46,34 +114,137 @@ class Message:
     messageContents: str
     creationDT: str
 
+    @strawberry.field
+    async def author(self, info: Info) -> User | None:
+        return await info.context["user_loader"].load(self.userID)
+
+@strawberry.type
+class ThreadSummary:
+    messageID: int
+    messageCount: int
+    lastUserMessageID: int | None
+    lastMessageDT: str | None
+    lastReadDT: str | None
+    participants: list[int]
+    unreadCount: int
+
+@strawberry.type
+class PageInfo:
+    hasNextPage: bool
+    endCursor: str | None
+
+
+@strawberry.type
+class MessageEdge:
+    cursor: str
+    node: Message
+
+
+@strawberry.type
+class MessageConnection:
+    edges: list[MessageEdge]
+    pageInfo: PageInfo
+
+def from_row(cls, row: dict):
+    # REST rows also carry "links" (and search results a "rank") that the GraphQL types don't
+    # have, and resolver fields (User.messages, Message.author) aren't constructor arguments.
+    return cls(**{f.name: row[f.name] for f in dataclasses.fields(cls) if f.init})
+
 @strawberry.type
 class Query:
     @strawberry.field
-    def user(self, userID: int) -> User | None:
-        result = user_resource.get_users(userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None)
-        if result is not []:
-            return User(**result[0])
+    async def user(self, userID: int) -> User | None:
+        result = await user_resource.get_users(userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None)
+        if result:
+            return from_row(User, result[0])
         else:
             return None
     @strawberry.field
-    def messages(userID: int | None = None, messageThreadID: int | None = None, messageID: int | None = None, messageContents: int | None = None, offset: int | None = None, limit: int | None = None) -> list[Message]:
-        result = message_resource.get_messages(userID, messageThreadID, messageID, messageContents, offset, limit)
-        print(result)
-        return [Message(**msg) for msg in result]
-    
-schema = strawberry.Schema(query=Query)
+    async def messages(userID: int | None = None, messageThreadID: int | None = None, messageID: int | None = None, messageContents: str | None = None, offset: int | None = None, limit: int | None = None, since: datetime | None = None, before: datetime | None = None) -> list[Message]:
+        result = await message_resource.get_messages(userID, messageThreadID, messageID, messageContents, offset, limit, since, before)
+        return [from_row(Message, msg) for msg in result]
+    @strawberry.field
+    async def threads(userID: int, limit: int | None = None) -> list[ThreadSummary]:
+        result = await thread_resource.get_threads(userID, limit)
+        return [ThreadSummary(**t) for t in result]
+    @strawberry.field
+    async def searchMessages(q: str, userID: int | None = None, messageThreadID: int | None = None, limit: int = 50) -> list[Message]:
+        result = await message_resource.search_messages(q, userID, messageThreadID, limit)
+        return [from_row(Message, msg) for msg in result]
+    @strawberry.field
+    async def messagesConnection(userID: int | None = None, messageThreadID: int | None = None, messageID: int | None = None, messageContents: str | None = None, first: int | None = None, after: str | None = None, since: datetime | None = None, before: datetime | None = None) -> MessageConnection:
+        page = await message_resource.get_messages_page(userID, messageThreadID, messageID, messageContents, None, first, after, since, before)
+        edges = [MessageEdge(cursor=c, node=from_row(Message, msg)) for msg, c in zip(page["items"], page["cursors"])]
+        return MessageConnection(edges=edges, pageInfo=PageInfo(hasNextPage=page["next_cursor"] is not None, endCursor=page["cursors"][-1] if page["cursors"] else None))
     
-graphql_app = GraphQL(schema)
+@strawberry.input
+class MessageInput:
+    userID: int
+    messageID: int
+    messageContents: str
 
-app = FastAPI()
-app.add_route("/graphql", graphql_app)
-app.add_websocket_route("/graphql", graphql_app)
+@strawberry.type
+class Mutation:
+    @strawberry.mutation
+    async def addMessages(self, messages: list[MessageInput]) -> list[int]:
+        result = await message_resource.add_messages(messages)
+        invalidate_threads(message.messageID for message in messages)
+        return result
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+@strawberry.type
+class MessageEvent:
+    op: str
+    userMessageID: int | None
+    userID: int | None
+    messageID: int
+    message: Message | None
 
+@strawberry.type
+class Subscription:
+    @strawberry.subscription
+    async def messageEvents(self, messageThreadID: int) -> AsyncGenerator[MessageEvent, None]:
+        """
+        Messages added, updated or deleted in a thread, pushed as they happen. When older messages
+        are archived or restored, a single "archived" / "restored" event without a userMessageID
+        covers the whole thread.
+        """
+        async for event in message_events.subscribe(messageThreadID):
+            message = from_row(Message, event["message"]) if event["message"] else None
+            yield MessageEvent(op=event["op"], userMessageID=event["userMessageID"], userID=event["userID"], messageID=event["messageID"], message=message)
+
+schema = strawberry.Schema(query=Query, mutation=Mutation, subscription=Subscription)
+
+
+async def load_users(userIDs: list[int]) -> list[User | None]:
+    users = {u["userID"]: from_row(User, u) for u in await user_resource.get_users_by_ids(userIDs)}
+    return [users.get(userID) for userID in userIDs]
+
+
+async def load_user_messages(userIDs: list[int]) -> list[list[Message]]:
+    messages = {userID: [] for userID in userIDs}
+    for msg in await message_resource.get_messages_by_users(userIDs):
+        messages[msg["userID"]].append(from_row(Message, msg))
+    return [messages[userID] for userID in userIDs]
+
+
+class MessagesGraphQL(GraphQL):
+    async def get_context(self, request, response=None):
+        # Loaders are per operation, so every author / messages lookup in one query is batched
+        # into a single ANY(%s) query and nothing is cached across requests.
+        return {
+            "request": request,
+            "response": response,
+            "user_loader": DataLoader(load_fn=load_users),
+            "user_messages_loader": DataLoader(load_fn=load_user_messages),
+        }
+
+    
+graphql_app = MessagesGraphQL(schema)
+
+def get_database_config():
+    if DATABASE_CONFIG is not None:
+        return DATABASE_CONFIG
 
-def get_data_service():
     database = {}
     if LOCAL:
         database = {
@@ -90,12 +261,31 @@ def get_data_service():
             "db_pass" : "message",
         }
 
-    ds = UserDataService(database)
+    return database
+
+
+def get_database(config: dict):
+    if config.get("data_backend", DATA_BACKEND) == "memory":
+        return MemoryDatabaseDataService(config)
+    # With replicas configured, reads are routed to them and writes to the primary.
+    replicas = config.get("db_replica_dsns", DB_REPLICA_DSNS)
+    if replicas:
+        return RoutingDatabaseDataService({"db_replica_dsns": replicas, "db_replica_sticky_seconds": DB_REPLICA_STICKY_SECONDS, "db_replica_pool_max": runtime.replica_pool_max(), **config})
+    return AsyncDatabaseDataService(config)
+
+
+def get_data_service(database: AsyncDatabaseDataService):
+    cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+    if CACHE_REDIS_URL:
+        cache = TieredCache(cache, RedisCache(CACHE_REDIS_URL, USER_CACHE_TTL))
+
+    users = MemoryUserDataService if isinstance(database, MemoryDatabaseDataService) else AsyncUserDataService
+    ds = CachedUserDataService(users({"database": database}), cache)
     return ds
 
 
-def get_user_resource():
-    ds = get_data_service()
+def get_user_resource(database: AsyncDatabaseDataService):
+    ds = get_data_service(database)
     config = {
         "data_service": ds
     }
@@ -103,36 +293,83 @@ def get_user_resource():
     return res
 
 
-user_resource = get_user_resource()
+def get_message_resource(database: AsyncDatabaseDataService):
+    messages = MemoryMessageDataService if isinstance(database, MemoryDatabaseDataService) else AsyncMessageDataService
+    ds = messages({"database": database})
 
-def get_message_resource():
-    database = {}
-    if LOCAL:
-        database = {
-            "db_name" : "message",
-            "db_host" : "localhost",
-            "db_user" : "message",
-            "db_pass" : "message",
-        }
-    else:
-        database = {
-            "db_name" : "message",
-            "db_host" : '/cloudsql/{}'.format("messages-microservice:us-east1:message-db"),
-            "db_user" : "message",
-            "db_pass" : "message",
-        }
+    config = {
+        "data_service": ds
+    }
+    res = MessageResource(config)
+    return res
 
 
-    ds = MessageDataService(database)
+def get_thread_resource(database: AsyncDatabaseDataService):
+    threads = MemoryThreadDataService if isinstance(database, MemoryDatabaseDataService) else AsyncThreadDataService
+    ds = threads({"database": database})
 
     config = {
         "data_service": ds
     }
-    res = MessageResource(config)
+    res = ThreadResource(config)
     return res
 
 
-message_resource = get_message_resource()
+# Built in lifespan() rather than at import, so the worker binds its port without waiting for
+# Cloud SQL. Both resources share one connection pool.
+database = None
+user_resource = None
+message_resource = None
+thread_resource = None
+message_events = None
+message_write_queue = None
+message_cache = None
+message_archive = MessageArchive(ARCHIVE_DIR)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global database, user_resource, message_resource, thread_resource, message_events, message_write_queue, message_cache
+
+    database = get_database({"db_slow_query_seconds": SLOW_QUERY_SECONDS, "db_pool_max": runtime.pool_max(), **get_database_config()})
+    user_resource = get_user_resource(database)
+    message_resource = get_message_resource(database)
+    thread_resource = get_thread_resource(database)
+    message_events = MessageEventBroker({"database": database, "data_service": message_resource.data_service})
+    if MESSAGE_CACHE_BYTES:
+        message_cache = MessageResponseCache(MESSAGE_CACHE_BYTES)
+        # Other workers' writes arrive as NOTIFY events.
+        message_events.add_watcher(message_cache.on_event)
+    message_events.add_watcher(user_resource.data_service.on_event)
+    # Connections are established in the background; the first queries wait for them.
+    await database.open()
+    await message_events.start()
+    if WRITE_BEHIND:
+        message_write_queue = MessageWriteQueue({
+            "data_service": message_resource.data_service,
+            "journal_dir": WRITE_QUEUE_JOURNAL_DIR,
+            "max_size": WRITE_QUEUE_SIZE,
+            "batch_size": WRITE_QUEUE_BATCH_SIZE,
+            "flush_interval": WRITE_QUEUE_FLUSH_INTERVAL,
+            "put_timeout": WRITE_QUEUE_PUT_TIMEOUT,
+        })
+        # Replays whatever a crashed worker left in the journal before taking new messages.
+        await message_write_queue.start()
+    yield
+    if message_write_queue is not None:
+        await message_write_queue.stop()
+    await message_events.stop()
+    await database.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(StickyReadsMiddleware, sticky_seconds=DB_REPLICA_STICKY_SECONDS)
+app.add_route("/graphql", graphql_app)
+app.add_websocket_route("/graphql", graphql_app)
+
+app.mount("/static", StaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
 
 
 #
@@ -156,9 +393,41 @@ async def api():
     """
     return RedirectResponse("/docs")
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: the process is up and serving requests.
+    """
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: the database is reachable, so the instance can take traffic.
+    """
+    if database is None or not await database.ping(READY_TIMEOUT):
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ok"}
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus metrics: request latency per route, DB time and rows per data-service operation,
+    pool wait and serialization time, plus the connection pool and user cache counters.
+    """
+    gauges = {}
+    if database is not None:
+        gauges["db_pool"] = database.get_metrics()
+        gauges["user_cache"] = user_resource.data_service.get_cache_stats()
+    if message_cache is not None:
+        gauges["message_cache"] = message_cache.get_stats()
+    if message_write_queue is not None:
+        gauges["message_write_queue"] = message_write_queue.get_metrics()
+    return Response(content=metrics.render(gauges), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/profile/{userID}", response_class=HTMLResponse)
 async def profile(request: Request, userID: int):
-    result = user_resource.get_users(userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None)
+    result = await user_resource.get_users(userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None)
     if len(result) == 1:
         result = result[0]
     else:
@@ -167,12 +436,19 @@ async def profile(request: Request, userID: int):
     return templates.TemplateResponse("profile.html", {"request": request, "userID": userID, "result": result})
 
 @app.get("/api/users", response_model=List[UserRspModel])
-async def get_users(userID: int | None = None, firstName: str | None = None, lastName: str | None = None, isAdmin: bool | None = None, offset: int | None = None, limit: int | None = None):
+async def get_users(userID: int | None = None, firstName: str | None = None, lastName: str | None = None, isAdmin: bool | None = None, offset: int | None = None, limit: int | None = None, cursor: str | None = None):
     """
     Return all users.
+
+    - **limit** / **offset**: page size and number of rows to skip
+    - **cursor**: X-Next-Cursor header of the previous page, for keyset pagination
     """
-    result = user_resource.get_users(userID, firstName, lastName, isAdmin, offset, limit)
-    return result
+    try:
+        page = await user_resource.get_users_page(userID, firstName, lastName, isAdmin, offset, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers = {"X-Next-Cursor": page["next_cursor"]} if page["next_cursor"] is not None else None
+    return TrustedJSONResponse(page["items"], headers=headers)
 
 @app.get("/api/users/{userID}", response_model=Union[List[UserRspModel], UserRspModel, None])
 async def get_student(userID: int):
@@ -181,19 +457,98 @@ async def get_student(userID: int):
 
     - **userID**: User's userID
     """
-    result = user_resource.get_users(userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None)
+    result = await user_resource.get_users(userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None)
     if len(result) == 1:
         result = result[0]
     else:
         raise HTTPException(status_code=404, detail="Not found")
 
+    return TrustedJSONResponse(result)
+
+
+@app.get("/api/users/{userID}/threads", response_model=List[ThreadSummaryRspModel])
+async def get_threads(userID: int, limit: int | None = None):
+    """
+    Return the user's inbox: one summary per thread, most recently active first.
+
+    - **userID**: User's userID
+    """
+    result = await thread_resource.get_threads(userID, limit)
+
+    return TrustedJSONResponse(result)
+
+@app.put("/api/users/{userID}/threads/{messageThreadID}/read")
+async def mark_thread_read(userID: int, messageThreadID: int):
+    """
+    Mark everything currently in the thread as read by the user.
+    """
+    result = await thread_resource.mark_read(userID, messageThreadID)
+    if result is not None and len(result) == 1:
+        result = result[0]
+    else:
+        raise HTTPException(status_code=404, detail="Not found")
+
     return result
 
 
+def invalidate_threads(messageThreadIDs):
+    # This worker's cache, right away; the others follow on the NOTIFY.
+    if message_cache is not None:
+        for messageThreadID in set(messageThreadIDs):
+            message_cache.invalidate(messageThreadID)
+
+async def cached_thread_response(messageThreadID: int, key: tuple, load, headers: dict = None):
+    """
+    Serves a JSON thread read from message_cache, or runs load() and caches its serialized body.
+    """
+    if message_cache is None:
+        return TrustedJSONResponse(await load(), headers=headers)
+    body = message_cache.get(messageThreadID, key)
+    if body is not None:
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    generation = message_cache.generation(messageThreadID)
+    # From the primary: a lagging replica could hand the cache a version older than the NOTIFY
+    # that would have invalidated it.
+    with primary_reads():
+        result = await load()
+    response = TrustedJSONResponse(result, headers=headers)
+    message_cache.set(messageThreadID, key, response.body, generation)
+    return response
+
+@app.get("/api/threads/{messageThreadID}/messages", response_model=List[MessageRspModel])
+async def get_conversation(request: Request, messageThreadID: int, userMessageID: int | None = None, before: int | None = None, after: int | None = None, timestamps: Literal["legacy", "iso", "epoch"] = "legacy"):
+    """
+    Return the conversation: every participant's messages in the thread, oldest first.
+
+    - **userMessageID**: center a window on this message, with up to **before** messages
+      preceding it and up to **after** following it
+    - **before** / **after** (without userMessageID): only the latest / first N messages
+    - **timestamps**: see /api/messages
+
+    Responses carry a weak ETag for the thread's current contents. Send it back in If-None-Match
+    to get 304 Not Modified, answered from the thread summary without reading any messages.
+    """
+    if any(n is not None and n < 0 for n in (before, after)):
+        raise HTTPException(status_code=400, detail="before and after must not be negative")
+    etag = await thread_resource.get_etag(messageThreadID)
+    if etag is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    # A write landing between the two reads leaves the body newer than its ETag, which only
+    # costs the client one more full response.
+    return await cached_thread_response(
+        messageThreadID, ("conversation", userMessageID, before, after, timestamps),
+        lambda: message_resource.get_conversation(messageThreadID, userMessageID, before, after, timestamps),
+        headers)
+
 @app.post("/api/users/newUser")
-def add_users(request: UserModel):
+async def add_users(request: UserModel):
     
-    result = user_resource.add_user(request)
+    result = await user_resource.add_user(request)
     if len(result) == 1:
         result = result[0]
     else:
@@ -201,80 +556,181 @@ def add_users(request: UserModel):
     
     return result
 
+def stream_messages_response(request: Request, userID: int | None, messageThreadID: int | None, messageID: int | None, messageContents: str | None, since: datetime | None = None, before: datetime | None = None, timestamps: str = "legacy"):
+    batches = message_resource.stream_messages(userID, messageThreadID, messageID, messageContents, STREAM_BATCH_SIZE, since, before, timestamps)
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(ndjson_stream(batches), media_type=NDJSON_MEDIA_TYPE)
+    return StreamingResponse(json_array_stream(batches), media_type="application/json")
+
+async def columnar_messages_response(media_type: str, userID: int | None, messageThreadID: int | None, messageID: int | None, messageContents: str | None, offset: int | None, limit: int | None, cursor: str | None, since: datetime | None = None, before: datetime | None = None):
+    try:
+        page = await message_resource.get_messages_columns(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers = {"X-Next-Cursor": page["next_cursor"]} if page["next_cursor"] is not None else None
+    return Response(content=columnar.encode(page["columns"], media_type), media_type=media_type, headers=headers)
+
 @app.get("/api/messages", response_model=List[MessageRspModel])
-async def get_messages(userID: int | None = None, messageThreadID: int | None = None, messageID: int | None = None, messageContents: int | None = None, offset: int | None = None, limit: int | None = None):
+async def get_messages(request: Request, userID: int | None = None, messageThreadID: int | None = None, messageID: int | None = None, messageContents: str | None = None, offset: int | None = None, limit: int | None = None, cursor: str | None = None, stream: bool = False, since: datetime | None = None, before: datetime | None = None, timestamps: Literal["legacy", "iso", "epoch"] = "legacy"):
     """
     Returns all messages.
+
+    - **limit** / **offset**: page size and number of rows to skip
+    - **cursor**: X-Next-Cursor header of the previous page, for keyset pagination
+    - **since** / **before**: only messages with since <= creationDT < before
+    - **timestamps**: creationDT as "legacy" ("10/03/2023, 16:25:00"), "iso" (ISO-8601) or
+      "epoch" (milliseconds since 1970-01-01 UTC)
+    - **stream**: stream every matching message instead of one page; NDJSON if the Accept header
+      asks for application/x-ndjson, otherwise a chunked JSON array
+
+    Sending Accept: application/vnd.columnar+json (or application/x-msgpack /
+    application/vnd.apache.arrow.stream when available) returns the page column-oriented,
+    e.g. {"userMessageID": [...], "creationDT": [...]}, with ISO-8601 timestamps.
     """
 
-    result = message_resource.get_messages(userID, messageThreadID, messageID, messageContents, offset, limit)
-    return result
+    if stream:
+        return stream_messages_response(request, userID, messageThreadID, messageID, messageContents, since, before, timestamps)
+    media_type = columnar.negotiate(request.headers.get("accept"))
+    if media_type:
+        return await columnar_messages_response(media_type, userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before)
+    try:
+        page = await message_resource.get_messages_page(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before, timestamps)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers = {"X-Next-Cursor": page["next_cursor"]} if page["next_cursor"] is not None else None
+    return TrustedJSONResponse(page["items"], headers=headers)
+
+@app.get("/api/messages/search", response_model=List[MessageSearchRspModel])
+async def search_messages(q: str, userID: int | None = None, messageThreadID: int | None = None, limit: int = 50):
+    """
+    Full-text search over message contents, best match first. Every word matches as a prefix.
+
+    - **q**: search text
+    - **userID** / **messageThreadID**: restrict the search to one user or thread
+    """
+
+    result = await message_resource.search_messages(q, userID, messageThreadID, limit)
+    return TrustedJSONResponse(result)
+
+@app.get("/api/messages/archive", response_model=List[MessageRspModel])
+async def get_archived_messages(request: Request, userID: int | None = None, messageThreadID: int | None = None, messageID: int | None = None, since: datetime | None = None, before: datetime | None = None, timestamps: Literal["legacy", "iso", "epoch"] = "legacy"):
+    """
+    Stream archived messages: the months moved out of the database by the partition archival job.
+
+    - **userID** / **messageThreadID** / **messageID**: filters, as for /api/messages
+    - **since** / **before**: only the archived months overlapping the range are read
+    - **timestamps**: see /api/messages
+
+    NDJSON if the Accept header asks for application/x-ndjson, otherwise a chunked JSON array.
+    """
+
+    batches = message_archive.stream_messages(userID, messageThreadID, messageID, STREAM_BATCH_SIZE, since, before, timestamps)
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(ndjson_stream(batches), media_type=NDJSON_MEDIA_TYPE)
+    return StreamingResponse(json_array_stream(batches), media_type="application/json")
 
 @app.get("/api/messages/{userID}", response_model=Union[List[MessageRspModel], MessageRspModel, None])
-async def get_messages(userID: int):
+async def get_messages(request: Request, userID: int, stream: bool = False, since: datetime | None = None, before: datetime | None = None, timestamps: Literal["legacy", "iso", "epoch"] = "legacy"):
     """
     Return messages based on userID.
 
     - **userID**: User's userID
+    - **stream**: stream the user's full history (see /api/messages)
+    - **since** / **before** / **timestamps**: see /api/messages
     """
     
-    result = message_resource.get_messages(userID, messageThreadID=None, messageID=None, messageContents=None, offset=None, limit=None)
+    if stream:
+        return stream_messages_response(request, userID, None, None, None, since, before, timestamps)
+    result = await message_resource.get_messages(userID, messageThreadID=None, messageID=None, messageContents=None, offset=None, limit=None, since=since, before=before, timestamps=timestamps)
 
-    return result
+    return TrustedJSONResponse(result)
 
 @app.get("/api/messages/{userID}/{messageThreadID}", response_model=Union[List[MessageRspModel], MessageRspModel, None])
-async def get_messages(userID: int, messageThreadID: int):
+async def get_messages(request: Request, userID: int, messageThreadID: int, since: datetime | None = None, before: datetime | None = None, timestamps: Literal["legacy", "iso", "epoch"] = "legacy"):
     """
     Return messages based on userID and message Thread ID.
 
     - **userID**: User's userID
     - **messageThreadID**: ThreadID
-    """
+    - **since** / **before** / **timestamps**: see /api/messages
 
-    result = message_resource.get_messages(userID, messageThreadID, messageID=None, messageContents=None, offset=None, limit=None)
+    Supports the same columnar Accept types as /api/messages.
+    """
 
-    return result
+    media_type = columnar.negotiate(request.headers.get("accept"))
+    if media_type:
+        return await columnar_messages_response(media_type, userID, messageThreadID, None, None, None, None, None, since, before)
+    return await cached_thread_response(
+        messageThreadID, ("user", userID, since, before, timestamps),
+        lambda: message_resource.get_messages(userID, messageThreadID, messageID=None, messageContents=None, offset=None, limit=None, since=since, before=before, timestamps=timestamps))
 
 @app.post("/api/messages/newMessage")
-def new_message(request: MessageModel):
+async def new_message(request: MessageModel):
     
+    if message_write_queue is not None:
+        # The database only sees the message after the 202, so reject an unknown userID (its one
+        # foreign key; threads are created on insert) here, from the user cache.
+        if not await user_resource.get_users(request.userID, firstName=None, lastName=None, isAdmin=None, offset=None, limit=None):
+            raise HTTPException(status_code=404, detail="Not found")
+        # Accepted, not yet inserted: same body as below, plus the new message's ID.
+        try:
+            userMessageID = await message_write_queue.add_message(request)
+        except QueueFull:
+            raise HTTPException(status_code=503, detail="Too many pending messages", headers={"Retry-After": "1"})
+        return TrustedJSONResponse(request.messageID, status_code=202, headers={"X-User-Message-ID": str(userMessageID)})
+
     result = None
-    result = message_resource.add_message(request)
+    result = await message_resource.add_message(request)
     if len(result) == 1:
         result = result[0]
+        invalidate_threads([result])
     else:
         raise HTTPException(status_code=404, detail="Not found")
     
     return result
 
+@app.post("/api/messages/bulk", response_model=List[int])
+async def new_messages(request: List[MessageModel]):
+    """
+    Adds many messages in one transaction and returns their userMessageIDs, in request order.
+    userMessageID and creationDT in the request are ignored.
+    """
+
+    result = await message_resource.add_messages(request)
+    invalidate_threads(message.messageID for message in request)
+
+    return result
+
 @app.put("/api/messages/newMessage")
-def put_message(request: MessageModel):
+async def put_message(request: MessageModel):
     
     result = None
-    result = message_resource.put_message(request)
+    result = await message_resource.put_message(request)
     if len(result) == 1:
         result = result[0]
+        invalidate_threads([result])
     else:
         raise HTTPException(status_code=404, detail="Not found")
     
     return result
 
 @app.delete("/api/messages/newMessage")
-def delete_message(request: MessageModel):
+async def delete_message(request: MessageModel):
     
     result = None
-    result = message_resource.delete_message(request)
+    result = await message_resource.delete_message(request)
     if len(result) == 1:
         result = result[0]
+        invalidate_threads([result])
     else:
         raise HTTPException(status_code=404, detail="Not found")
     
     return result
 
 @app.delete("/api/users/deleteUser")
-def delete_users(request: UserModel):
+async def delete_users(request: UserModel):
     
-    result = user_resource.delete_user(request)
+    result = await user_resource.delete_user(request)
     if len(result) == 1:
         result = result[0]
     else:
@@ -285,4 +741,5 @@ def delete_users(request: UserModel):
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8011, reload=True)
+    # Production runs gunicorn with gunicorn.conf.py instead (see app.yaml).
+    uvicorn.run("main:app", host="0.0.0.0", port=8011, reload=RELOAD, workers=None if RELOAD else runtime.worker_count())
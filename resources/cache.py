@@ -0,0 +1,156 @@
+#
+# Small pluggable caches used in front of the data services. All caches share the same async
+# interface (get / set / delete / clear / get_stats) so a local LRU can be swapped for, or
+# layered over, a shared store. get returns None on a miss, so None itself cannot be cached.
+#
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        """
+
+        In-process LRU cache whose entries also expire ttl seconds after they were set.
+
+        :param max_size: Maximum number of entries; the least recently used one is evicted first.
+        :param ttl: Seconds an entry stays valid. None means entries never expire.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get_sync(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set_sync(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def delete_sync(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    async def get(self, key):
+        return self.get_sync(key)
+
+    async def set(self, key, value):
+        self.set_sync(key, value)
+
+    async def delete(self, key):
+        self.delete_sync(key)
+
+    def clear_sync(self):
+        with self._lock:
+            self._entries.clear()
+
+    async def clear(self):
+        self.clear_sync()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        stats["max_size"] = self.max_size
+        return stats
+
+
+class RedisCache():
+
+    def __init__(self, url: str, ttl: float = 60, prefix: str = "messages:"):
+        """
+
+        Cache shared by every worker and instance, stored in Redis as JSON. Needs the optional
+        redis package.
+
+        :param url: Redis URL, e.g. redis://localhost:6379/0
+        """
+        try:
+            import redis.asyncio
+        except ImportError as e:
+            raise ImportError("RedisCache requires the 'redis' package") from e
+
+        self.client = redis.asyncio.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._stats = {"hits": 0, "misses": 0}
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        if raw is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        return json.loads(raw)
+
+    async def set(self, key, value):
+        ttl = int(self.ttl) if self.ttl is not None else None
+        await self.client.set(self.prefix + key, json.dumps(value, default=str), ex=ttl)
+
+    async def delete(self, key):
+        await self.client.delete(self.prefix + key)
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=self.prefix + "*"):
+            await self.client.delete(key)
+
+    def get_stats(self) -> dict:
+        return dict(self._stats)
+
+
+class TieredCache():
+
+    def __init__(self, local, shared):
+        """
+
+        Checks local first and falls back to shared, copying shared hits into local. Writes and
+        deletes go to both.
+        """
+        self.local = local
+        self.shared = shared
+
+    async def get(self, key):
+        value = await self.local.get(key)
+        if value is None:
+            value = await self.shared.get(key)
+            if value is not None:
+                await self.local.set(key, value)
+        return value
+
+    async def set(self, key, value):
+        await self.local.set(key, value)
+        await self.shared.set(key, value)
+
+    async def delete(self, key):
+        await self.local.delete(key)
+        await self.shared.delete(key)
+
+    async def clear(self):
+        await self.local.clear()
+        await self.shared.clear()
+
+    def get_stats(self) -> dict:
+        return {"local": self.local.get_stats(), "shared": self.shared.get_stats()}
@@ -0,0 +1,71 @@
+#
+# Compact, column-oriented response bodies for large reads, chosen through the Accept header.
+# The input is {column: [values...]} as returned by fetchcolumnsquery, so no per-row dict or
+# model is ever built. MessagePack and Arrow need their optional packages (msgpack, pyarrow) and
+# are only offered when those are installed.
+#
+import json
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+COLUMNAR_JSON = "application/vnd.columnar+json"
+MSGPACK = "application/x-msgpack"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def available_formats() -> list:
+    formats = [COLUMNAR_JSON]
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    if pyarrow is not None:
+        formats.append(ARROW_STREAM)
+    return formats
+
+
+def negotiate(accept: str) -> str | None:
+    """
+
+    :param accept: The request's Accept header.
+    :return: The first columnar media type the client accepts, or None for the regular response.
+    """
+    if not accept:
+        return None
+    requested = [part.split(";")[0].strip() for part in accept.split(",")]
+    formats = available_formats()
+    for media_type in requested:
+        if media_type in formats:
+            return media_type
+    return None
+
+
+def _plain(columns: dict) -> dict:
+    # JSON and MessagePack have no timestamp type; send ISO-8601 strings.
+    result = {}
+    for name, values in columns.items():
+        if values and isinstance(values[0], datetime):
+            values = [v.isoformat() if v is not None else None for v in values]
+        result[name] = values
+    return result
+
+
+def encode(columns: dict, media_type: str) -> bytes:
+    if media_type == MSGPACK:
+        return msgpack.packb(_plain(columns))
+    if media_type == ARROW_STREAM:
+        table = pyarrow.table(columns)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    return json.dumps(_plain(columns), separators=(",", ":")).encode()
@@ -0,0 +1,289 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import json
+import logging
+import time
+import weakref
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+from resources import metrics
+
+
+slow_query_log = logging.getLogger("slow_query")
+
+
+class AsyncDatabaseDataService():
+    def __init__(self, config: dict):
+        """
+
+        asyncio counterpart of DatabaseDataService, backed by psycopg 3 and its own connection pool.
+        Queries use the same %s placeholders as DatabaseDataService.
+
+        Parameterized statements are prepared server-side on first use and kept, per connection, in
+        an LRU of at most db_prepared_max statements (0 turns this off). The query builders emit one
+        text per filter shape (see query_builder.py), so the hot statements stay prepared.
+
+        :param config: A dictionary of configuration parameters. Uses the same keys as
+            DatabaseDataService (db_pool_min, db_pool_max, db_pool_timeout, db_pool_health_check),
+            plus db_dsn (a connection string used instead of db_name, db_host, db_user and
+            db_pass), db_prepared_max and db_slow_query_seconds (queries at least this slow are logged
+            to the "slow_query" logger; None, the default, logs nothing).
+        """
+        self.config = config
+        self.pool_min = config.get("db_pool_min", 1)
+        self.pool_max = config.get("db_pool_max", 10)
+        self.prepared_max = config.get("db_prepared_max", 100)
+        self.slow_query_seconds = config.get("db_slow_query_seconds")
+
+        # Mirrors psycopg's per-connection prepared LRU (same size, same order) for the metrics,
+        # and per statement [misses, miss seconds, hits, hit seconds].
+        self._prepared = weakref.WeakKeyDictionary()
+        self._prepared_evictions = 0
+        self._statement_stats = {}
+
+        if config.get("db_dsn"):
+            self.conninfo = config["db_dsn"]
+        else:
+            self.conninfo = make_conninfo(dbname=config["db_name"],
+                            host=config["db_host"],
+                            user=config["db_user"],
+                            password=config["db_pass"])
+        self.pool = AsyncConnectionPool(self.conninfo,
+                        min_size=self.pool_min,
+                        max_size=self.pool_max,
+                        timeout=config.get("db_pool_timeout", 30),
+                        # Only statements run through _execute() are prepared.
+                        kwargs={"autocommit": True, "prepare_threshold": None},
+                        configure=self._configure,
+                        check=AsyncConnectionPool.check_connection,
+                        open=False)
+
+    async def _configure(self, conn):
+        conn.prepared_max = self.prepared_max
+
+    async def open(self):
+        await self.pool.open()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def connect(self):
+        """
+
+        Opens a dedicated autocommit connection outside the pool, for sessions that hold on to their
+        connection (e.g. LISTEN). The caller closes it.
+        """
+        return await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True)
+
+    async def listen(self, channel: str, reconnect_delay: float = 1):
+        """
+
+        Yields the JSON payload of every NOTIFY on channel, on a dedicated connection. A dropped
+        connection is reopened after reconnect_delay seconds; notifications sent meanwhile are lost,
+        so None is yielded each time listening (re)starts for consumers that must resynchronize.
+        """
+        while True:
+            try:
+                conn = await self.connect()
+                try:
+                    await conn.execute(f"LISTEN {channel}")
+                    yield None
+                    async for notify in conn.notifies():
+                        yield json.loads(notify.payload)
+                finally:
+                    await conn.close()
+            except psycopg.OperationalError:
+                await asyncio.sleep(reconnect_delay)
+
+    async def ping(self, timeout: float = 2) -> bool:
+        """
+
+        Returns True if a connection can be checked out and answers SELECT 1 within timeout seconds.
+        """
+        try:
+            async with self.pool.connection(timeout=timeout) as conn:
+                await conn.execute("SELECT 1")
+            return True
+        except (psycopg.Error, PoolTimeout):
+            return False
+
+    @asynccontextmanager
+    async def _connection(self):
+        start = time.perf_counter()
+        async with self.pool.connection() as conn:
+            metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+            yield conn
+
+    @asynccontextmanager
+    async def cursor(self):
+        """
+
+        Checks a connection out of the pool for the duration of the block and yields a cursor on it.
+        Statements run in autocommit mode.
+        """
+        async with self._connection() as conn:
+            async with conn.cursor() as cursor:
+                yield cursor
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+
+        Like cursor(), but every statement in the block runs in one transaction that is committed
+        when the block exits and rolled back if it raises.
+        """
+        async with self._connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor() as cursor:
+                    yield cursor
+
+    async def _execute(self, cursor, query: str, params):
+        prepare = bool(self.prepared_max and params)
+        start = time.perf_counter()
+        if prepare:
+            hit = query in self._prepared.get(cursor.connection, ())
+            await cursor.execute(query, params, prepare=True)
+        else:
+            await cursor.execute(query, params)
+        elapsed = time.perf_counter() - start
+
+        self._observe(query, elapsed, cursor.rowcount)
+        if prepare:
+            self._track_prepared(cursor.connection, query, hit, elapsed)
+
+    def _observe(self, query: str, elapsed: float, rows: int):
+        name = metrics.operation.get()
+        metrics.DB_QUERY_SECONDS.observe(elapsed, name)
+        metrics.DB_ROWS.observe(max(rows, 0), name)
+        if self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds:
+            slow_query_log.warning("%s took %.3fs (%d rows): %s", name, elapsed, rows, query)
+
+    def _track_prepared(self, conn, query: str, hit: bool, elapsed: float):
+        statements = self._prepared.setdefault(conn, OrderedDict())
+        if hit:
+            statements.move_to_end(query)
+        else:
+            statements[query] = None
+            if len(statements) > self.prepared_max:
+                statements.popitem(last=False)
+                self._prepared_evictions += 1
+        stats = self._statement_stats.setdefault(query, [0, 0.0, 0, 0.0])
+        i = 2 if hit else 0
+        stats[i] += 1
+        stats[i + 1] += elapsed
+
+    def get_statement_stats(self) -> list:
+        """
+
+        Per prepared statement: how often it was prepared (misses) and reused (hits), and the
+        estimated parse/plan seconds saved, i.e. hits times how much slower a preparing execution
+        was than a reusing one on average.
+        """
+        result = []
+        for query, (misses, miss_seconds, hits, hit_seconds) in self._statement_stats.items():
+            saved = 0.0
+            if misses and hits:
+                saved = hits * max(0.0, miss_seconds / misses - hit_seconds / hits)
+            result.append({"query": query, "misses": misses, "hits": hits, "seconds_saved": saved})
+        return result
+
+    def get_metrics(self) -> dict:
+        stats = self.pool.get_stats()
+        statements = self.get_statement_stats()
+        return {
+            "checkouts": stats.get("requests_num", 0),
+            "waiters": stats.get("requests_waiting", 0),
+            "timeouts": stats.get("requests_errors", 0),
+            "reconnects": stats.get("connections_lost", 0),
+            "checkout_seconds_total": stats.get("requests_wait_ms", 0) / 1000,
+            "pool_min": self.pool_min,
+            "pool_max": self.pool_max,
+            "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+            "idle": stats.get("pool_available", 0),
+            "prepared_max": self.prepared_max,
+            "prepared_statements": sum(len(s) for s in self._prepared.values()),
+            "prepared_hits": sum(s["hits"] for s in statements),
+            "prepared_misses": sum(s["misses"] for s in statements),
+            "prepared_evictions": self._prepared_evictions,
+            "prepared_seconds_saved": sum(s["seconds_saved"] for s in statements),
+        }
+
+    async def execute_query(self, query: str = None, params: () = None):
+        if (query):
+            async with self.cursor() as cursor:
+                await self._execute(cursor, query, params)
+                return cursor.rowcount
+        return 0
+
+    async def fetchallquery(self, query: str = None, params: () = None):
+        if not query:
+            return []
+        async with self.cursor() as cursor:
+            await self._execute(cursor, query, params)
+            columns = [col.name for col in cursor.description]
+            return [dict(zip(columns, row)) for row in await cursor.fetchall()]
+
+    async def streamquery(self, query: str = None, params: () = None, size: int = 1000):
+        """
+
+        Runs query on a server-side (named) cursor and yields the result in batches of at most size
+        rows, so only one batch is held in memory at a time. The connection stays checked out until
+        the generator is exhausted or closed.
+
+        Observed once, when the stream ends or is closed, with the time spent in the database
+        (the execute and every fetch, not the caller's time between batches) and the total rows.
+        """
+        if not query:
+            return
+        elapsed, total = 0.0, 0
+        async with self._connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor(name="stream") as cursor:
+                    start = time.perf_counter()
+                    await cursor.execute(query, params)
+                    elapsed += time.perf_counter() - start
+                    try:
+                        columns = [col.name for col in cursor.description]
+                        while True:
+                            start = time.perf_counter()
+                            rows = await cursor.fetchmany(size)
+                            elapsed += time.perf_counter() - start
+                            if not rows:
+                                break
+                            total += len(rows)
+                            yield [dict(zip(columns, row)) for row in rows]
+                    finally:
+                        self._observe(query, elapsed, total)
+
+    async def fetchcolumnsquery(self, query: str = None, params: () = None):
+        """
+
+        Returns the result column-oriented, {column: [values...]}, transposed straight from the
+        row tuples without building a dict per row.
+        """
+        if not query:
+            return {}
+        async with self.cursor() as cursor:
+            await self._execute(cursor, query, params)
+            columns = [col.name for col in cursor.description]
+            rows = await cursor.fetchall()
+        values = [list(col) for col in zip(*rows)] if rows else [[] for _ in columns]
+        return dict(zip(columns, values))
+
+    async def fetchonequery(self, query: str = None, params: () = None):
+        if not query:
+            return []
+        async with self.cursor() as cursor:
+            await self._execute(cursor, query, params)
+            return await cursor.fetchone()
+
+    async def fetchmanyquery(self, query: str = None, size: int = 1, params: () = None):
+        if not query:
+            return []
+        async with self.cursor() as cursor:
+            await self._execute(cursor, query, params)
+            return await cursor.fetchmany(size=size)
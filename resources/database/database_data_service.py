@@ -1,6 +1,11 @@
 #from resources.abstract_base_data_service import BaseDataService
 import json
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.pool
 
 
 
@@ -9,43 +14,179 @@ class DatabaseDataService():
     def __init__(self, config: dict):
         """
 
-        :param config: A dictionary of configuration parameters.
+        :param config: A dictionary of configuration parameters. Besides the connection settings,
+            db_pool_min / db_pool_max size the pool, db_pool_timeout is how long (seconds) a caller
+            waits for a free connection and db_pool_health_check is how long (seconds) a connection
+            may sit idle before it is pinged on checkout.
         """
         #super().__init__()
 
-        self.conn = psycopg2.connect(database=config["db_name"],
+        self.config = config
+        self.pool_min = config.get("db_pool_min", 1)
+        self.pool_max = config.get("db_pool_max", 10)
+        self.pool_timeout = config.get("db_pool_timeout", 30)
+        self.health_check = config.get("db_pool_health_check", 30)
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(self.pool_min, self.pool_max,
+                        database=config["db_name"],
                         host=config["db_host"],
                         user=config["db_user"],
                         password=config["db_pass"])
-        self.conn.autocommit = True
-        self.cursor = self.conn.cursor()
 
-    def _get_cursor(self):
-        return self.cursor
+        # ThreadedConnectionPool raises instead of blocking when it is exhausted, so callers
+        # queue on this semaphore until a connection is handed back.
+        self._slots = threading.BoundedSemaphore(self.pool_max)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._metrics = {
+            "checkouts": 0,
+            "waiters": 0,
+            "max_waiters": 0,
+            "timeouts": 0,
+            "reconnects": 0,
+            "checkout_seconds_total": 0.0,
+            "checkout_seconds_max": 0.0,
+        }
+
+    def _checkout(self):
+        start = time.perf_counter()
+        with self._lock:
+            self._metrics["waiters"] += 1
+            self._metrics["max_waiters"] = max(self._metrics["max_waiters"], self._metrics["waiters"])
+        try:
+            acquired = self._slots.acquire(timeout=self.pool_timeout)
+        finally:
+            with self._lock:
+                self._metrics["waiters"] -= 1
+        if not acquired:
+            with self._lock:
+                self._metrics["timeouts"] += 1
+            raise psycopg2.pool.PoolError("timed out waiting for a database connection")
+
+        try:
+            conn = self._healthy(self.pool.getconn())
+        except Exception:
+            self._slots.release()
+            raise
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._metrics["checkouts"] += 1
+            self._metrics["checkout_seconds_total"] += elapsed
+            self._metrics["checkout_seconds_max"] = max(self._metrics["checkout_seconds_max"], elapsed)
+        return conn
+
+    def _healthy(self, conn):
+        """
+
+        Returns a usable connection, replacing conn if its socket was dropped (e.g. Cloud SQL
+        closing idle connections). Connections idle longer than health_check are pinged first.
+        """
+        idle = time.monotonic() - self._last_used.get(id(conn), time.monotonic())
+        dead = bool(conn.closed)
+        if not dead and idle >= self.health_check:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                dead = True
+        if dead:
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+            with self._lock:
+                self._metrics["reconnects"] += 1
+        conn.autocommit = True
+        return conn
+
+    def _checkin(self, conn, broken: bool = False):
+        self._last_used.pop(id(conn), None)
+        if broken or conn.closed:
+            self.pool.putconn(conn, close=True)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+            self.pool.putconn(conn)
+        self._slots.release()
+
+    @contextmanager
+    def cursor(self):
+        """
+
+        Checks a connection out of the pool for the duration of the block and yields a cursor on it.
+        Statements run in autocommit mode.
+        """
+        conn = self._checkout()
+        broken = False
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    @contextmanager
+    def transaction(self):
+        """
+
+        Like cursor(), but every statement in the block runs in one transaction that is committed
+        when the block exits and rolled back if it raises.
+        """
+        conn = self._checkout()
+        broken = False
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+            self._checkin(conn, broken)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["pool_min"] = self.pool_min
+        metrics["pool_max"] = self.pool_max
+        metrics["in_use"] = len(self.pool._used)
+        metrics["idle"] = len(self.pool._pool)
+        return metrics
+
+    def close(self):
+        self.pool.closeall()
 
     def execute_query(self, query: str = None, params: () = None):
         if (query):
-            self.cursor.execute(query, params)
-        return self.cursor
+            with self.cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.rowcount
+        return 0
 
     def fetchallquery(self, query: str = None, params: () = None):
-        if (query):
-            self.cursor.execute(query, params)
-        else: 
+        if not query:
             return []
-        columns = [col[0] for col in self.cursor.description]
-        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-    
+        with self.cursor() as cursor:
+            cursor.execute(query, params)
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
     def fetchonequery(self, query: str = None, params: () = None):
-        if (query):
-            self.cursor.execute(query, params)
-        else: 
+        if not query:
             return []
-        return self.cursor.fetchone()
+        with self.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchone()
 
     def fetchmanyquery(self, query: str = None, size: int = 1, params: () = None):
-        if (query):
-            self.cursor.execute(query, params)
-        else: 
+        if not query:
             return []
-        return self.cursor.fetchmany(size=size)
\ No newline at end of file
+        with self.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchmany(size=size)
@@ -0,0 +1,164 @@
+#
+# In-process stand-in for the Postgres database, used by the Memory*DataService classes when
+# DATA_BACKEND is "memory". Rows live in dicts keyed by their primary key, and each table is
+# indexed the way the SQL schema is: sorted (creationDT, userMessageID) keys overall, per thread
+# and per user. Writes keep the thread summaries current the way the "userMessages_thread_summary"
+# trigger does, and NOTIFY-style events are delivered to listen() subscribers. Nothing is
+# persisted; everything is lost when the process exits.
+#
+import asyncio
+from bisect import bisect_left, insort
+from datetime import datetime, timezone
+
+
+class IntegrityError(Exception):
+    """
+    A write that Postgres would reject with a foreign key or unique violation.
+    """
+
+
+def now() -> datetime:
+    # CURRENT_TIMESTAMP stored in a "timestamp" column: UTC, without a time zone.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class MemoryDatabaseDataService():
+
+    def __init__(self, config: dict = None):
+        """
+
+        :param config: Accepted for symmetry with AsyncDatabaseDataService; unused.
+        """
+        self.config = config or {}
+
+        self.users = {}             # userID -> row
+        self.user_ids = []          # sorted userIDs
+        self.threads = {}           # messageID -> {"messageID", "creationDT"}
+        self.messages = {}          # userMessageID -> row
+        self.message_keys = []      # sorted (creationDT, userMessageID) of every message
+        self.thread_keys = {}       # messageID -> sorted (creationDT, userMessageID)
+        self.user_keys = {}         # userID -> sorted (creationDT, userMessageID)
+        self.participants = {}      # messageID -> {userID: {"messageCount": int, "lastReadDT": datetime}}
+
+        # Serial columns: the next value handed out by DEFAULT.
+        self._sequences = {"userID": 1, "messageID": 1, "userMessageID": 1}
+        self._listeners = {}
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def ping(self, timeout: float = 2) -> bool:
+        return True
+
+    def get_metrics(self) -> dict:
+        return {
+            "users": len(self.users),
+            "threads": len(self.threads),
+            "messages": len(self.messages),
+        }
+
+    def next_id(self, column: str, explicit: int = None) -> int:
+        """
+
+        :param explicit: An ID given by the caller instead of DEFAULT. Unlike a Postgres sequence,
+            the sequence moves past it so later DEFAULT IDs can't collide with it.
+        """
+        value = explicit if explicit is not None else self._sequences[column]
+        self._sequences[column] = max(self._sequences[column], value + 1)
+        return value
+
+    async def listen(self, channel: str, reconnect_delay: float = None):
+        """
+
+        Yields every payload passed to notify() on channel, like AsyncDatabaseDataService.listen.
+        """
+        queue = asyncio.Queue()
+        self._listeners.setdefault(channel, set()).add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._listeners[channel].discard(queue)
+
+    def notify(self, channel: str, payload: dict):
+        for queue in self._listeners.get(channel, ()):
+            queue.put_nowait(dict(payload))
+
+    # "messageUsers"
+
+    def insert_user(self, row: dict) -> dict:
+        if row["userID"] in self.users:
+            raise IntegrityError(f"userID {row['userID']} already exists")
+        self.users[row["userID"]] = row
+        insort(self.user_ids, row["userID"])
+        return row
+
+    def delete_user(self, userID: int) -> dict:
+        if self.user_keys.get(userID) or any(userID in p for p in self.participants.values()):
+            raise IntegrityError(f"userID {userID} is still referenced by messages")
+        row = self.users.pop(userID, None)
+        if row is not None:
+            del self.user_ids[bisect_left(self.user_ids, userID)]
+        return row
+
+    # "messageThread"
+
+    def ensure_thread(self, messageID: int):
+        # INSERT ... ON CONFLICT DO NOTHING
+        if messageID not in self.threads:
+            self.threads[messageID] = {"messageID": self.next_id("messageID", messageID), "creationDT": now()}
+            self.thread_keys[messageID] = []
+            self.participants[messageID] = {}
+
+    def thread_summary(self, messageID: int) -> dict:
+        keys = self.thread_keys[messageID]
+        return {
+            "messageID": messageID,
+            "messageCount": len(keys),
+            "lastUserMessageID": keys[-1][1] if keys else None,
+            "lastMessageDT": keys[-1][0] if keys else None,
+        }
+
+    # "userMessages"
+
+    def _index(self, row: dict):
+        key = (row["creationDT"], row["userMessageID"])
+        insort(self.message_keys, key)
+        insort(self.thread_keys[row["messageID"]], key)
+        insort(self.user_keys.setdefault(row["userID"], []), key)
+
+    def _unindex(self, row: dict):
+        key = (row["creationDT"], row["userMessageID"])
+        for keys in (self.message_keys, self.thread_keys[row["messageID"]], self.user_keys[row["userID"]]):
+            del keys[bisect_left(keys, key)]
+
+    def insert_message(self, row: dict) -> dict:
+        if row["userID"] not in self.users:
+            raise IntegrityError(f"userID {row['userID']} does not exist")
+        if row["messageID"] not in self.threads:
+            raise IntegrityError(f"messageID {row['messageID']} does not exist")
+        if row["userMessageID"] in self.messages:
+            raise IntegrityError(f"userMessageID {row['userMessageID']} already exists")
+        self.messages[row["userMessageID"]] = row
+        self._index(row)
+        participant = self.participants[row["messageID"]].setdefault(row["userID"], {"messageCount": 0, "lastReadDT": None})
+        participant["messageCount"] += 1
+        return row
+
+    def update_message(self, userMessageID: int, messageContents: str, creationDT: datetime) -> dict:
+        row = self.messages[userMessageID]
+        self._unindex(row)
+        row["messageContents"] = messageContents
+        row["creationDT"] = creationDT
+        self._index(row)
+        return row
+
+    def delete_message(self, userMessageID: int) -> dict:
+        row = self.messages.pop(userMessageID, None)
+        if row is not None:
+            self._unindex(row)
+            self.participants[row["messageID"]][row["userID"]]["messageCount"] -= 1
+        return row
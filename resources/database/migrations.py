@@ -0,0 +1,261 @@
+#
+# Versioned schema migrations. Run them once per deploy, out of band, instead of issuing DDL
+# every time a worker starts:
+#
+#   python -m resources.database.migrations --host localhost
+#
+# Each migration is applied at most once and recorded in "schemaMigrations". Append new
+# migrations to MIGRATIONS; never edit one that has already shipped.
+#
+import argparse
+import re
+
+from resources.database.database_data_service import DatabaseDataService
+
+
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "create message tables",
+        "statements": [
+            """CREATE TABLE IF NOT EXISTS "messageUsers" (
+            "userID" serial,
+            "firstName" text,
+            "lastName" text,
+            "isAdmin" boolean,
+            PRIMARY KEY ("userID")
+            );""",
+            """CREATE TABLE IF NOT EXISTS "messageThread" (
+            "messageID" serial,
+            "creationDT" timestamp,
+            PRIMARY KEY ("messageID")
+            );""",
+            """CREATE TABLE IF NOT EXISTS "userMessages" (
+            "userMessageID" serial,
+            "userID" int,
+            "messageID" int,
+            "messageContents" text,
+            "creationDT" timestamp,
+            PRIMARY KEY ("userMessageID"),
+            CONSTRAINT "FK_userMessages.messageID"
+                FOREIGN KEY ("messageID")
+                REFERENCES "messageThread"("messageID"),
+            CONSTRAINT "FK_userMessages.userID"
+                FOREIGN KEY ("userID")
+                REFERENCES "messageUsers"("userID")
+            );""",
+        ],
+    },
+    {
+        "version": 2,
+        "name": "index message lookups",
+        # CONCURRENTLY keeps the table writable while the indexes build, but cannot run inside a
+        # transaction.
+        "transaction": False,
+        "statements": [
+            """CREATE INDEX CONCURRENTLY IF NOT EXISTS "userMessages_userID_creationDT_idx" ON "userMessages" ("userID", "creationDT");""",
+            """CREATE INDEX CONCURRENTLY IF NOT EXISTS "userMessages_messageID_creationDT_idx" ON "userMessages" ("messageID", "creationDT");""",
+            """CREATE INDEX CONCURRENTLY IF NOT EXISTS "userMessages_creationDT_userMessageID_idx" ON "userMessages" ("creationDT", "userMessageID");""",
+            """CREATE EXTENSION IF NOT EXISTS pg_trgm;""",
+            """CREATE INDEX CONCURRENTLY IF NOT EXISTS "userMessages_messageContents_trgm_idx" ON "userMessages" USING gin ("messageContents" gin_trgm_ops);""",
+        ],
+    },
+    {
+        "version": 3,
+        "name": "full-text search on message contents",
+        "transaction": False,
+        "statements": [
+            """ALTER TABLE "userMessages" ADD COLUMN IF NOT EXISTS "messageSearch" tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce("messageContents", ''))) STORED;""",
+            """CREATE INDEX CONCURRENTLY IF NOT EXISTS "userMessages_messageSearch_idx" ON "userMessages" USING gin ("messageSearch");""",
+        ],
+    },
+    {
+        "version": 4,
+        "name": "thread summaries and read markers",
+        "statements": [
+            """ALTER TABLE "messageThread"
+            ADD COLUMN IF NOT EXISTS "messageCount" int NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS "lastUserMessageID" int,
+            ADD COLUMN IF NOT EXISTS "lastMessageDT" timestamp;""",
+            """CREATE TABLE IF NOT EXISTS "threadParticipants" (
+            "messageID" int REFERENCES "messageThread"("messageID"),
+            "userID" int REFERENCES "messageUsers"("userID"),
+            "messageCount" int NOT NULL DEFAULT 0,
+            "lastReadDT" timestamp,
+            PRIMARY KEY ("messageID", "userID")
+            );""",
+            """CREATE INDEX IF NOT EXISTS "threadParticipants_userID_idx" ON "threadParticipants" ("userID");""",
+            # Keeps the summary columns and participant counts current on every write, including
+            # bulk inserts, so the inbox never has to aggregate "userMessages".
+            """CREATE OR REPLACE FUNCTION "userMessages_thread_summary"() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE "messageThread" SET "messageCount" = "messageCount" + 1 WHERE "messageID" = NEW."messageID";
+                    INSERT INTO "threadParticipants" ("messageID", "userID", "messageCount") VALUES (NEW."messageID", NEW."userID", 1)
+                        ON CONFLICT ("messageID", "userID") DO UPDATE SET "messageCount" = "threadParticipants"."messageCount" + 1;
+                ELSIF TG_OP = 'DELETE' THEN
+                    UPDATE "messageThread" SET "messageCount" = "messageCount" - 1 WHERE "messageID" = OLD."messageID";
+                    UPDATE "threadParticipants" SET "messageCount" = "messageCount" - 1 WHERE "messageID" = OLD."messageID" AND "userID" = OLD."userID";
+                    UPDATE "messageThread" SET ("lastUserMessageID", "lastMessageDT") = (
+                        SELECT "userMessageID", "creationDT" FROM "userMessages" WHERE "messageID" = OLD."messageID"
+                        ORDER BY "creationDT" DESC, "userMessageID" DESC LIMIT 1)
+                    WHERE "messageID" = OLD."messageID" AND "lastUserMessageID" = OLD."userMessageID";
+                    RETURN OLD;
+                END IF;
+                UPDATE "messageThread" SET "lastUserMessageID" = NEW."userMessageID", "lastMessageDT" = NEW."creationDT"
+                WHERE "messageID" = NEW."messageID"
+                    AND ("lastMessageDT" IS NULL OR ("lastMessageDT", "lastUserMessageID") <= (NEW."creationDT", NEW."userMessageID"));
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;""",
+            """DROP TRIGGER IF EXISTS "userMessages_thread_summary" ON "userMessages";""",
+            """CREATE TRIGGER "userMessages_thread_summary" AFTER INSERT OR UPDATE OR DELETE ON "userMessages"
+            FOR EACH ROW EXECUTE FUNCTION "userMessages_thread_summary"();""",
+            """UPDATE "messageThread" t SET "messageCount" = s."messageCount", "lastUserMessageID" = s."userMessageID", "lastMessageDT" = s."creationDT"
+            FROM (SELECT DISTINCT ON ("messageID") "messageID", "userMessageID", "creationDT", count(*) OVER (PARTITION BY "messageID") AS "messageCount"
+                FROM "userMessages" ORDER BY "messageID", "creationDT" DESC, "userMessageID" DESC) s
+            WHERE t."messageID" = s."messageID";""",
+            """INSERT INTO "threadParticipants" ("messageID", "userID", "messageCount")
+            SELECT "messageID", "userID", count(*) FROM "userMessages" GROUP BY "messageID", "userID"
+            ON CONFLICT ("messageID", "userID") DO UPDATE SET "messageCount" = EXCLUDED."messageCount";""",
+        ],
+    },
+    {
+        "version": 5,
+        "name": "partition userMessages by creationDT",
+        # The existing table becomes the first partition as it is, covering everything up to the end
+        # of the current month; monthly partitions after it are created by partitions.py. Postgres
+        # needs the partition key in the primary key, so it is now ("userMessageID", "creationDT").
+        "statements": [
+            """ALTER TABLE "userMessages" RENAME TO "userMessages_legacy";""",
+            """ALTER INDEX "userMessages_pkey" RENAME TO "userMessages_legacy_pkey";""",
+            """ALTER INDEX IF EXISTS "userMessages_userID_creationDT_idx" RENAME TO "userMessages_legacy_userID_creationDT_idx";""",
+            """ALTER INDEX IF EXISTS "userMessages_messageID_creationDT_idx" RENAME TO "userMessages_legacy_messageID_creationDT_idx";""",
+            """ALTER INDEX IF EXISTS "userMessages_creationDT_userMessageID_idx" RENAME TO "userMessages_legacy_creationDT_userMessageID_idx";""",
+            """ALTER INDEX IF EXISTS "userMessages_messageContents_trgm_idx" RENAME TO "userMessages_legacy_messageContents_trgm_idx";""",
+            """ALTER INDEX IF EXISTS "userMessages_messageSearch_idx" RENAME TO "userMessages_legacy_messageSearch_idx";""",
+            # Re-created on the partitioned table below, which clones it onto every partition.
+            """DROP TRIGGER IF EXISTS "userMessages_thread_summary" ON "userMessages_legacy";""",
+            """UPDATE "userMessages_legacy" SET "creationDT" = 'epoch' WHERE "creationDT" IS NULL;""",
+            """ALTER TABLE "userMessages_legacy" ALTER COLUMN "creationDT" SET NOT NULL;""",
+            """CREATE TABLE "userMessages" (
+            "userMessageID" int NOT NULL DEFAULT nextval('"userMessages_userMessageID_seq"'),
+            "userID" int,
+            "messageID" int,
+            "messageContents" text,
+            "creationDT" timestamp NOT NULL,
+            "messageSearch" tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce("messageContents", ''))) STORED,
+            PRIMARY KEY ("userMessageID", "creationDT"),
+            CONSTRAINT "FK_userMessages.messageID"
+                FOREIGN KEY ("messageID")
+                REFERENCES "messageThread"("messageID"),
+            CONSTRAINT "FK_userMessages.userID"
+                FOREIGN KEY ("userID")
+                REFERENCES "messageUsers"("userID")
+            ) PARTITION BY RANGE ("creationDT");""",
+            """ALTER SEQUENCE "userMessages_userMessageID_seq" OWNED BY "userMessages"."userMessageID";""",
+            """CREATE INDEX "userMessages_userID_creationDT_idx" ON "userMessages" ("userID", "creationDT");""",
+            """CREATE INDEX "userMessages_messageID_creationDT_idx" ON "userMessages" ("messageID", "creationDT");""",
+            """CREATE INDEX "userMessages_creationDT_userMessageID_idx" ON "userMessages" ("creationDT", "userMessageID");""",
+            """CREATE INDEX "userMessages_messageContents_trgm_idx" ON "userMessages" USING gin ("messageContents" gin_trgm_ops);""",
+            """CREATE INDEX "userMessages_messageSearch_idx" ON "userMessages" USING gin ("messageSearch");""",
+            """DO $$
+            DECLARE
+                bound timestamp := date_trunc('month', greatest((SELECT max("creationDT") FROM "userMessages_legacy"), LOCALTIMESTAMP)) + interval '1 month';
+            BEGIN
+                EXECUTE format('ALTER TABLE "userMessages" ATTACH PARTITION "userMessages_legacy" FOR VALUES FROM (MINVALUE) TO (%L)', bound);
+            END
+            $$;""",
+            # Catches rows for months partitions.py hasn't created (yet).
+            """CREATE TABLE "userMessages_default" PARTITION OF "userMessages" DEFAULT;""",
+            """CREATE TRIGGER "userMessages_thread_summary" AFTER INSERT OR UPDATE OR DELETE ON "userMessages"
+            FOR EACH ROW EXECUTE FUNCTION "userMessages_thread_summary"();""",
+        ],
+    },
+]
+
+# Arbitrary key for pg_advisory_lock so two runners never apply migrations at the same time.
+LOCK_ID = 7301
+
+# The index a CREATE INDEX CONCURRENTLY IF NOT EXISTS statement builds.
+_CONCURRENT_INDEX = re.compile(r'CREATE (?:UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS ("[^"]+")')
+
+
+class MigrationRunner():
+
+    def __init__(self, database: DatabaseDataService, migrations: list = None):
+        self.database = database
+        self.migrations = migrations if migrations is not None else MIGRATIONS
+
+    def applied_versions(self) -> set:
+        self.database.execute_query("""CREATE TABLE IF NOT EXISTS "schemaMigrations" (
+        "version" int PRIMARY KEY,
+        "name" text,
+        "appliedDT" timestamp DEFAULT CURRENT_TIMESTAMP
+        );""")
+        return {row["version"] for row in self.database.fetchallquery("""SELECT "version" FROM "schemaMigrations";""")}
+
+    def pending(self) -> list:
+        applied = self.applied_versions()
+        return [m for m in sorted(self.migrations, key=lambda m: m["version"]) if m["version"] not in applied]
+
+    def _drop_invalid_index(self, statement: str):
+        # A CONCURRENTLY build that failed (or was interrupted) leaves an INVALID index behind,
+        # which IF NOT EXISTS would then skip; drop it so the statement builds it again.
+        match = _CONCURRENT_INDEX.match(statement)
+        if match is None:
+            return
+        rows = self.database.fetchallquery("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (match.group(1),))
+        if rows and not rows[0]["indisvalid"]:
+            self.database.execute_query(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)};")
+
+    def _apply(self, migration: dict):
+        record = ("""INSERT INTO "schemaMigrations" ("version", "name") VALUES (%s, %s);""", (migration["version"], migration["name"]))
+        if migration.get("transaction", True):
+            with self.database.transaction() as cursor:
+                for statement in migration["statements"]:
+                    cursor.execute(statement)
+                cursor.execute(*record)
+        else:
+            for statement in migration["statements"]:
+                self._drop_invalid_index(statement)
+                self.database.execute_query(statement)
+            self.database.execute_query(*record)
+
+    def run(self) -> list:
+        """
+
+        Applies every pending migration in version order.
+
+        :return: The versions that were applied.
+        """
+        applied = []
+        with self.database.cursor() as lock:
+            lock.execute("SELECT pg_advisory_lock(%s);", (LOCK_ID,))
+            try:
+                for migration in self.pending():
+                    self._apply(migration)
+                    applied.append(migration["version"])
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s);", (LOCK_ID,))
+        return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations.")
+    parser.add_argument("--db", default="message")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="message")
+    parser.add_argument("--password", default="message")
+    args = parser.parse_args()
+
+    database = DatabaseDataService({
+        "db_name": args.db,
+        "db_host": args.host,
+        "db_user": args.user,
+        "db_pass": args.password,
+        "db_pool_max": 2,
+    })
+    versions = MigrationRunner(database).run()
+    print("Applied migrations: {}".format(versions or "none"))
+    database.close()
@@ -0,0 +1,340 @@
+#
+# Monthly partitions of "userMessages" (see migration 5) and their archival. Run it out of band,
+# e.g. daily from cron, like the migrations:
+#
+#   python -m resources.database.partitions --host localhost ensure --months-ahead 3
+#   python -m resources.database.partitions --host localhost archive --older-than 12 --directory archive
+#   python -m resources.database.partitions --host localhost restore userMessages_2025_01 --directory archive
+#
+# Archiving a month writes its rows to "<partition>.csv.gz" plus a "<partition>.json" manifest and
+# then drops the partition, so recent-message queries keep pruning down to a few small partitions
+# while the archive stays readable through MessageArchive (GET /api/messages/archive). Both files
+# are written under a ".tmp" name and renamed only once the drop has committed, so a failed
+# archive never leaves rows that are served both live and from the archive. Detaching
+# and attaching a partition fires no triggers, so archive and restore adjust the thread summaries
+# ("messageThread", "threadParticipants") themselves, in the same transaction: the counts and the
+# last message change, and with them the thread's ETag.
+#
+import argparse
+import csv
+import glob
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+from resources.database.database_data_service import DatabaseDataService
+from resources.messages.message_data_service import MESSAGE_CHANNEL
+
+
+PARENT = "userMessages"
+DEFAULT_PARTITION = "userMessages_default"
+# Everything but the generated "messageSearch", which is recomputed when a month is restored.
+COLUMNS = ("userMessageID", "userID", "messageID", "messageContents", "creationDT")
+
+# Arbitrary key for pg_advisory_lock so two jobs never reshape the partitions at the same time.
+LOCK_ID = 7303
+
+_BOUND = re.compile(r"FOR VALUES FROM \((.*)\) TO \((.*)\)")
+
+
+def _columns() -> str:
+    return ", ".join(f"\"{column}\"" for column in COLUMNS)
+
+
+def _parse_bound(value: str) -> datetime:
+    # MINVALUE / MAXVALUE -> None, otherwise a quoted timestamp literal.
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def month_start(dt: datetime, months: int = 0) -> datetime:
+    """
+
+    :return: Midnight on the first of dt's month, moved by months (which may be negative).
+    """
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"{PARENT}_{start.year:04d}_{start.month:02d}"
+
+
+def _notify_threads_query(table: str, op: str) -> str:
+    # One event per thread whose messages are (dis)appearing, so caches drop their copies.
+    return f"""SELECT pg_notify('{MESSAGE_CHANNEL}', json_build_object('op', '{op}', 'userMessageID', NULL, 'userID', NULL, 'messageID', \"messageID\")::text) FROM (SELECT DISTINCT \"messageID\" FROM \"{table}\") threads;"""
+
+
+def _summary_queries(table: str, sign: str) -> list:
+    # Adds (sign "+") or subtracts (sign "-") the table's messages to / from the thread summaries,
+    # as the "userMessages_thread_summary" trigger would have row by row.
+    return [
+        f"""UPDATE "messageThread" t SET "messageCount" = t."messageCount" {sign} m."messageCount"
+        FROM (SELECT "messageID", count(*) AS "messageCount" FROM "{table}" GROUP BY "messageID") m
+        WHERE t."messageID" = m."messageID";""",
+        f"""INSERT INTO "threadParticipants" ("messageID", "userID", "messageCount")
+        SELECT "messageID", "userID", {sign}count(*) FROM "{table}" GROUP BY "messageID", "userID"
+        ON CONFLICT ("messageID", "userID") DO UPDATE SET "messageCount" = "threadParticipants"."messageCount" + EXCLUDED."messageCount";""",
+    ]
+
+
+def _last_message_query(table: str) -> str:
+    # Run once the table is detached from / attached to "userMessages".
+    return f"""UPDATE "messageThread" t SET ("lastUserMessageID", "lastMessageDT") = (
+        SELECT "userMessageID", "creationDT" FROM "{PARENT}" u WHERE u."messageID" = t."messageID"
+        ORDER BY "creationDT" DESC, "userMessageID" DESC LIMIT 1)
+    WHERE t."messageID" IN (SELECT DISTINCT "messageID" FROM "{table}");"""
+
+
+def _fsync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PartitionManager():
+
+    def __init__(self, database: DatabaseDataService):
+        self.database = database
+
+    def partitions(self) -> list:
+        """
+
+        :return: [{"name", "from", "to"}] for every range partition, oldest first; None for an
+            unbounded side. The default partition is left out.
+        """
+        rows = self.database.fetchallquery(
+            """SELECT c.relname AS "name", pg_get_expr(c.relpartbound, c.oid) AS "bound"
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass;""", (f"\"{PARENT}\"",))
+        partitions = []
+        for row in rows:
+            match = _BOUND.fullmatch(row["bound"])
+            if match is None:
+                continue
+            partitions.append({"name": row["name"], "from": _parse_bound(match.group(1)), "to": _parse_bound(match.group(2))})
+        partitions.sort(key=lambda p: p["from"] or datetime.min)
+        return partitions
+
+    @staticmethod
+    def _overlaps(partitions: list, start: datetime, end: datetime) -> bool:
+        return any((p["from"] is None or p["from"] < end) and (p["to"] is None or start < p["to"]) for p in partitions)
+
+    def _create(self, cursor, name: str, start: datetime, end: datetime):
+        # Rows for this month that already landed in the default partition have to move out first,
+        # or creating the partition fails. Deleting them and inserting them again through the
+        # parent leaves the thread summaries as they were.
+        cursor.execute(f"""CREATE TEMP TABLE "userMessages_moving" ON COMMIT DROP AS SELECT {_columns()} FROM "{DEFAULT_PARTITION}" WITH NO DATA;""")
+        cursor.execute(f"""WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE "creationDT" >= %s AND "creationDT" < %s RETURNING {_columns()})
+            INSERT INTO "userMessages_moving" SELECT * FROM moved;""", (start, end))
+        cursor.execute(f"""CREATE TABLE "{name}" PARTITION OF "{PARENT}" FOR VALUES FROM (%s) TO (%s);""", (start, end))
+        cursor.execute(f"""INSERT INTO "{PARENT}" ({_columns()}) SELECT {_columns()} FROM "userMessages_moving";""")
+
+    def ensure_partitions(self, months_ahead: int = 3, now: datetime = None) -> list:
+        """
+
+        Creates the monthly partitions from the current month through months_ahead months from now,
+        skipping months an existing partition already covers.
+
+        :return: The names of the partitions created.
+        """
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        created = []
+        with self.database.cursor() as lock:
+            lock.execute("SELECT pg_advisory_lock(%s);", (LOCK_ID,))
+            try:
+                partitions = self.partitions()
+                for months in range(months_ahead + 1):
+                    start, end = month_start(now, months), month_start(now, months + 1)
+                    if self._overlaps(partitions, start, end):
+                        continue
+                    name = partition_name(start)
+                    with self.database.transaction() as cursor:
+                        self._create(cursor, name, start, end)
+                    partitions.append({"name": name, "from": start, "to": end})
+                    created.append(name)
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s);", (LOCK_ID,))
+        return created
+
+    def _export(self, cursor, partition: dict, directory: str) -> int:
+        name = partition["name"]
+        path = os.path.join(directory, f"{name}.csv.gz")
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8", newline="") as f:
+            cursor.copy_expert(f"""COPY (SELECT {_columns()} FROM "{name}" ORDER BY "creationDT", "userMessageID") TO STDOUT WITH (FORMAT csv, HEADER)""", f)
+        with open(path + ".tmp", "rb") as f:
+            os.fsync(f.fileno())
+
+        # Read the file back: the gzip CRC and the row count must both check out before the
+        # partition is dropped.
+        with gzip.open(path + ".tmp", "rt", encoding="utf-8", newline="") as f:
+            rows = sum(1 for _ in csv.reader(f)) - 1
+        cursor.execute(f"""SELECT count(*) FROM "{name}";""")
+        expected = cursor.fetchone()[0]
+        if rows != expected:
+            raise RuntimeError(f"Archive of {name} has {rows} rows, the partition {expected}")
+
+        manifest = {
+            "partition": name,
+            "from": partition["from"].isoformat() if partition["from"] else None,
+            "to": partition["to"].isoformat() if partition["to"] else None,
+            "rows": rows,
+            "file": os.path.basename(path),
+            "archivedDT": datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+        }
+        with open(os.path.join(directory, f"{name}.json.tmp"), "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return rows
+
+    @staticmethod
+    def _publish(directory: str, name: str):
+        # The manifest last: MessageArchive only reads months that have one.
+        for suffix in (".csv.gz", ".json"):
+            os.replace(os.path.join(directory, name + suffix + ".tmp"), os.path.join(directory, name + suffix))
+        _fsync_directory(directory)
+
+    @staticmethod
+    def _discard(directory: str, name: str):
+        for suffix in (".csv.gz", ".json"):
+            try:
+                os.unlink(os.path.join(directory, name + suffix + ".tmp"))
+            except FileNotFoundError:
+                pass
+
+    def _recover(self, directory: str, partitions: list):
+        # A run that died between the commit and the renames left a complete export of a partition
+        # that is gone, which is published now; one for a partition that still exists is stale.
+        live = {p["name"] for p in partitions}
+        for path in glob.glob(os.path.join(directory, "*.json.tmp")):
+            name = os.path.basename(path)[:-len(".json.tmp")]
+            if name in live:
+                self._discard(directory, name)
+            else:
+                self._publish(directory, name)
+
+    def archive(self, directory: str, older_than_months: int = 12, now: datetime = None) -> list:
+        """
+
+        Exports every partition that ends at least older_than_months before the current month to
+        directory and drops it, taking its messages out of the thread summaries. Each partition is
+        handled in its own transaction, which holds a SHARE lock on it from the export to the drop,
+        so no write can slip in between.
+
+        :return: [{"partition", "rows"}] for each partition archived.
+        """
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        cutoff = month_start(now, -older_than_months)
+        os.makedirs(directory, exist_ok=True)
+        archived = []
+        with self.database.cursor() as lock:
+            lock.execute("SELECT pg_advisory_lock(%s);", (LOCK_ID,))
+            try:
+                partitions = self.partitions()
+                self._recover(directory, partitions)
+                for partition in partitions:
+                    if partition["to"] is None or partition["to"] > cutoff:
+                        continue
+                    name = partition["name"]
+                    try:
+                        with self.database.transaction() as cursor:
+                            cursor.execute(f"""LOCK TABLE "{name}" IN SHARE MODE;""")
+                            rows = self._export(cursor, partition, directory)
+                            # Delivered on commit, together with the drop.
+                            cursor.execute(_notify_threads_query(name, "archived"))
+                            for query in _summary_queries(name, "-"):
+                                cursor.execute(query)
+                            cursor.execute(f"""ALTER TABLE "{PARENT}" DETACH PARTITION "{name}";""")
+                            cursor.execute(_last_message_query(name))
+                            cursor.execute(f"""DROP TABLE "{name}";""")
+                    except Exception:
+                        # Rolled back: the rows are still in the partition.
+                        self._discard(directory, name)
+                        raise
+                    self._publish(directory, name)
+                    archived.append({"partition": name, "rows": rows})
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s);", (LOCK_ID,))
+        return archived
+
+    def restore(self, directory: str, name: str) -> int:
+        """
+
+        Loads an archived partition back into "userMessages", counts its messages in the thread
+        summaries again and removes it from the archive. Fails if the month overlaps a partition created since, or if rows for it have landed in
+        the default partition meanwhile.
+
+        :return: The number of rows restored.
+        """
+        with open(os.path.join(directory, f"{name}.json")) as f:
+            manifest = json.load(f)
+        start = datetime.fromisoformat(manifest["from"]) if manifest["from"] else None
+        end = datetime.fromisoformat(manifest["to"]) if manifest["to"] else None
+
+        with self.database.cursor() as lock:
+            lock.execute("SELECT pg_advisory_lock(%s);", (LOCK_ID,))
+            try:
+                with self.database.transaction() as cursor:
+                    cursor.execute(f"""CREATE TABLE "{name}" (LIKE "{PARENT}" INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS);""")
+                    with gzip.open(os.path.join(directory, manifest["file"]), "rt", encoding="utf-8", newline="") as f:
+                        cursor.copy_expert(f"""COPY "{name}" ({_columns()}) FROM STDIN WITH (FORMAT csv, HEADER)""", f)
+                    cursor.execute(f"""SELECT count(*) FROM "{name}";""")
+                    rows = cursor.fetchone()[0]
+                    if rows != manifest["rows"]:
+                        raise RuntimeError(f"Archive of {name} has {rows} rows, its manifest {manifest['rows']}")
+                    # Builds the parent's indexes on the table and checks every row against the bounds.
+                    lower = "%s" if start else "MINVALUE"
+                    upper = "%s" if end else "MAXVALUE"
+                    cursor.execute(f"""ALTER TABLE "{PARENT}" ATTACH PARTITION "{name}" FOR VALUES FROM ({lower}) TO ({upper});""",
+                                   tuple(bound for bound in (start, end) if bound))
+                    for query in _summary_queries(name, "+"):
+                        cursor.execute(query)
+                    cursor.execute(_last_message_query(name))
+                    cursor.execute(_notify_threads_query(name, "restored"))
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s);", (LOCK_ID,))
+
+        os.unlink(os.path.join(directory, manifest["file"]))
+        os.unlink(os.path.join(directory, f"{name}.json"))
+        return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create, archive and restore monthly userMessages partitions.")
+    parser.add_argument("--db", default="message")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="message")
+    parser.add_argument("--password", default="message")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ensure = commands.add_parser("ensure", help="create the partitions for the coming months")
+    ensure.add_argument("--months-ahead", type=int, default=3)
+    archive = commands.add_parser("archive", help="export old partitions to compressed files and drop them")
+    archive.add_argument("--older-than", type=int, default=12, help="months")
+    archive.add_argument("--directory", default="archive")
+    restore = commands.add_parser("restore", help="load an archived partition back")
+    restore.add_argument("partition")
+    restore.add_argument("--directory", default="archive")
+    args = parser.parse_args()
+
+    database = DatabaseDataService({
+        "db_name": args.db,
+        "db_host": args.host,
+        "db_user": args.user,
+        "db_pass": args.password,
+        "db_pool_max": 2,
+    })
+    manager = PartitionManager(database)
+    if args.command == "ensure":
+        print("Created partitions: {}".format(manager.ensure_partitions(args.months_ahead) or "none"))
+    elif args.command == "archive":
+        archived = manager.archive(args.directory, args.older_than)
+        print("Archived partitions: {}".format(", ".join("{partition} ({rows} rows)".format(**a) for a in archived) or "none"))
+    else:
+        print("Restored {} rows".format(manager.restore(args.directory, args.partition)))
+    database.close()
@@ -0,0 +1,46 @@
+#
+# Canonical SQL for the dynamic filter builders (get_users, get_messages). The statement text
+# depends only on which filters are present, the filter-set "shape", never on their values, and
+# each shape is rendered once. One text per shape is what lets AsyncDatabaseDataService keep the
+# statement prepared on each pooled connection, so Postgres parses and plans it once per
+# connection instead of once per request.
+#
+from functools import lru_cache
+
+
+def where(*filters) -> tuple:
+    """
+
+    :param filters: (condition, value) pairs in a fixed order, e.g. ('"userID" = %s', userID).
+        Pairs whose value is None are left out.
+    :return: (conditions, values), with conditions as a tuple so it can key select_statement.
+    """
+    conditions = tuple(condition for condition, value in filters if value is not None)
+    values = [value for condition, value in filters if value is not None]
+
+    return conditions, values
+
+
+@lru_cache(maxsize=512)
+def select_statement(table: str, columns: str, conditions: tuple = (), order_by: str = None, limit: bool = False, offset: bool = False) -> str:
+    """
+
+    :param table: Table to select from (unquoted).
+    :param columns: Select list.
+    :param conditions: WHERE conditions, joined with AND.
+    :param order_by: ORDER BY list, if any.
+    :param limit: Whether a LIMIT %s parameter follows the filter values.
+    :param offset: Whether an OFFSET %s parameter follows (after LIMIT's).
+    :return: The statement for this shape; the same object on every call.
+    """
+    query = f"""SELECT {columns} FROM \"{table}\""""
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if order_by:
+        query += f" ORDER BY {order_by}"
+    if limit:
+        query += " LIMIT %s"
+    if offset:
+        query += " OFFSET %s"
+
+    return query + ";"
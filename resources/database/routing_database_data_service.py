@@ -0,0 +1,291 @@
+#
+# Read/write splitting over a primary and any number of streaming replicas, with the same interface
+# as AsyncDatabaseDataService. Reads (fetchallquery, fetchcolumnsquery, fetchmanyquery,
+# streamquery) go to the healthy replica with the fewest queries in flight; writes, transactions,
+# LISTEN sessions and readiness checks go to the primary. After a user's own write, that user's
+# reads stay on the primary for a short window so replication lag can't hide the write from them.
+# The window travels with the client in a cookie set by StickyReadsMiddleware, so it holds on
+# whichever worker or instance serves the next request.
+#
+import asyncio
+import functools
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import psycopg
+from psycopg_pool import PoolTimeout
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+
+from resources.database.async_database_data_service import AsyncDatabaseDataService
+
+
+# userID the current read is made for; see reads_as_user.
+reader = ContextVar("reader", default=None)
+_primary_only = ContextVar("primary_only", default=False)
+# {"until": time.time() until which this client's reads go to the primary, "wrote": bool} for the
+# current request; see StickyReadsMiddleware.
+_session = ContextVar("sticky_session", default=None)
+
+STICKY_COOKIE = "db-primary-until"
+
+
+@contextmanager
+def primary_reads():
+    """
+
+    Reads inside the block go to the primary, e.g. to load a row right after its NOTIFY.
+    """
+    token = _primary_only.set(True)
+    try:
+        yield
+    finally:
+        _primary_only.reset(token)
+
+
+def reads_as_user(func):
+    """
+
+    Decorator for async data-service reads whose first argument is the userID they are made for.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, userID, *args, **kwargs):
+        token = reader.set(userID)
+        try:
+            return await func(self, userID, *args, **kwargs)
+        finally:
+            reader.reset(token)
+    return wrapper
+
+
+def writes_as_user(func):
+    """
+
+    Decorator for async data-service writes whose first argument is a request (or list of
+    requests) with a userID, or the userID itself. Once the write is done, reads by those users
+    stick to the primary.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, request, *args, **kwargs):
+        result = await func(self, request, *args, **kwargs)
+        note_write = getattr(self.database, "note_write", None)
+        if note_write is not None:
+            for r in (request if isinstance(request, list) else [request]):
+                userID = getattr(r, "userID", r)
+                if userID is not None:
+                    note_write(userID)
+        return result
+    return wrapper
+
+
+class StickyReadsMiddleware():
+    """
+
+    ASGI middleware that carries read-your-writes across workers and instances. A request that
+    writes through RoutingDatabaseDataService gets a cookie with the wall-clock time until which
+    its client's reads must see the primary; requests bringing that cookie back read from the
+    primary until then, wherever they land.
+    """
+
+    def __init__(self, app, sticky_seconds: float = 5):
+        """
+
+        :param sticky_seconds: The database's db_replica_sticky_seconds. Cookies claiming a later
+            time than that from now are clamped, so a client can't pin itself to the primary.
+        """
+        self.app = app
+        self.sticky_seconds = sticky_seconds
+
+    def _until(self, scope) -> float:
+        try:
+            until = float(HTTPConnection(scope).cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            return 0
+        return min(until, time.time() + self.sticky_seconds)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        session = {"until": self._until(scope), "wrote": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and session["wrote"]:
+                max_age = max(1, int(session["until"] - time.time() + 1))
+                MutableHeaders(scope=message).append(
+                    "set-cookie", "{}={:.3f}; Max-Age={}; Path=/; HttpOnly; SameSite=Lax".format(STICKY_COOKIE, session["until"], max_age))
+            await send(message)
+
+        token = _session.set(session)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _session.reset(token)
+
+
+class _Replica():
+
+    def __init__(self, database: AsyncDatabaseDataService):
+        self.database = database
+        self.healthy = True
+        self.in_flight = 0
+
+
+class RoutingDatabaseDataService():
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary of configuration parameters for the primary, as for
+            AsyncDatabaseDataService, plus db_replica_dsns (connection strings of the replicas,
+            which otherwise share the primary's pool settings), db_replica_pool_max (pool size per
+            replica, default db_pool_max), db_replica_sticky_seconds (how long
+            a user's reads stay on the primary after their write, default 5) and
+            db_replica_check_interval (seconds between replica health checks, default 5).
+        """
+        self.primary = AsyncDatabaseDataService(config)
+        replica_config = {**config, "db_pool_max": config.get("db_replica_pool_max", config.get("db_pool_max", 10))}
+        self.replicas = [_Replica(AsyncDatabaseDataService({**replica_config, "db_dsn": dsn})) for dsn in config.get("db_replica_dsns", [])]
+        self.sticky_seconds = config.get("db_replica_sticky_seconds", 5)
+        self.check_interval = config.get("db_replica_check_interval", 5)
+        self.conninfo = self.primary.conninfo
+
+        # userID -> time.monotonic() until which that user's reads go to the primary
+        self._written = {}
+        self._rotation = itertools.count()
+        self._task = None
+        self._metrics = {
+            "replica_reads": 0,
+            "primary_reads": 0,
+            "sticky_reads": 0,
+            "replica_failovers": 0,
+        }
+
+    async def open(self):
+        await self.primary.open()
+        for replica in self.replicas:
+            await replica.database.open()
+        if self._task is None:
+            self._task = asyncio.create_task(self._check())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self.replicas:
+            await replica.database.close()
+        await self.primary.close()
+
+    async def _check(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for replica in self.replicas:
+                replica.healthy = await replica.database.ping(self.check_interval)
+            now = time.monotonic()
+            self._written = {userID: until for userID, until in self._written.items() if until > now}
+
+    def note_write(self, userID: int):
+        self._written[userID] = time.monotonic() + self.sticky_seconds
+        # The local map only covers this worker; the cookie covers the client everywhere.
+        session = _session.get()
+        if session is not None:
+            session["until"] = max(session["until"], time.time() + self.sticky_seconds)
+            session["wrote"] = True
+
+    def _choose(self):
+        # None means the primary.
+        if _primary_only.get():
+            return None
+        userID = reader.get()
+        session = _session.get()
+        if (userID is not None and self._written.get(userID, 0) > time.monotonic()) or \
+                (session is not None and session["until"] > time.time()):
+            self._metrics["sticky_reads"] += 1
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        # Start at a rotating offset so that ties are broken round-robin.
+        start = next(self._rotation)
+        candidates = [healthy[(start + i) % len(healthy)] for i in range(len(healthy))]
+        return min(candidates, key=lambda replica: replica.in_flight)
+
+    async def _read(self, method: str, *args):
+        replica = self._choose()
+        if replica is None:
+            self._metrics["primary_reads"] += 1
+            return await getattr(self.primary, method)(*args)
+
+        replica.in_flight += 1
+        try:
+            result = await getattr(replica.database, method)(*args)
+            self._metrics["replica_reads"] += 1
+            return result
+        except (psycopg.OperationalError, PoolTimeout):
+            # Out of rotation until the next health check; answer this read from the primary.
+            replica.healthy = False
+            self._metrics["replica_failovers"] += 1
+            return await getattr(self.primary, method)(*args)
+        finally:
+            replica.in_flight -= 1
+
+    async def fetchallquery(self, query: str = None, params: () = None):
+        return await self._read("fetchallquery", query, params)
+
+    async def fetchcolumnsquery(self, query: str = None, params: () = None):
+        return await self._read("fetchcolumnsquery", query, params)
+
+    async def fetchmanyquery(self, query: str = None, size: int = 1, params: () = None):
+        return await self._read("fetchmanyquery", query, size, params)
+
+    async def streamquery(self, query: str = None, params: () = None, size: int = 1000):
+        # No failover once rows have been sent.
+        replica = self._choose()
+        database = self.primary if replica is None else replica.database
+        if replica is not None:
+            replica.in_flight += 1
+        try:
+            async for batch in database.streamquery(query, params, size):
+                yield batch
+        finally:
+            if replica is not None:
+                replica.in_flight -= 1
+
+    async def execute_query(self, query: str = None, params: () = None):
+        return await self.primary.execute_query(query, params)
+
+    async def fetchonequery(self, query: str = None, params: () = None):
+        return await self.primary.fetchonequery(query, params)
+
+    def cursor(self):
+        return self.primary.cursor()
+
+    def transaction(self):
+        return self.primary.transaction()
+
+    async def connect(self):
+        return await self.primary.connect()
+
+    async def listen(self, channel: str, reconnect_delay: float = 1):
+        async for payload in self.primary.listen(channel, reconnect_delay):
+            yield payload
+
+    async def ping(self, timeout: float = 2) -> bool:
+        return await self.primary.ping(timeout)
+
+    def get_metrics(self) -> dict:
+        metrics = self.primary.get_metrics()
+        metrics.update(self._metrics)
+        metrics["sticky_users"] = len(self._written)
+        metrics["replicas"] = {
+            str(i): {**replica.database.get_metrics(), "healthy": int(replica.healthy), "in_flight": replica.in_flight}
+            for i, replica in enumerate(self.replicas)
+        }
+        return metrics
@@ -0,0 +1,115 @@
+#
+# Read access to the months archived by resources/database/partitions.py: one gzipped CSV per
+# former partition of "userMessages", described by a JSON manifest next to it. Archived messages
+# are read on demand by scanning the files whose month overlaps the requested range, so nothing
+# about them is kept in memory or in the database.
+#
+import asyncio
+import csv
+import functools
+import glob
+import gzip
+import json
+import os
+from datetime import datetime
+
+from resources.messages.message_data_service import MemoryMessageDataService, _message_columns, _naive
+
+
+def _int(value: str) -> int:
+    # COPY writes NULL as an empty field.
+    return int(value) if value else None
+
+
+def _close(batches, future: asyncio.Future = None):
+    if future is not None and not future.cancelled():
+        # Nobody is left to see an error from the last read.
+        future.exception()
+    batches.close()
+
+
+class MessageArchive():
+
+    def __init__(self, directory: str):
+        """
+
+        :param directory: Where partitions.py archives to; it may not exist yet.
+        """
+        self.directory = directory
+
+    def manifests(self) -> list:
+        """
+
+        :return: The manifests of the archived months, oldest first, with "from" / "to" as
+            datetimes (None when unbounded).
+        """
+        manifests = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            with open(path) as f:
+                manifest = json.load(f)
+            for bound in ("from", "to"):
+                manifest[bound] = datetime.fromisoformat(manifest[bound]) if manifest[bound] else None
+            manifests.append(manifest)
+        manifests.sort(key=lambda m: m["from"] or datetime.min)
+        return manifests
+
+    def get_stats(self) -> dict:
+        manifests = self.manifests()
+        return {"partitions": len(manifests), "rows": sum(m["rows"] for m in manifests)}
+
+    def _read(self, manifest: dict, userID: int, messageThreadID: int, messageID: int, since: datetime, before: datetime, batch_size: int, timestamps: str):
+        batch = []
+        with gzip.open(os.path.join(self.directory, manifest["file"]), "rt", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for userMessageID, user, thread, contents, created in reader:
+                row = {
+                    "userMessageID": int(userMessageID),
+                    "userID": _int(user),
+                    "messageID": _int(thread),
+                    "messageContents": contents,
+                    "creationDT": datetime.fromisoformat(created),
+                }
+                if ((userID is not None and row["userID"] != userID)
+                        or (messageThreadID is not None and row["messageID"] != messageThreadID)
+                        or (messageID is not None and row["userMessageID"] != messageID)
+                        or (since is not None and row["creationDT"] < since)
+                        or (before is not None and row["creationDT"] >= before)):
+                    continue
+                batch.append(MemoryMessageDataService._format(row, timestamps))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    async def stream_messages(self, userID: int, messageThreadID: int, messageID: int, batch_size: int = 1000, since: datetime = None, before: datetime = None, timestamps: str = "legacy"):
+        """
+
+        Yields the archived messages matching the filters in batches of at most batch_size rows,
+        oldest first. Only the files for months overlapping [since, before) are opened, and they
+        are read in a worker thread so the event loop isn't blocked on decompression.
+        """
+        _message_columns(timestamps)
+        since, before = _naive(since), _naive(before)
+        for manifest in await asyncio.to_thread(self.manifests):
+            if (since is not None and manifest["to"] is not None and manifest["to"] <= since) or \
+                    (before is not None and manifest["from"] is not None and manifest["from"] >= before):
+                continue
+            batches = self._read(manifest, userID, messageThreadID, messageID, since, before, batch_size, timestamps)
+            pending = None
+            try:
+                while True:
+                    # Shielded: cancelling the stream doesn't stop the thread, which is still
+                    # inside the generator until next() returns.
+                    pending = asyncio.ensure_future(asyncio.to_thread(next, batches, None))
+                    batch = await asyncio.shield(pending)
+                    if batch is None:
+                        break
+                    yield batch
+            finally:
+                if pending is None or pending.done():
+                    _close(batches)
+                else:
+                    # Closing a generator that is executing raises; close it once the read returns.
+                    pending.add_done_callback(functools.partial(_close, batches))
@@ -0,0 +1,109 @@
+#
+# Serialized responses for thread reads, kept per worker. Entries are the JSON bodies themselves,
+# keyed by thread and by the rest of the request (route, userID, window, timestamps, ...), in an
+# LRU bounded by their total size. Every add, put or delete in a thread drops that thread's
+# entries: the worker that wrote invalidates right away, every other worker when the NOTIFY on
+# MESSAGE_CHANNEL reaches its MessageEventBroker.
+#
+from collections import OrderedDict
+
+
+# Threads whose invalidation count is remembered; past this the counts start over (see clear()).
+MAX_TRACKED_THREADS = 100000
+
+
+class MessageResponseCache():
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: int = None):
+        """
+
+        :param max_bytes: Bound on the total size of the cached bodies; the least recently used are
+            evicted first.
+        :param max_entry_bytes: Bodies larger than this are not cached (default max_bytes / 16), so
+            one huge thread can't flush everything else.
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 16
+
+        # (messageThreadID, key) -> body
+        self._entries = OrderedDict()
+        # messageThreadID -> keys cached for it
+        self._threads = {}
+        self._bytes = 0
+        # A fill is only stored if its thread wasn't invalidated while it was being read.
+        self._epoch = 0
+        self._generations = {}
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "stale_fills": 0}
+
+    def get_stats(self) -> dict:
+        return {**self._stats, "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+    def generation(self, messageThreadID: int) -> tuple:
+        """
+
+        Take this before reading a thread and pass it to set() with the result.
+        """
+        return self._epoch, self._generations.get(messageThreadID, 0)
+
+    def get(self, messageThreadID: int, key: tuple) -> bytes:
+        body = self._entries.get((messageThreadID, key))
+        if body is None:
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end((messageThreadID, key))
+        self._stats["hits"] += 1
+        return body
+
+    def set(self, messageThreadID: int, key: tuple, body: bytes, generation: tuple):
+        if generation != self.generation(messageThreadID):
+            self._stats["stale_fills"] += 1
+            return
+        if len(body) > self.max_entry_bytes:
+            return
+
+        self._remove(messageThreadID, key)
+        self._entries[(messageThreadID, key)] = body
+        self._threads.setdefault(messageThreadID, set()).add(key)
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            (threadID, oldest), _ = next(iter(self._entries.items()))
+            self._remove(threadID, oldest)
+            self._stats["evictions"] += 1
+
+    def _remove(self, messageThreadID: int, key: tuple):
+        body = self._entries.pop((messageThreadID, key), None)
+        if body is None:
+            return
+        self._bytes -= len(body)
+        keys = self._threads[messageThreadID]
+        keys.discard(key)
+        if not keys:
+            del self._threads[messageThreadID]
+
+    def invalidate(self, messageThreadID: int):
+        for key in list(self._threads.get(messageThreadID, ())):
+            self._remove(messageThreadID, key)
+        if messageThreadID not in self._generations and len(self._generations) >= MAX_TRACKED_THREADS:
+            self._generations.clear()
+            self._epoch += 1
+        self._generations[messageThreadID] = self._generations.get(messageThreadID, 0) + 1
+        self._stats["invalidations"] += 1
+
+    def clear(self):
+        # A new epoch also turns away every fill that is still being read.
+        self._entries.clear()
+        self._threads.clear()
+        self._bytes = 0
+        self._generations.clear()
+        self._epoch += 1
+
+    def on_event(self, event: dict):
+        """
+
+        MessageEventBroker watcher: drops the changed thread, or everything if events were missed.
+        User events carry no thread and are ignored.
+        """
+        if event is None:
+            self.clear()
+        elif event["messageID"] is not None:
+            self.invalidate(event["messageID"])
@@ -1,122 +1,693 @@
 from resources.abstract_base_data_service import BaseDataService
-from resources.database.database_data_service import DatabaseDataService
+from resources.database.async_database_data_service import AsyncDatabaseDataService
+from resources.database.memory_database_data_service import MemoryDatabaseDataService, IntegrityError, now
+from resources.database.routing_database_data_service import reads_as_user, writes_as_user
+from resources.metrics import instrumented
+from resources.database.query_builder import where, select_statement
+from resources.pagination import encode_cursor, decode_cursor
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+import functools
+import heapq
 import json
+import re
+
+
+# "userMessages" also has a generated "messageSearch" tsvector, so reads name their columns.
+MESSAGE_COLUMNS = """\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\""""
+# Keyset of message pages: ("creationDT", "userMessageID").
+MESSAGE_CURSOR = (datetime, int)
+
+# How creationDT comes back: "legacy" is the original "MM/DD/YYYY, HH:MM:SS" string, "iso" leaves
+# the datetime for the JSON serializer to write as ISO-8601 and "epoch" is milliseconds since
+# 1970-01-01. Postgres renders legacy and epoch into "creationFormatted" so no row is formatted in
+# Python; the raw creationDT is still selected because keyset cursors are built from it.
+TIMESTAMP_FORMATS = ("legacy", "iso", "epoch")
+TIMESTAMP_COLUMNS = {
+    "legacy": """to_char(\"creationDT\", 'MM/DD/YYYY, HH24:MI:SS')""",
+    "epoch": """(extract(epoch FROM \"creationDT\") * 1000)::bigint""",
+}
+
+
+def _message_columns(timestamps: str = None) -> str:
+    if timestamps not in (None, *TIMESTAMP_FORMATS):
+        raise ValueError(f"Unknown timestamp format {timestamps!r}")
+    if timestamps in TIMESTAMP_COLUMNS:
+        return f"""{MESSAGE_COLUMNS}, {TIMESTAMP_COLUMNS[timestamps]} AS \"creationFormatted\""""
+    return MESSAGE_COLUMNS
+
+
+# Postgres NOTIFY channel that add/put/delete announce changes on; see message_events.py.
+MESSAGE_CHANNEL = "message_events"
+
+
+def _notify_changed(op: str, output: str = """\"messageID\"""") -> str:
+    # Final SELECT over a "changed" CTE of ("userMessageID", "userID", "messageID", ...) rows.
+    return f"""SELECT changed.{output} FROM changed CROSS JOIN LATERAL (SELECT pg_notify('{MESSAGE_CHANNEL}', json_build_object('op', {op}, 'userMessageID', changed.\"userMessageID\", 'userID', changed.\"userID\", 'messageID', changed.\"messageID\")::text)) notified"""
+
+
+def _with_notify(statement: str, op: str, output: str = """\"messageID\"""", returning: str = "") -> str:
+    """
+
+    Wraps an INSERT/UPDATE/DELETE on "userMessages" so that every affected row is announced with
+    pg_notify in the same statement (and transaction) as the write.
+
+    :param op: SQL expression for the event type ('added', 'updated' or 'deleted').
+    :param output: Column of the affected rows to return.
+    :param returning: Extra RETURNING expressions that op may refer to.
+    """
+    return f"""WITH changed AS ({statement} RETURNING \"userMessageID\", \"userID\", \"messageID\"{returning}) {_notify_changed(op, output)}"""
+
+
+# First key of the advisory locks put_message takes per userMessageID.
+MESSAGE_LOCK_CLASS = 7302
 
 
 class MessageDataService(BaseDataService):
+    """
+
+    Queries and result shaping shared by the Postgres data services; AsyncMessageDataService runs
+    them. Nothing here talks to a database.
+    """
+
+    def _get_messages_query(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str = None, since: datetime = None, before: datetime = None, timestamps: str = None) -> tuple:
+        conditions, values = where(
+            ("""\"userID\" = %s""", userID),
+            ("""\"messageID\" = %s""", messageThreadID),
+            ("""\"userMessageID\" = %s""", messageID),
+            ("""\"messageContents\" LIKE %s""", messageContents),
+            # Half-open range on creationDT; with userID or thread equality it is a range scan on
+            # the ("userID", "creationDT") / ("messageID", "creationDT") indexes.
+            ("""\"creationDT\" >= %s""", since),
+            ("""\"creationDT\" < %s""", before),
+        )
+        if cursor is not None:
+            # The plain bound on creationDT lets the planner skip partitions before the cursor.
+            keyset = decode_cursor(cursor, MESSAGE_CURSOR)
+            conditions += ("""\"creationDT\" >= %s""", """(\"creationDT\", \"userMessageID\") > (%s, %s)""")
+            values.extend((keyset[0], *keyset))
+
+        # Pages need a stable order; the keyset is ("creationDT", "userMessageID").
+        paged = cursor is not None or offset is not None or limit is not None
+        query = select_statement("userMessages", _message_columns(timestamps), conditions,
+                                 """\"creationDT\", \"userMessageID\"""" if paged else None,
+                                 limit is not None, offset is not None)
+        values.extend(value for value in (limit, offset) if value is not None)
+
+        return query, tuple(values)
+
+    @staticmethod
+    def _page(messages: list, limit: int) -> dict:
+        cursors = [encode_cursor(s['creationDT'], s['userMessageID']) for s in messages]
+        next_cursor = cursors[-1] if limit is not None and cursors and len(messages) == limit else None
+
+        return {"cursors": cursors, "next_cursor": next_cursor}
+
+    @staticmethod
+    def _format_messages(messages: list, timestamps: str = "legacy") -> list:
+        if timestamps in TIMESTAMP_COLUMNS:
+            for s in messages:
+                s['creationDT'] = s.pop('creationFormatted')
+
+        return messages
+
+    @staticmethod
+    def _columns_page(columns: dict, limit: int) -> dict:
+        count = len(columns["userMessageID"])
+        next_cursor = None
+        if limit is not None and count and count == limit:
+            next_cursor = encode_cursor(columns["creationDT"][-1], columns["userMessageID"][-1])
+
+        return {"columns": columns, "next_cursor": next_cursor}
+
+    @staticmethod
+    def _get_messages_by_users_query(userIDs: list) -> tuple:
+        return f"""SELECT {_message_columns("legacy")} FROM \"userMessages\" WHERE \"userID\" = ANY(%s) ORDER BY \"creationDT\", \"userMessageID\";""", (list(userIDs),)
+
+    @staticmethod
+    def _search_terms(text: str) -> str:
+        # Every word is a prefix match and all of them must appear, e.g. "hel wor" -> "hel:* & wor:*".
+        return " & ".join(word + ":*" for word in re.findall(r"\w+", text))
+
+    def _search_messages_query(self, text: str, userID: int, messageThreadID: int, limit: int) -> tuple:
+        query = f"""SELECT {_message_columns("legacy")}, ts_rank(\"messageSearch\", q) AS \"rank\" FROM \"userMessages\", to_tsquery('english', %s) q WHERE \"messageSearch\" @@ q"""
+        values = [self._search_terms(text)]
+        if userID is not None:
+            query += """ AND \"userID\" = %s"""
+            values.append(userID)
+        if messageThreadID is not None:
+            query += """ AND \"messageID\" = %s"""
+            values.append(messageThreadID)
+        query += """ ORDER BY \"rank\" DESC, \"creationDT\" DESC LIMIT %s;"""
+        values.append(limit)
+
+        return query, tuple(values)
+
+    @staticmethod
+    def _get_conversation_query(messageThreadID: int, userMessageID: int, before: int, after: int, timestamps: str = None) -> tuple:
+        thread = f"""SELECT {_message_columns(timestamps)} FROM \"userMessages\" WHERE \"messageID\" = %s"""
+        order = """\"creationDT\", \"userMessageID\""""
+        newest = """\"creationDT\" DESC, \"userMessageID\" DESC"""
+
+        if userMessageID is None:
+            if before is not None:
+                # The latest messages: read newest first, then put back in order.
+                return f"""SELECT * FROM ({thread} ORDER BY {newest} LIMIT %s) w ORDER BY {order};""", (messageThreadID, before)
+            if after is not None:
+                return f"""{thread} ORDER BY {order} LIMIT %s;""", (messageThreadID, after)
+            return f"""{thread} ORDER BY {order};""", (messageThreadID,)
+
+        # Both halves are index range scans from the anchor on ("messageID", "creationDT"). The
+        # anchor itself opens the "after" half; a userMessageID from another thread matches nothing.
+        anchor = """(SELECT \"creationDT\", \"userMessageID\" FROM \"userMessages\" WHERE \"userMessageID\" = %s AND \"messageID\" = %s)"""
+        older = f"""{thread} AND ({order}) < {anchor} ORDER BY {newest} LIMIT %s"""
+        newer = f"""{thread} AND ({order}) >= {anchor} ORDER BY {order} LIMIT %s"""
+        query = f"""SELECT * FROM (({older}) UNION ALL ({newer})) w ORDER BY {order};"""
+
+        return query, (messageThreadID, userMessageID, messageThreadID, before or 0,
+                       messageThreadID, userMessageID, messageThreadID, (after or 0) + 1)
+
+    @staticmethod
+    def _thread_query(request) -> tuple:
+        return "INSERT INTO \"messageThread\" (\"messageID\", \"creationDT\") VALUES (%s, CURRENT_TIMESTAMP) ON CONFLICT DO NOTHING", (request.messageID,)
+
+    @staticmethod
+    def _add_message_query(request) -> tuple:
+        return _with_notify("INSERT INTO \"userMessages\" (\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\") VALUES (DEFAULT, %s, %s, %s, CURRENT_TIMESTAMP)", "'added'"), (request.userID, request.messageID, request.messageContents)
+
+    @staticmethod
+    def _lock_message_query(userMessageID: int) -> tuple:
+        # Serializes puts of one userMessageID until the end of the transaction.
+        return "SELECT pg_advisory_xact_lock(%s, %s)", (MESSAGE_LOCK_CLASS, userMessageID)
+
+    @staticmethod
+    def _put_message_query(request) -> tuple:
+        # "userMessages" is partitioned by creationDT, so userMessageID alone can't be an ON CONFLICT
+        # target: update the row if there is one, else insert it. Run it in a transaction holding
+        # _lock_message_query's lock, so two puts of a new userMessageID can't both insert. The
+        # update moves the row to the current month's partition.
+        updated = "UPDATE \"userMessages\" SET \"messageContents\"=%s, \"creationDT\"=CURRENT_TIMESTAMP WHERE \"userMessageID\" = %s RETURNING \"userMessageID\", \"userID\", \"messageID\", false AS inserted"
+        inserted = "INSERT INTO \"userMessages\" (\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\") SELECT %s, %s, %s, %s, CURRENT_TIMESTAMP WHERE NOT EXISTS (SELECT 1 FROM updated) RETURNING \"userMessageID\", \"userID\", \"messageID\", true AS inserted"
+        query = f"""WITH updated AS ({updated}), inserted AS ({inserted}), changed AS (SELECT * FROM updated UNION ALL SELECT * FROM inserted) {_notify_changed("CASE WHEN changed.inserted THEN 'added' ELSE 'updated' END")}"""
+
+        return query, (request.messageContents, request.userMessageID, request.userMessageID, request.userID, request.messageID, request.messageContents)
+
+    @staticmethod
+    def _delete_message_query(request) -> tuple:
+        return _with_notify("DELETE FROM \"userMessages\" WHERE \"userMessageID\" = %s", "'deleted'"), (request.userMessageID,)
+
+    @staticmethod
+    def _add_messages_queries(requests: list) -> list:
+        # Threads are deduped (and sorted, so concurrent loads lock them in the same order); the
+        # messages go in as one INSERT ... SELECT FROM unnest(...) instead of one statement each.
+        threads = sorted({request.messageID for request in requests})
+        return [
+            ("INSERT INTO \"messageThread\" (\"messageID\", \"creationDT\") SELECT unnest(%s::int[]), CURRENT_TIMESTAMP ON CONFLICT DO NOTHING", (threads,)),
+            (_with_notify("INSERT INTO \"userMessages\" (\"userID\", \"messageID\", \"messageContents\", \"creationDT\") SELECT m.\"userID\", m.\"messageID\", m.\"messageContents\", CURRENT_TIMESTAMP FROM unnest(%s::int[], %s::int[], %s::text[]) WITH ORDINALITY AS m(\"userID\", \"messageID\", \"messageContents\", n) ORDER BY n", "'added'", output="""\"userMessageID\""""),
+             ([request.userID for request in requests], [request.messageID for request in requests], [request.messageContents for request in requests])),
+        ]
+
+    @staticmethod
+    def _reserve_message_ids_query(count: int) -> tuple:
+        return """SELECT nextval(pg_get_serial_sequence('\"userMessages\"', 'userMessageID')) AS \"userMessageID\" FROM generate_series(1, %s);""", (count,)
+
+    @staticmethod
+    def _insert_messages_queries(messages: list) -> list:
+        # Like _add_messages_queries, but the rows bring their own userMessageID and creationDT.
+        # Rows that are already there are skipped (and not announced), so a batch can be replayed;
+        # by NOT EXISTS even if a put has since moved the row to another partition.
+        threads = sorted({s["messageID"] for s in messages})
+        return [
+            ("INSERT INTO \"messageThread\" (\"messageID\", \"creationDT\") SELECT unnest(%s::int[]), CURRENT_TIMESTAMP ON CONFLICT DO NOTHING", (threads,)),
+            (_with_notify("INSERT INTO \"userMessages\" (\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\") SELECT * FROM unnest(%s::int[], %s::int[], %s::int[], %s::text[], %s::timestamp[]) AS m(\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\") WHERE NOT EXISTS (SELECT 1 FROM \"userMessages\" u WHERE u.\"userMessageID\" = m.\"userMessageID\") ON CONFLICT DO NOTHING", "'added'", output="""\"userMessageID\""""),
+             tuple([s[column] for s in messages] for column in ("userMessageID", "userID", "messageID", "messageContents", "creationDT"))),
+        ]
+
+
+class AsyncMessageDataService(MessageDataService):
+    """
+
+    Same queries as MessageDataService, awaited on an AsyncDatabaseDataService so route handlers
+    do not block the event loop. Call open() before first use.
+    """
 
     def __init__(self, config: dict):
         """
 
-        :param config: A dictionary of configuration parameters.
+        :param config: A dictionary of configuration parameters. If it has a "database" entry, that
+            AsyncDatabaseDataService (and its pool) is shared instead of creating a new one.
         """
-        super().__init__()
+        BaseDataService.__init__(self)
+
+        self.database = config.get("database") or AsyncDatabaseDataService(config)
+
+    async def open(self):
+        await self.database.open()
+
+    async def close(self):
+        await self.database.close()
 
-        #self.data_dir = config['data_directory']
-        #self.data_file = config["data_file"]
-        #self.students = []
-
-        self.database = DatabaseDataService(config)
-        self._load()
-
-    def _load(self):
-
-        messages = """CREATE TABLE IF NOT EXISTS "userMessages" (
-        "userMessageID" serial,
-        "userID" int,
-        "messageID" int,
-        "messageContents" text,
-        "creationDT" timestamp,
-        PRIMARY KEY ("userMessageID"),
-        CONSTRAINT "FK_userMessages.messageID"
-            FOREIGN KEY ("messageID")
-            REFERENCES "messageThread"("messageID"),
-        CONSTRAINT "FK_userMessages.userID"
-            FOREIGN KEY ("userID")
-            REFERENCES "messageUsers"("userID")
-        );"""
-        threads = """CREATE TABLE IF NOT EXISTS "messageThread" (
-        "messageID" serial,
-        "creationDT" timestamp,
-        PRIMARY KEY ("messageID")
-        );"""
-        self.database.execute_query(threads)
-        self.database.execute_query(messages)
-
-    def get_database(self):
-        return self.database
-
-    def get_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: int, offset: int, limit: int) -> list:
-        """
-
-        Returns students with properties matching the values. Only non-None parameters apply to
+    @instrumented("get_messages")
+    @reads_as_user
+    async def get_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, since: datetime = None, before: datetime = None, timestamps: str = "legacy") -> list:
+        """
+
+        Returns messages with properties matching the values. Only non-None parameters apply to
         the filtering.
 
-        :param uni: UNI to match.
-        :param last_name: last_name to match.
-        :param school_code: first_name to match.
+        :param userID: userID to match.
+        :param messageThreadID: thread (messageID) to match.
+        :param messageID: userMessageID to match.
+        :param since: Only messages created at or after this time.
+        :param before: Only messages created before this time.
+        :param timestamps: One of TIMESTAMP_FORMATS.
         :return: A list of matching JSON records.
         """
-        result = []
-
-        params = ["""\"userID\"""", """\"messageID\"""", """\"userMessageID\"""", """\"messageContents\"""", """\"offset\"""", """\"limit\""""]
-        values = [userID, messageThreadID, messageID, messageContents, offset, limit]
-
-        query = """SELECT * FROM \"userMessages\""""
-        conditions = []
-        for param, value in zip(params, values):
-            if value is not None:
-                if param == """\"messageContents\"""":
-                    conditions.append(f"{param} LIKE %s")
-                else:
-                    conditions.append(f"{param} = %s")
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-        query += ";"
-              
-        messages = self.database.fetchallquery(query, tuple(value for value in values if value is not None))
+        query, values = self._get_messages_query(userID, messageThreadID, messageID, messageContents, offset, limit, None, since, before, timestamps)
+        messages = await self.database.fetchallquery(query, values)
 
-        for s in messages:
-            s['creationDT'] = s['creationDT'].strftime("%m/%d/%Y, %H:%M:%S")
-            result.append(s)
+        return self._format_messages(messages, timestamps)
+
+    @instrumented("get_messages_page")
+    @reads_as_user
+    async def get_messages_page(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str, since: datetime = None, before: datetime = None, timestamps: str = "legacy") -> dict:
+        """
+
+        Like get_messages, but returns one page ordered by creationDT together with a keyset cursor
+        per row and the cursor to pass back for the next page (None on the last page).
+
+        :param cursor: next_cursor of the previous page, or None for the first page.
+        :return: {"items": [...], "cursors": [...], "next_cursor": str}
+        """
+        query, values = self._get_messages_query(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before, timestamps)
+        messages = await self.database.fetchallquery(query, values)
+        page = self._page(messages, limit)
+        page["items"] = self._format_messages(messages, timestamps)
+
+        return page
+
+    @instrumented("get_messages_columns")
+    @reads_as_user
+    async def get_messages_columns(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str, since: datetime = None, before: datetime = None) -> dict:
+        """
+
+        Same page as get_messages_page, but column-oriented ({"userMessageID": [...], ...}) and with
+        creationDT left as datetimes, for the compact response formats.
+
+        :return: {"columns": {...}, "next_cursor": str}
+        """
+        query, values = self._get_messages_query(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before)
+
+        return self._columns_page(await self.database.fetchcolumnsquery(query, values), limit)
+
+    @instrumented("get_messages_by_users")
+    async def get_messages_by_users(self, userIDs: list) -> list:
+        """
+
+        Returns the messages written by any of the given users in a single query, oldest first.
+
+        :param userIDs: userIDs whose messages to fetch.
+        """
+        messages = await self.database.fetchallquery(*self._get_messages_by_users_query(userIDs))
+
+        return self._format_messages(messages)
+
+    @instrumented("search_messages")
+    async def search_messages(self, text: str, userID: int, messageThreadID: int, limit: int) -> list:
+        """
+
+        Full-text search over messageContents using the "messageSearch" tsvector index.
+        Words match as prefixes and all of them must be present.
+
+        :param text: Search text.
+        :param userID: Only search this user's messages, if given.
+        :param messageThreadID: Only search this thread, if given.
+        :param limit: Maximum number of results.
+        :return: Matching messages, best match first, each with its "rank".
+        """
+        if not self._search_terms(text):
+            return []
+        messages = await self.database.fetchallquery(*self._search_messages_query(text, userID, messageThreadID, limit))
+
+        return self._format_messages(messages)
+
+    @instrumented("stream_messages")
+    async def stream_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, batch_size: int = 1000, since: datetime = None, before: datetime = None, timestamps: str = "legacy"):
+        """
+
+        Yields the messages matching the filters in batches of at most batch_size rows, read from a
+        server-side cursor so that exporting a full history runs in constant memory.
+        """
+        query, values = self._get_messages_query(userID, messageThreadID, messageID, messageContents, None, None, None, since, before, timestamps)
+
+        async for messages in self.database.streamquery(query, values, batch_size):
+            yield self._format_messages(messages, timestamps)
+
+    @instrumented("get_conversation")
+    async def get_conversation(self, messageThreadID: int, userMessageID: int = None, before: int = None, after: int = None, timestamps: str = "legacy") -> list:
+        """
+
+        Returns the messages of every participant in a thread, oldest first (by creationDT, then
+        userMessageID).
+
+        :param messageThreadID: Thread (messageID) to return.
+        :param userMessageID: Message to center the window on. It is included, with up to before
+            messages preceding it and up to after messages following it.
+        :param before: Without userMessageID, return only the latest before messages.
+        :param after: Without userMessageID, return only the first after messages.
+        :param timestamps: One of TIMESTAMP_FORMATS.
+        """
+        messages = await self.database.fetchallquery(*self._get_conversation_query(messageThreadID, userMessageID, before, after, timestamps))
+
+        return self._format_messages(messages, timestamps)
 
-        return result
-    
-    def add_message(self, request: dict) -> list:
+    @instrumented("add_message")
+    @writes_as_user
+    async def add_message(self, request: dict) -> list:
         """
 
         Adds a message to a thread. Thread is created if the current ID doesnt exist.
 
         :param request: POST request with message data.
         """
-        self.database.execute_query("INSERT INTO \"messageThread\" (\"messageID\", \"creationDT\") VALUES (%s, CURRENT_TIMESTAMP) ON CONFLICT DO NOTHING", (request.messageID,))
-        messages = self.database.execute_query("INSERT INTO \"userMessages\" (\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\") VALUES (DEFAULT, %s, %s, %s, CURRENT_TIMESTAMP) RETURNING \"messageID\"", (request.userID, request.messageID, request.messageContents))
-        result = messages.fetchone()
+        await self.database.execute_query(*self._thread_query(request))
+        return await self.database.fetchonequery(*self._add_message_query(request))
+
+    @instrumented("add_messages")
+    @writes_as_user
+    async def add_messages(self, requests: list) -> list:
+        """
+
+        Adds many messages in one transaction, creating any threads that don't exist yet.
+
+        :param requests: Messages to add.
+        :return: The new userMessageIDs, in the same order as requests.
+        """
+        if not requests:
+            return []
+        (threads, thread_params), (messages, message_params) = self._add_messages_queries(requests)
+
+        async with self.database.transaction() as cursor:
+            await cursor.execute(threads, thread_params)
+            await cursor.execute(messages, message_params)
+            return sorted(row[0] for row in await cursor.fetchall())
+
+    @instrumented("reserve_message_ids")
+    async def reserve_message_ids(self, count: int) -> list:
+        """
+
+        Takes count values from the userMessageID sequence, for rows that are inserted later with
+        insert_messages. Unused values are simply skipped, as after a rolled back insert.
+        """
+        return [row["userMessageID"] for row in await self.database.fetchallquery(*self._reserve_message_ids_query(count))]
 
-        return result
-    
-    def put_message(self, request: dict) -> list:
+    @instrumented("insert_messages")
+    async def insert_messages(self, messages: list) -> list:
+        """
+
+        Inserts fully formed rows ({"userMessageID", "userID", "messageID", "messageContents",
+        "creationDT"}) in one transaction, creating their threads as needed. userMessageIDs that
+        already exist are skipped.
+
+        :return: userMessageIDs of the rows inserted.
+        """
+        (threads, thread_params), (inserts, insert_params) = self._insert_messages_queries(messages)
+
+        async with self.database.transaction() as cursor:
+            await cursor.execute(threads, thread_params)
+            await cursor.execute(inserts, insert_params)
+            return sorted(row[0] for row in await cursor.fetchall())
+
+    @instrumented("put_message")
+    @writes_as_user
+    async def put_message(self, request: dict) -> list:
         """
 
         Puts a message to a thread. Thread is created if the current ID doesnt exist.
 
         :param request: POST request with message data.
         """
-        self.database.execute_query("INSERT INTO \"messageThread\" (\"messageID\", \"creationDT\") VALUES (%s, CURRENT_TIMESTAMP) ON CONFLICT DO NOTHING", (request.messageID,))
-        messages = self.database.execute_query("INSERT INTO \"userMessages\" (\"userMessageID\", \"userID\", \"messageID\", \"messageContents\", \"creationDT\") VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP) ON CONFLICT (\"userMessageID\") DO UPDATE SET \"messageContents\"=%s, \"creationDT\"=CURRENT_TIMESTAMP RETURNING \"messageID\"", (request.userMessageID, request.userID, request.messageID, request.messageContents, request.messageContents))
-        result = messages.fetchone()
+        async with self.database.transaction() as cursor:
+            await cursor.execute(*self._thread_query(request))
+            await cursor.execute(*self._lock_message_query(request.userMessageID))
+            await cursor.execute(*self._put_message_query(request))
+            return await cursor.fetchone()
 
-        return result
-    
-    def delete_message(self, request: dict) -> list:
+    @instrumented("delete_message")
+    @writes_as_user
+    async def delete_message(self, request: dict) -> list:
         """
 
         Deletes a message from a thread.
 
         :param request: DELETE request with message ID.
         """
-        messages = self.database.execute_query("DELETE FROM \"userMessages\" WHERE \"userMessageID\" = %s RETURNING \"messageID\"", (request.userMessageID,))
-        result = messages.fetchone()
+        return await self.database.fetchonequery(*self._delete_message_query(request))
+
+
+MESSAGE_COLUMN_NAMES = ("userMessageID", "userID", "messageID", "messageContents", "creationDT")
+EPOCH = datetime(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=256)
+def _like(pattern: str):
+    # LIKE semantics: % is any run, _ any one character, backslash escapes; the whole value must match.
+    regex = []
+    escaped = False
+    for ch in pattern:
+        if escaped:
+            regex.append(re.escape(ch))
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        elif ch == "%":
+            regex.append(".*")
+        elif ch == "_":
+            regex.append(".")
+        else:
+            regex.append(re.escape(ch))
+    return re.compile("".join(regex), re.DOTALL)
+
+
+def _naive(value: datetime) -> datetime:
+    # A timestamptz parameter compared with a "timestamp" column is taken in UTC.
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class MemoryMessageDataService(BaseDataService):
+    """
+
+    Same interface and results as AsyncMessageDataService, answered from a
+    MemoryDatabaseDataService: the filters use its per-thread, per-user or global
+    (creationDT, userMessageID) index, so ranges and keyset pages are bisections.
+    """
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary of configuration parameters. If it has a "database" entry, that
+            MemoryDatabaseDataService is shared instead of creating a new one.
+        """
+        super().__init__()
+
+        self.database = config.get("database") or MemoryDatabaseDataService(config)
+
+    async def open(self):
+        await self.database.open()
+
+    async def close(self):
+        await self.database.close()
+
+    @staticmethod
+    def _format(row: dict, timestamps: str = "legacy") -> dict:
+        _message_columns(timestamps)
+        s = dict(row)
+        if timestamps == "legacy":
+            s["creationDT"] = row["creationDT"].strftime("%m/%d/%Y, %H:%M:%S")
+        elif timestamps == "epoch":
+            s["creationDT"] = round((row["creationDT"] - EPOCH) / timedelta(milliseconds=1))
+        return s
+
+    def _select(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, cursor: str = None, since: datetime = None, before: datetime = None):
+        db = self.database
+        if messageID is not None:
+            row = db.messages.get(messageID)
+            keys = [(row["creationDT"], messageID)] if row is not None else []
+        elif messageThreadID is not None:
+            keys = db.thread_keys.get(messageThreadID, [])
+        elif userID is not None:
+            keys = db.user_keys.get(userID, [])
+        else:
+            keys = db.message_keys
+
+        start, end = 0, len(keys)
+        if since is not None:
+            start = bisect_left(keys, (_naive(since),))
+        if before is not None:
+            end = bisect_left(keys, (_naive(before),))
+        if cursor is not None:
+            created, userMessageID = decode_cursor(cursor, MESSAGE_CURSOR)
+            start = max(start, bisect_right(keys, (_naive(created), userMessageID)))
+        pattern = _like(messageContents) if messageContents is not None else None
+
+        rows = []
+        for _, userMessageID in keys[start:end]:
+            row = db.messages[userMessageID]
+            if userID is not None and row["userID"] != userID:
+                continue
+            if messageThreadID is not None and row["messageID"] != messageThreadID:
+                continue
+            if pattern is not None and not pattern.fullmatch(row["messageContents"] or ""):
+                continue
+            rows.append(row)
+        return rows
+
+    def _query(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str = None, since: datetime = None, before: datetime = None) -> list:
+        rows = self._select(userID, messageThreadID, messageID, messageContents, cursor, since, before)
+        start = offset or 0
+        return rows[start:start + limit if limit is not None else None]
+
+    def _notify(self, op: str, row: dict):
+        self.database.notify(MESSAGE_CHANNEL, {"op": op, "userMessageID": row["userMessageID"], "userID": row["userID"], "messageID": row["messageID"]})
+
+    async def get_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, since: datetime = None, before: datetime = None, timestamps: str = "legacy") -> list:
+        rows = self._query(userID, messageThreadID, messageID, messageContents, offset, limit, None, since, before)
+
+        return [self._format(row, timestamps) for row in rows]
+
+    async def get_messages_page(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str, since: datetime = None, before: datetime = None, timestamps: str = "legacy") -> dict:
+        rows = self._query(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before)
+        page = MessageDataService._page(rows, limit)
+        page["items"] = [self._format(row, timestamps) for row in rows]
+
+        return page
+
+    async def get_messages_columns(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str, since: datetime = None, before: datetime = None) -> dict:
+        rows = self._query(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before)
+        columns = {name: [row[name] for row in rows] for name in MESSAGE_COLUMN_NAMES}
+
+        return MessageDataService._columns_page(columns, limit)
+
+    async def get_messages_by_users(self, userIDs: list) -> list:
+        keys = heapq.merge(*(self.database.user_keys.get(userID, []) for userID in set(userIDs)))
+
+        return [self._format(self.database.messages[userMessageID]) for _, userMessageID in keys]
+
+    async def search_messages(self, text: str, userID: int, messageThreadID: int, limit: int) -> list:
+        # Prefix matching as in _search_terms, without stemming or stop words; the rank is the
+        # share of the message's words that match a term.
+        if not MessageDataService._search_terms(text):
+            return []
+        terms = re.findall(r"\w+", text.lower())
+
+        results = []
+        for row in self._select(userID, messageThreadID, None, None):
+            words = re.findall(r"\w+", (row["messageContents"] or "").lower())
+            if all(any(word.startswith(term) for word in words) for term in terms):
+                matched = sum(1 for word in words if any(word.startswith(term) for term in terms))
+                results.append((matched / len(words), row))
+        results.sort(key=lambda result: (result[0], result[1]["creationDT"]), reverse=True)
+
+        return [dict(self._format(row), rank=rank) for rank, row in results[:limit]]
+
+    async def stream_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, batch_size: int = 1000, since: datetime = None, before: datetime = None, timestamps: str = "legacy"):
+        # Matching rows are fixed when the stream starts, like a cursor's snapshot.
+        rows = self._select(userID, messageThreadID, messageID, messageContents, None, since, before)
+
+        for i in range(0, len(rows), batch_size):
+            yield [self._format(row, timestamps) for row in rows[i:i + batch_size]]
+
+    async def get_conversation(self, messageThreadID: int, userMessageID: int = None, before: int = None, after: int = None, timestamps: str = "legacy") -> list:
+        keys = self.database.thread_keys.get(messageThreadID, [])
+        if userMessageID is not None:
+            row = self.database.messages.get(userMessageID)
+            if row is None or row["messageID"] != messageThreadID:
+                return []
+            anchor = bisect_left(keys, (row["creationDT"], userMessageID))
+            keys = keys[max(anchor - (before or 0), 0):anchor + (after or 0) + 1]
+        elif before is not None:
+            keys = keys[max(len(keys) - before, 0):]
+        elif after is not None:
+            keys = keys[:after]
+
+        return [self._format(self.database.messages[key[1]], timestamps) for key in keys]
+
+    async def add_message(self, request: dict) -> list:
+        self.database.ensure_thread(request.messageID)
+        row = self.database.insert_message({
+            "userMessageID": self.database.next_id("userMessageID"),
+            "userID": request.userID,
+            "messageID": request.messageID,
+            "messageContents": request.messageContents,
+            "creationDT": now(),
+        })
+        self._notify("added", row)
+
+        return (row["messageID"],)
+
+    async def add_messages(self, requests: list) -> list:
+        if not requests:
+            return []
+        # All or nothing, like the single transaction on Postgres.
+        for request in requests:
+            if request.userID not in self.database.users:
+                raise IntegrityError(f"userID {request.userID} does not exist")
+        for messageID in sorted({request.messageID for request in requests}):
+            self.database.ensure_thread(messageID)
+
+        created = now()
+        rows = [self.database.insert_message({
+            "userMessageID": self.database.next_id("userMessageID"),
+            "userID": request.userID,
+            "messageID": request.messageID,
+            "messageContents": request.messageContents,
+            "creationDT": created,
+        }) for request in requests]
+        for row in rows:
+            self._notify("added", row)
+
+        return [row["userMessageID"] for row in rows]
+
+    async def reserve_message_ids(self, count: int) -> list:
+        return [self.database.next_id("userMessageID") for _ in range(count)]
+
+    async def insert_messages(self, messages: list) -> list:
+        for s in messages:
+            if s["userMessageID"] not in self.database.messages and s["userID"] not in self.database.users:
+                raise IntegrityError(f"userID {s['userID']} does not exist")
+        for messageID in sorted({s["messageID"] for s in messages}):
+            self.database.ensure_thread(messageID)
+
+        rows = [self.database.insert_message(dict(s)) for s in messages if s["userMessageID"] not in self.database.messages]
+        for row in rows:
+            self._notify("added", row)
+
+        return sorted(row["userMessageID"] for row in rows)
+
+    async def put_message(self, request: dict) -> list:
+        self.database.ensure_thread(request.messageID)
+        if request.userMessageID in self.database.messages:
+            row = self.database.update_message(request.userMessageID, request.messageContents, now())
+            op = "updated"
+        else:
+            row = self.database.insert_message({
+                "userMessageID": self.database.next_id("userMessageID", request.userMessageID),
+                "userID": request.userID,
+                "messageID": request.messageID,
+                "messageContents": request.messageContents,
+                "creationDT": now(),
+            })
+            op = "added"
+        self._notify(op, row)
+
+        return (row["messageID"],)
 
-        return result
+    async def delete_message(self, request: dict) -> list:
+        row = self.database.delete_message(request.userMessageID)
+        if row is None:
+            return None
+        self._notify("deleted", row)
 
+        return (row["messageID"],)
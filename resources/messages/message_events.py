@@ -0,0 +1,113 @@
+#
+# Fans out message changes to GraphQL subscribers. add/put/delete_message announce every change
+# with pg_notify on MESSAGE_CHANNEL; each worker holds a single LISTEN connection and hands the
+# events to the in-process subscribers of the affected thread.
+#
+import asyncio
+import logging
+
+from resources.database.routing_database_data_service import primary_reads
+from resources.messages.message_data_service import MESSAGE_CHANNEL
+
+
+log = logging.getLogger("message_events")
+
+
+class MessageEventBroker():
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary with the "database" (AsyncDatabaseDataService or
+            MemoryDatabaseDataService) to listen on and the "data_service" used to load changed
+            messages. "queue_size" bounds how many undelivered events a slow subscriber may have
+            before the oldest are dropped.
+        """
+        self.database = config["database"]
+        self.data_service = config["data_service"]
+        self.queue_size = config.get("queue_size", 100)
+        self.reconnect_delay = config.get("reconnect_delay", 1)
+
+        self._subscribers = {}
+        self._watchers = []
+        # Events for threads with subscribers, waiting for their row to be loaded.
+        self._deliveries = asyncio.Queue()
+        self._tasks = []
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._deliver())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def add_watcher(self, callback):
+        """
+
+        Calls callback(event) with every raw event ({"op", "userMessageID", "userID", "messageID"}),
+        whichever thread it is in, and callback(None) whenever events may have been missed.
+        """
+        self._watchers.append(callback)
+
+    async def _listen(self):
+        # The database reconnects a dropped LISTEN session itself; subscribers stay. Watchers
+        # (cache invalidation) run inline and never wait for the row loads of _deliver, so a bulk
+        # insert's events can't hold them up.
+        async for event in self.database.listen(MESSAGE_CHANNEL, self.reconnect_delay):
+            for callback in self._watchers:
+                try:
+                    callback(event)
+                except Exception:
+                    log.exception("Message event watcher failed on %s", event)
+            if event is not None and self._subscribers.get(event["messageID"]):
+                self._deliveries.put_nowait(event)
+
+    async def _deliver(self):
+        while True:
+            event = await self._deliveries.get()
+            try:
+                await self._dispatch(event)
+            except Exception:
+                # One event that can't be loaded must not end delivery for every subscriber.
+                log.exception("Delivering message event %s failed", event)
+
+    async def _dispatch(self, event: dict):
+        queues = self._subscribers.get(event["messageID"])
+        if not queues:
+            return
+
+        # Load the row once per worker, not once per subscriber, from the primary: a replica may not
+        # have replayed the change yet.
+        event["message"] = None
+        # Archival announces whole threads, without a userMessageID.
+        if event["op"] != "deleted" and event["userMessageID"] is not None:
+            with primary_reads():
+                rows = await self.data_service.get_messages(None, None, event["userMessageID"], None, None, None)
+            event["message"] = rows[0] if rows else None
+
+        for queue in list(queues):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def subscribe(self, messageThreadID: int):
+        """
+
+        Yields {"op", "userMessageID", "userID", "messageID", "message"} for every message added,
+        updated or deleted in the thread until the consumer stops iterating. "message" is the
+        current row, or None for deletions.
+        """
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(messageThreadID, set()).add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            queues = self._subscribers.get(messageThreadID)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[messageThreadID]
@@ -1,5 +1,6 @@
 from __future__ import annotations
 from pydantic import BaseModel
+from datetime import datetime
 from typing import List
 
 from resources.rest_models import Link
@@ -10,7 +11,7 @@ class MessageModel(BaseModel):
     userID: int
     messageID: int
     messageContents: str
-    creationDT: str
+    creationDT: datetime | None = None
 
     model_config = {
         "json_schema_extra": {
@@ -20,7 +21,7 @@ class MessageModel(BaseModel):
                     "userID": 1,
                     "messageID": 1,
                     "messageContents": "Hi! (Potentially Encrypted).",
-                    "creationDT": "10/3/23 16:25"
+                    "creationDT": "2023-10-03T16:25:00"
                 }
             ]
         }
@@ -28,7 +29,11 @@ class MessageModel(BaseModel):
 
 
 class MessageRspModel(MessageModel):
+    # Depends on the "timestamps" query parameter: the legacy "MM/DD/YYYY, HH:MM:SS" string by
+    # default, an ISO-8601 datetime, or epoch milliseconds.
+    creationDT: datetime | int | str
     links: List[Link] = None
 
 
-
+class MessageSearchRspModel(MessageRspModel):
+    rank: float
@@ -1,9 +1,15 @@
 from resources.abstract_base_resource import BaseResource
-from resources.messages.message_models import MessageRspModel, MessageModel
-from resources.rest_models import Link
+from resources.messages.message_models import MessageRspModel, MessageModel, MessageSearchRspModel
+from datetime import datetime
 from typing import List
 
 
+LINK_TEMPLATES = (
+    ("self", "/api/messages/{userID}/{messageID}"),
+    ("author", "/api/users/{userID}"),
+)
+
+
 class MessageResource(BaseResource):
     #
     # This code is just to get us started.
@@ -16,46 +22,84 @@ class MessageResource(BaseResource):
         self.data_service = config["data_service"]
 
     @staticmethod
-    def _generate_links(s: dict) -> MessageRspModel:
-
-        self_link = Link(**{
-            "rel": "self",
-            "href": "/users/" + str(s['userID'])
-        })
-
-        links = [
-            self_link,
-        ]
-        rsp = MessageRspModel(**s, links=links)
-        return rsp
+    def _generate_links(s: dict) -> dict:
+        # Rows come straight from Postgres and are already typed, so the links are filled in from
+        # LINK_TEMPLATES on the dict itself instead of building Link / MessageRspModel objects per row.
+        s["links"] = [{"rel": rel, "href": href.format_map(s)} for rel, href in LINK_TEMPLATES]
+        return s
 
-    def get_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: int, offset: int, limit: int) -> List[MessageRspModel]:
+    async def get_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, since: datetime = None, before: datetime = None, timestamps: str = "legacy") -> List[MessageRspModel]:
 
-        result = self.data_service.get_messages(userID, messageThreadID, messageID, messageContents, offset, limit)
+        result = await self.data_service.get_messages(userID, messageThreadID, messageID, messageContents, offset, limit, since, before, timestamps)
         final_result = []
 
         for s in result:
-            #m = self._generate_links(s)
-            #final_result.append(m)
-            final_result.append(s)
+            final_result.append(self._generate_links(s))
 
         return final_result
 
-    def add_message(self, request: MessageModel) -> List[MessageRspModel]:
+    async def get_messages_page(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str, since: datetime = None, before: datetime = None, timestamps: str = "legacy") -> dict:
+
+        result = await self.data_service.get_messages_page(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before, timestamps)
+        for s in result["items"]:
+            self._generate_links(s)
+
+        return result
+
+    async def get_messages_columns(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, offset: int, limit: int, cursor: str, since: datetime = None, before: datetime = None) -> dict:
+
+        result = await self.data_service.get_messages_columns(userID, messageThreadID, messageID, messageContents, offset, limit, cursor, since, before)
+
+        return result
+
+    async def get_messages_by_users(self, userIDs: list) -> List[MessageRspModel]:
+
+        result = await self.data_service.get_messages_by_users(userIDs)
+
+        return result
+
+    async def search_messages(self, text: str, userID: int, messageThreadID: int, limit: int) -> List[MessageSearchRspModel]:
+
+        result = await self.data_service.search_messages(text, userID, messageThreadID, limit)
+        for s in result:
+            self._generate_links(s)
+
+        return result
+
+    async def stream_messages(self, userID: int, messageThreadID: int, messageID: int, messageContents: str, batch_size: int = 1000, since: datetime = None, before: datetime = None, timestamps: str = "legacy"):
+
+        async for batch in self.data_service.stream_messages(userID, messageThreadID, messageID, messageContents, batch_size, since, before, timestamps):
+            yield batch
+
+    async def get_conversation(self, messageThreadID: int, userMessageID: int = None, before: int = None, after: int = None, timestamps: str = "legacy") -> List[MessageRspModel]:
+
+        result = await self.data_service.get_conversation(messageThreadID, userMessageID, before, after, timestamps)
+        for s in result:
+            self._generate_links(s)
+
+        return result
+
+    async def add_message(self, request: MessageModel) -> List[MessageRspModel]:
+
+        result = await self.data_service.add_message(request)
+
+        return result
+    
+    async def add_messages(self, requests: List[MessageModel]) -> List[int]:
 
-        result = self.data_service.add_message(request)
+        result = await self.data_service.add_messages(requests)
 
         return result
     
-    def put_message(self, request: MessageModel) -> List[MessageRspModel]:
+    async def put_message(self, request: MessageModel) -> List[MessageRspModel]:
 
-        result = self.data_service.put_message(request)
+        result = await self.data_service.put_message(request)
 
         return result
 
-    def delete_message(self, request: MessageModel) -> List[MessageRspModel]:
+    async def delete_message(self, request: MessageModel) -> List[MessageRspModel]:
 
-        result = self.data_service.delete_message(request)
+        result = await self.data_service.delete_message(request)
 
         return result
 
@@ -0,0 +1,382 @@
+#
+# Write-behind for POST /api/messages/newMessage (WRITE_BEHIND in main.py). A message gets its
+# userMessageID from a block reserved from the sequence in advance, is appended to a journal on
+# local disk and acknowledged as soon as the journal is fsynced; a background task then inserts
+# the queued messages in batches of one transaction each. Because the rows carry their own IDs,
+# inserting one twice is a no-op, so whatever is left in the journal can simply be replayed.
+#
+# The journal is a set of segment files "<pid>-<n>.jsonl", one message per line plus a
+# {"committed": [...]} line per batch. A worker holds an exclusive flock on its segments and
+# deletes each one once every message in it is committed. Segments nobody holds a lock on were
+# left by a worker that died; the next worker to start replays and deletes them.
+#
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import psycopg
+
+from resources import metrics
+from resources.database.memory_database_data_service import IntegrityError
+
+
+log = logging.getLogger("message_write_queue")
+
+# Errors that reject the rows themselves (unknown userID, ...), as opposed to the database being
+# unavailable. A rejected batch is retried row by row and the rejected rows are dropped.
+REJECTED = (psycopg.IntegrityError, psycopg.DataError, IntegrityError)
+
+
+class QueueFull(Exception):
+    """
+    The queue stayed full for the whole put timeout, or is shutting down.
+    """
+
+
+def _now() -> datetime:
+    # The same naive UTC timestamp CURRENT_TIMESTAMP stores on the Cloud SQL instance.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps({**message, "creationDT": message["creationDT"].isoformat()}) + "\n").encode()
+
+
+def _decode(line: bytes) -> dict:
+    entry = json.loads(line)
+    if "creationDT" in entry:
+        entry["creationDT"] = datetime.fromisoformat(entry["creationDT"])
+    return entry
+
+
+class _Segment():
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "xb")
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.size = 0
+        # Messages written to this segment and not committed yet.
+        self.pending = 0
+
+    def delete(self):
+        os.unlink(self.path)
+        self.file.close()
+
+
+class MessageWriteQueue():
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary with the "data_service" (AsyncMessageDataService or
+            MemoryMessageDataService) to insert into and the "journal_dir" to keep the journal in,
+            which must survive a restart of the process. Optional: "max_size" (messages accepted but
+            not committed before add_message waits, default 10000), "batch_size" (messages per
+            insert, and the queue length that triggers a flush, default 500), "flush_interval"
+            (seconds between flushes when the batch doesn't fill up, default 0.05), "put_timeout"
+            (seconds add_message waits for room before raising QueueFull, default 1), "id_block"
+            (userMessageIDs reserved per round trip, default 1000), "retry_delay" (seconds before
+            retrying a failed batch, default 1) and "segment_bytes" (journal segment size, default
+            16 MiB).
+        """
+        self.data_service = config["data_service"]
+        self.journal_dir = config["journal_dir"]
+        self.max_size = config.get("max_size", 10000)
+        self.batch_size = config.get("batch_size", 500)
+        self.flush_interval = config.get("flush_interval", 0.05)
+        self.put_timeout = config.get("put_timeout", 1)
+        self.id_block = config.get("id_block", 1000)
+        self.retry_delay = config.get("retry_delay", 1)
+        self.segment_bytes = config.get("segment_bytes", 16 * 1024 * 1024)
+
+        self._ids = deque()
+        self._id_lock = asyncio.Lock()
+        # (message, future) waiting for the journal; (message, segment, accepted) waiting for the database.
+        self._incoming = []
+        self._queue = deque()
+        self._in_flight = 0
+        # (segment, [userMessageID]) of committed batches, for the journal task to record.
+        self._committed = []
+
+        self._segment = None
+        self._segments = []
+        self._sequence = 0
+
+        self._journal_wake = asyncio.Event()
+        self._flush_wake = asyncio.Event()
+        self._space = asyncio.Event()
+        self._closed = False
+        self._journal_done = False
+        self._tasks = []
+        self._metrics = {
+            "accepted": 0,
+            "committed": 0,
+            "rejected": 0,
+            "replayed": 0,
+            "batches": 0,
+            "flush_failures": 0,
+            "full": 0,
+        }
+
+    def depth(self) -> int:
+        return len(self._incoming) + len(self._queue) + self._in_flight
+
+    def get_metrics(self) -> dict:
+        return {
+            **self._metrics,
+            "depth": self.depth(),
+            "max_size": self.max_size,
+            "journal_pending": len(self._incoming),
+            "in_flight": self._in_flight,
+            "segments": len(self._segments),
+            "reserved_ids": len(self._ids),
+        }
+
+    async def start(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        await self._replay()
+        self._closed = False
+        self._journal_done = False
+        self._tasks = [asyncio.create_task(self._journal()), asyncio.create_task(self._flush_loop())]
+
+    async def stop(self):
+        """
+
+        Stops accepting messages and commits the queued ones. Whatever can't be committed stays in
+        the journal for the next start.
+        """
+        self._closed = True
+        self._space.set()
+        journal, flush_loop = self._tasks
+        flush_loop.cancel()
+        await asyncio.gather(flush_loop, return_exceptions=True)
+        try:
+            while self._incoming:
+                self._journal_wake.set()
+                await asyncio.sleep(0.01)
+            while self._queue:
+                if not await self._flush():
+                    break
+        finally:
+            # The journal task records the last commits and deletes finished segments, then exits.
+            self._journal_done = True
+            self._journal_wake.set()
+            await asyncio.gather(journal, return_exceptions=True)
+            self._tasks = []
+            for segment in self._segments:
+                segment.file.close()
+            self._segments = []
+            self._segment = None
+
+    async def _next_id(self) -> int:
+        async with self._id_lock:
+            if not self._ids:
+                self._ids.extend(await self.data_service.reserve_message_ids(self.id_block))
+            return self._ids.popleft()
+
+    async def add_message(self, request) -> int:
+        """
+
+        Queues a message for insertion and returns once it is journaled.
+
+        :param request: MessageModel; userMessageID and creationDT are assigned here.
+        :return: The userMessageID the message will have.
+        """
+        deadline = time.monotonic() + self.put_timeout
+        while self.depth() >= self.max_size and not self._closed:
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+        if self._closed or self.depth() >= self.max_size:
+            self._metrics["full"] += 1
+            raise QueueFull()
+
+        message = {
+            "userMessageID": await self._next_id(),
+            "userID": request.userID,
+            "messageID": request.messageID,
+            "messageContents": request.messageContents,
+            "creationDT": _now(),
+        }
+        future = asyncio.get_running_loop().create_future()
+        self._incoming.append((message, future))
+        self._journal_wake.set()
+        await future
+        self._metrics["accepted"] += 1
+
+        return message["userMessageID"]
+
+    # Journal
+
+    def _open_segment(self) -> _Segment:
+        while True:
+            self._sequence += 1
+            try:
+                segment = _Segment(os.path.join(self.journal_dir, f"{os.getpid()}-{self._sequence}.jsonl"))
+            except FileExistsError:
+                continue
+            self._segments.append(segment)
+            return segment
+
+    def _write(self, data: bytes, sync: bool):
+        # Runs in a thread; only the journal task calls it, so the segments need no lock.
+        segment = self._segment
+        segment.file.write(data)
+        segment.file.flush()
+        if sync:
+            os.fsync(segment.file.fileno())
+        segment.size += len(data)
+
+    async def _journal(self):
+        # The only task that touches the segment files. Each pass appends everything that arrived
+        # meanwhile with a single fsync, so the cost of durability is shared by a whole burst.
+        while not (self._journal_done and not self._incoming and not self._committed):
+            await self._journal_wake.wait()
+            self._journal_wake.clear()
+
+            committed, self._committed = self._committed, []
+            for segment, ids in committed:
+                segment.pending -= len(ids)
+                if segment is self._segment:
+                    # No fsync: losing the marker only means a harmless replay.
+                    await asyncio.to_thread(self._write, (json.dumps({"committed": ids}) + "\n").encode(), False)
+            for segment in [s for s in self._segments if s.pending == 0 and (s is not self._segment or s.size >= self.segment_bytes or not self._incoming)]:
+                if segment is self._segment:
+                    self._segment = None
+                self._segments.remove(segment)
+                segment.delete()
+
+            incoming, self._incoming = self._incoming, []
+            if not incoming:
+                continue
+            if self._segment is None or self._segment.size >= self.segment_bytes:
+                self._segment = self._open_segment()
+            segment = self._segment
+            try:
+                await asyncio.to_thread(self._write, b"".join(_encode(message) for message, _ in incoming), True)
+            except OSError as e:
+                log.exception("Journal write failed")
+                for _, future in incoming:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            accepted = time.monotonic()
+            segment.pending += len(incoming)
+            for message, future in incoming:
+                self._queue.append((message, segment, accepted))
+                if not future.done():
+                    future.set_result(None)
+            if len(self._queue) >= self.batch_size:
+                self._flush_wake.set()
+
+    async def _replay(self):
+        # Segments still locked belong to a live worker.
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, "*.jsonl"))):
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if not os.path.exists(path):
+                    # Replayed and deleted by another worker while this one waited for the lock.
+                    continue
+                committed = set()
+                messages = []
+                for line in f:
+                    try:
+                        entry = _decode(line)
+                    except ValueError:
+                        # A line cut off by the crash was never acknowledged.
+                        continue
+                    if "committed" in entry:
+                        committed.update(entry["committed"])
+                    else:
+                        messages.append(entry)
+                messages = [s for s in messages if s["userMessageID"] not in committed]
+                for i in range(0, len(messages), self.batch_size):
+                    await self._insert(messages[i:i + self.batch_size])
+                self._metrics["replayed"] += len(messages)
+                log.info("Replayed %d messages from %s", len(messages), path)
+                os.unlink(path)
+            except Exception:
+                log.exception("Replaying %s failed; it is kept for the next start", path)
+            finally:
+                f.close()
+
+    # Database
+
+    async def _insert(self, messages: list) -> int:
+        # Returns how many of the messages are in the database now (inserted here or by an earlier,
+        # interrupted attempt), i.e. all but the rejected ones.
+        try:
+            await self.data_service.insert_messages(messages)
+        except REJECTED:
+            if len(messages) == 1:
+                self._metrics["rejected"] += 1
+                log.error("Dropped message %s: rejected by the database", messages[0]["userMessageID"], exc_info=True)
+                return 0
+            stored = 0
+            for message in messages:
+                stored += await self._insert([message])
+            return stored
+        return len(messages)
+
+    async def _flush(self) -> bool:
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        self._in_flight = len(batch)
+        start = time.perf_counter()
+        try:
+            stored = await self._insert([message for message, _, _ in batch])
+        except asyncio.CancelledError:
+            # The batch may or may not have been committed; inserting it again is harmless.
+            self._queue.extendleft(reversed(batch))
+            raise
+        except Exception:
+            self._metrics["flush_failures"] += 1
+            log.exception("Write-behind batch of %d messages failed; retrying", len(batch))
+            self._queue.extendleft(reversed(batch))
+            return False
+        finally:
+            self._in_flight = 0
+        done = time.monotonic()
+        metrics.WRITE_QUEUE_FLUSH_SECONDS.observe(time.perf_counter() - start)
+        metrics.WRITE_QUEUE_BATCH_ROWS.observe(len(batch))
+        for _, _, accepted in batch:
+            metrics.WRITE_QUEUE_LAG_SECONDS.observe(done - accepted)
+        self._metrics["batches"] += 1
+        self._metrics["committed"] += stored
+
+        # Rejected messages are done with as well: they must not be replayed.
+        by_segment = {}
+        for message, segment, _ in batch:
+            by_segment.setdefault(segment, []).append(message["userMessageID"])
+        self._committed.extend(by_segment.items())
+        self._journal_wake.set()
+        self._space.set()
+        return True
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wake.clear()
+            while self._queue:
+                if not await self._flush():
+                    await asyncio.sleep(self.retry_delay)
+                    break
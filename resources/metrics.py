@@ -0,0 +1,186 @@
+#
+# Request and data-layer instrumentation, exposed in the Prometheus text format on /metrics.
+# Kept dependency-free: a handful of histograms fed by MetricsMiddleware (per-route latency),
+# AsyncDatabaseDataService (query time, rows, pool wait), TrustedJSONResponse (serialization) and
+# MessageWriteQueue (write-behind batches).
+# DB samples are tagged with the data-service operation that issued them via @instrumented.
+#
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from starlette.routing import Match
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+# Data-service operation (get_users, get_messages, add_message, ...) the current query belongs to.
+operation = ContextVar("operation", default="other")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram():
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                le = 'le="{}"'.format(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to handle a request, by route template.", ("method", "route", "status"))
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Time to execute a query and receive its result.", ("operation",))
+DB_ROWS = Histogram("db_rows_returned", "Rows returned (or affected) per query.", ("operation",), ROW_BUCKETS)
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time spent waiting for a pooled connection.")
+SERIALIZATION_SECONDS = Histogram("response_serialization_seconds", "Time to encode a JSON response body.")
+WRITE_QUEUE_FLUSH_SECONDS = Histogram("message_write_queue_flush_seconds", "Time to insert one write-behind batch.")
+WRITE_QUEUE_BATCH_ROWS = Histogram("message_write_queue_batch_rows", "Messages per write-behind batch.", (), ROW_BUCKETS)
+WRITE_QUEUE_LAG_SECONDS = Histogram("message_write_queue_lag_seconds", "Time from accepting a message to its batch being committed.")
+
+
+def _gauges(prefix: str, values: dict) -> list:
+    lines = []
+    for key, value in values.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            lines.extend(_gauges(name, value))
+        elif isinstance(value, (int, float)):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {float(value)}")
+    return lines
+
+
+def render(gauges: dict = None) -> str:
+    """
+
+    :param gauges: {prefix: stats dict} read at scrape time, e.g. {"db_pool": database.get_metrics()}.
+        Nested dicts are flattened into prefix_key_subkey.
+    :return: All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for prefix, values in (gauges or {}).items():
+        lines.extend(_gauges(prefix, values))
+    return "\n".join(lines) + "\n"
+
+
+def instrumented(name: str):
+    """
+
+    Decorator for async data-service methods (coroutines or async generators): queries issued while
+    the method runs are tagged with operation name.
+    """
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def generator(*args, **kwargs):
+                iterator = func(*args, **kwargs)
+                try:
+                    while True:
+                        # Set around each step only, so the tag doesn't leak into the consumer.
+                        token = operation.set(name)
+                        try:
+                            item = await iterator.__anext__()
+                        except StopAsyncIteration:
+                            return
+                        finally:
+                            operation.reset(token)
+                        yield item
+                finally:
+                    await iterator.aclose()
+            return generator
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = operation.set(name)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                operation.reset(token)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware():
+    """
+
+    ASGI middleware that records http_request_duration_seconds for every HTTP request, labelled
+    with the route template (/api/messages/{userID}) rather than the path, so the label set stays
+    bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _route(scope) -> str:
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+        # Plain Starlette routes (e.g. /graphql) don't record themselves in the scope.
+        app = scope.get("app")
+        for route in getattr(app, "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], self._route(scope), status)
@@ -0,0 +1,37 @@
+#
+# Opaque keyset (seek) cursors. A cursor is the sort key of the last row of a page, so the
+# next page is "rows after this key" and costs the same no matter how deep it is.
+#
+import base64
+import json
+from datetime import datetime
+
+
+def encode_cursor(*key) -> str:
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in key]
+    types = ["dt" if isinstance(v, datetime) else "" for v in key]
+    raw = json.dumps({"k": values, "t": types}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, shape: tuple) -> tuple:
+    """
+
+    :param cursor: A cursor produced by encode_cursor.
+    :param shape: The types of the sort key, e.g. (datetime, int).
+    :return: The sort key it was built from.
+    :raises ValueError: if the cursor is malformed or its key doesn't have that shape.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        values, types = data["k"], data["t"]
+        if len(values) != len(shape) or types != ["dt" if kind is datetime else "" for kind in shape]:
+            raise ValueError("Cursor has the wrong shape")
+        key = tuple(datetime.fromisoformat(v) if kind is datetime else v for v, kind in zip(values, shape))
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    # JSON has no int type of its own: 1.5, "1" and true all decode without complaint.
+    if not all(type(v) is kind for v, kind in zip(key, shape)):
+        raise ValueError("Invalid cursor")
+    return key
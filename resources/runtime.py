@@ -0,0 +1,76 @@
+#
+# Process and connection sizing for production. gunicorn.conf.py starts worker_count() uvicorn
+# workers, and every worker sizes its connection pool with pool_max() in main.lifespan, so that
+# all workers of all instances together stay under the Cloud SQL connection limit. Each worker also
+# opens a pool to every read replica, sized separately with replica_pool_max() against the
+# replica's own limit. Everything can be overridden through the environment (app.yaml
+# env_variables).
+#
+import os
+
+
+# max_connections of the Cloud SQL instance, and how many of them to leave for migrations,
+# admin sessions and instances that are still draining during a deploy.
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 100))
+DB_RESERVED_CONNECTIONS = int(os.environ.get("DB_RESERVED_CONNECTIONS", 10))
+# Instances that may run at once and share the budget: automatic_scaling.max_instances in app.yaml.
+DB_MAX_INSTANCES = int(os.environ.get("DB_MAX_INSTANCES", 1))
+# max_connections of each read replica (DB_REPLICA_DSNS in main.py); the same reserve is kept.
+DB_REPLICA_MAX_CONNECTIONS = int(os.environ.get("DB_REPLICA_MAX_CONNECTIONS", DB_MAX_CONNECTIONS))
+# Upper bound for one worker's pool, however large the budget.
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+# Connections a worker holds outside its pool: MessageEventBroker's LISTEN session.
+WORKER_EXTRA_CONNECTIONS = 1
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def worker_count() -> int:
+    """
+
+    WEB_CONCURRENCY if set, otherwise one worker per available core. Handlers are async, so a
+    single event loop keeps a core busy; more workers than cores only adds connections.
+    """
+    value = os.environ.get("WEB_CONCURRENCY")
+    if value:
+        return max(1, int(value))
+    return available_cores()
+
+
+def _pool_size(max_connections: int, extra: int, workers: int, instances: int) -> int:
+    workers = workers or worker_count()
+    instances = instances or DB_MAX_INSTANCES
+    budget = (max_connections - DB_RESERVED_CONNECTIONS) // (workers * instances) - extra
+    if budget < 1:
+        # Even one connection per worker would go over the limit; better to fail at startup than
+        # to have connections refused under load.
+        raise ValueError(f"{workers} workers on {instances} instances need at least {workers * instances * (1 + extra)} "
+                         f"connections, but only {max_connections - DB_RESERVED_CONNECTIONS} of {max_connections} are available")
+    return min(DB_POOL_MAX, budget)
+
+
+def pool_max(workers: int = None, instances: int = None) -> int:
+    """
+
+    :param workers: Number of worker processes per instance; defaults to worker_count().
+    :param instances: Number of instances sharing the database; defaults to DB_MAX_INSTANCES.
+    :return: The largest per-worker pool for which every worker's pool plus its extra connections,
+        on every instance, fit into DB_MAX_CONNECTIONS - DB_RESERVED_CONNECTIONS, capped at
+        DB_POOL_MAX.
+    :raises ValueError: if not even a pool of one fits.
+    """
+    return _pool_size(DB_MAX_CONNECTIONS, WORKER_EXTRA_CONNECTIONS, workers, instances)
+
+
+def replica_pool_max(workers: int = None, instances: int = None) -> int:
+    """
+
+    Like pool_max, for the pool every worker keeps to each read replica: against
+    DB_REPLICA_MAX_CONNECTIONS, and with no extra connections, since LISTEN runs on the primary.
+    """
+    return _pool_size(DB_REPLICA_MAX_CONNECTIONS, 0, workers, instances)
@@ -0,0 +1,26 @@
+#
+# Encoders that turn an async iterator of row batches into response body chunks for a
+# StreamingResponse. Each batch becomes one chunk, so the first rows go out before the last
+# ones are read. Rows are encoded with orjson, which writes datetimes as ISO-8601.
+#
+import orjson
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def ndjson_stream(batches):
+    async for batch in batches:
+        yield b"".join(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in batch)
+
+
+async def json_array_stream(batches):
+    first = True
+    yield b"["
+    async for batch in batches:
+        if not batch:
+            continue
+        chunk = b",".join(orjson.dumps(row) for row in batch)
+        yield chunk if first else b"," + chunk
+        first = False
+    yield b"]"
@@ -0,0 +1,184 @@
+from resources.abstract_base_data_service import BaseDataService
+from resources.database.async_database_data_service import AsyncDatabaseDataService
+from resources.database.memory_database_data_service import MemoryDatabaseDataService, IntegrityError, now
+from resources.database.routing_database_data_service import primary_reads, reads_as_user, writes_as_user
+from resources.metrics import instrumented
+from bisect import bisect_right
+from datetime import datetime
+
+
+def _legacy(column: str) -> str:
+    # The legacy "MM/DD/YYYY, HH:MM:SS" string, rendered by Postgres as for messages.
+    return f"""to_char({column}, 'MM/DD/YYYY, HH24:MI:SS')"""
+
+
+class ThreadDataService(BaseDataService):
+    """
+
+    Inbox summaries read from "messageThread" and "threadParticipants", which a trigger on
+    "userMessages" keeps current (see migration 4). Holds the queries AsyncThreadDataService runs;
+    nothing here talks to a database.
+    """
+
+    @staticmethod
+    def _get_threads_query(userID: int, limit: int) -> tuple:
+        query = f"""SELECT t.\"messageID\", t.\"messageCount\", t.\"lastUserMessageID\",
+        {_legacy('t."lastMessageDT"')} AS \"lastMessageDT\", {_legacy('p."lastReadDT"')} AS \"lastReadDT\",
+        ARRAY(SELECT q.\"userID\" FROM \"threadParticipants\" q WHERE q.\"messageID\" = t.\"messageID\" AND q.\"messageCount\" > 0 ORDER BY q.\"userID\") AS \"participants\",
+        (SELECT count(*) FROM \"userMessages\" m WHERE m.\"messageID\" = t.\"messageID\" AND m.\"userID\" <> p.\"userID\"
+            AND (p.\"lastReadDT\" IS NULL OR m.\"creationDT\" > p.\"lastReadDT\")) AS \"unreadCount\"
+        FROM \"threadParticipants\" p JOIN \"messageThread\" t ON t.\"messageID\" = p.\"messageID\"
+        WHERE p.\"userID\" = %s
+        ORDER BY t.\"lastMessageDT\" DESC NULLS LAST, t.\"messageID\" DESC"""
+        values = [userID]
+        if limit is not None:
+            query += " LIMIT %s"
+            values.append(limit)
+        query += ";"
+
+        return query, tuple(values)
+
+    @staticmethod
+    def _mark_read_query(userID: int, messageThreadID: int) -> tuple:
+        return """INSERT INTO \"threadParticipants\" (\"messageID\", \"userID\", \"lastReadDT\")
+        SELECT \"messageID\", %s, CURRENT_TIMESTAMP FROM \"messageThread\" WHERE \"messageID\" = %s
+        ON CONFLICT (\"messageID\", \"userID\") DO UPDATE SET \"lastReadDT\" = EXCLUDED.\"lastReadDT\"
+        RETURNING \"messageID\"""", (userID, messageThreadID)
+
+    @staticmethod
+    def _get_thread_version_query(messageThreadID: int) -> tuple:
+        return """SELECT \"messageID\", \"messageCount\", \"lastUserMessageID\", \"lastMessageDT\" FROM \"messageThread\" WHERE \"messageID\" = %s;""", (messageThreadID,)
+
+
+class AsyncThreadDataService(ThreadDataService):
+    """
+
+    Same queries as ThreadDataService, awaited on an AsyncDatabaseDataService.
+    """
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary of configuration parameters. If it has a "database" entry, that
+            AsyncDatabaseDataService (and its pool) is shared instead of creating a new one.
+        """
+        BaseDataService.__init__(self)
+
+        self.database = config.get("database") or AsyncDatabaseDataService(config)
+
+    async def open(self):
+        await self.database.open()
+
+    async def close(self):
+        await self.database.close()
+
+    @instrumented("get_thread_version")
+    async def get_thread_version(self, messageThreadID: int) -> dict:
+        """
+
+        Returns the thread's summary columns, which change with every message added, updated or
+        deleted in it (updates move creationDT to now), so they identify a version of the thread
+        without reading its messages.
+
+        Read from the primary: the version decides whether a client's copy is current, and a
+        lagging replica would confirm a copy that is already stale (a 304 right after a post).
+
+        :return: {"messageID", "messageCount", "lastUserMessageID", "lastMessageDT"}, or None if the
+            thread doesn't exist.
+        """
+        with primary_reads():
+            rows = await self.database.fetchallquery(*self._get_thread_version_query(messageThreadID))
+
+        return rows[0] if rows else None
+
+    @instrumented("get_threads")
+    @reads_as_user
+    async def get_threads(self, userID: int, limit: int) -> list:
+        """
+
+        Returns the user's threads, most recently active first, with message count, last message,
+        participants and the number of messages from others since the user last read the thread.
+
+        :param userID: User whose inbox to return.
+        :param limit: Maximum number of threads, or None for all.
+        """
+        return await self.database.fetchallquery(*self._get_threads_query(userID, limit))
+
+    @instrumented("mark_read")
+    @writes_as_user
+    async def mark_read(self, userID: int, messageThreadID: int) -> list:
+        """
+
+        Sets the user's read marker on a thread to now.
+
+        :return: (messageID,) or None if the thread doesn't exist.
+        """
+        return await self.database.fetchonequery(*self._mark_read_query(userID, messageThreadID))
+
+
+class MemoryThreadDataService(BaseDataService):
+    """
+
+    Same interface and results as AsyncThreadDataService, answered from a MemoryDatabaseDataService.
+    """
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary of configuration parameters. If it has a "database" entry, that
+            MemoryDatabaseDataService is shared instead of creating a new one.
+        """
+        super().__init__()
+
+        self.database = config.get("database") or MemoryDatabaseDataService(config)
+
+    async def open(self):
+        await self.database.open()
+
+    async def close(self):
+        await self.database.close()
+
+    def _unread(self, messageID: int, userID: int, lastReadDT) -> int:
+        keys = self.database.thread_keys[messageID]
+        start = bisect_right(keys, (lastReadDT, float("inf"))) if lastReadDT is not None else 0
+        return sum(1 for _, userMessageID in keys[start:] if self.database.messages[userMessageID]["userID"] != userID)
+
+    async def get_thread_version(self, messageThreadID: int) -> dict:
+        if messageThreadID not in self.database.threads:
+            return None
+
+        return self.database.thread_summary(messageThreadID)
+
+    @staticmethod
+    def _format(thread: dict) -> dict:
+        for column in ('lastMessageDT', 'lastReadDT'):
+            if thread[column] is not None:
+                thread[column] = thread[column].strftime("%m/%d/%Y, %H:%M:%S")
+        return thread
+
+    async def get_threads(self, userID: int, limit: int) -> list:
+        threads = []
+        for messageID, participants in self.database.participants.items():
+            if userID not in participants:
+                continue
+            lastReadDT = participants[userID]["lastReadDT"]
+            threads.append({
+                **self.database.thread_summary(messageID),
+                "lastReadDT": lastReadDT,
+                "participants": sorted(u for u, p in participants.items() if p["messageCount"] > 0),
+                "unreadCount": self._unread(messageID, userID, lastReadDT),
+            })
+        # lastMessageDT DESC NULLS LAST, messageID DESC
+        threads.sort(key=lambda s: (s["lastMessageDT"] is not None, s["lastMessageDT"] or datetime.min, s["messageID"]), reverse=True)
+
+        return [self._format(s) for s in (threads[:limit] if limit is not None else threads)]
+
+    async def mark_read(self, userID: int, messageThreadID: int) -> list:
+        if messageThreadID not in self.database.threads:
+            return None
+        if userID not in self.database.users:
+            raise IntegrityError(f"userID {userID} does not exist")
+        participant = self.database.participants[messageThreadID].setdefault(userID, {"messageCount": 0, "lastReadDT": None})
+        participant["lastReadDT"] = now()
+
+        return (messageThreadID,)
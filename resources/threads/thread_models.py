@@ -0,0 +1,35 @@
+from __future__ import annotations
+from pydantic import BaseModel
+from typing import List
+
+from resources.rest_models import Link
+
+
+class ThreadSummaryModel(BaseModel):
+    messageID: int
+    messageCount: int
+    lastUserMessageID: int | None
+    lastMessageDT: str | None
+    lastReadDT: str | None
+    participants: List[int]
+    unreadCount: int
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "messageID": 1,
+                    "messageCount": 12,
+                    "lastUserMessageID": 40,
+                    "lastMessageDT": "10/03/2023, 16:25:00",
+                    "lastReadDT": "10/03/2023, 16:20:12",
+                    "participants": [1, 2],
+                    "unreadCount": 1
+                }
+            ]
+        }
+    }
+
+
+class ThreadSummaryRspModel(ThreadSummaryModel):
+    links: List[Link] = None
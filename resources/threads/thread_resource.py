@@ -0,0 +1,39 @@
+from resources.abstract_base_resource import BaseResource
+from resources.threads.thread_models import ThreadSummaryRspModel
+from typing import List
+
+
+class ThreadResource(BaseResource):
+
+    def __init__(self, config):
+        super().__init__()
+
+        self.data_service = config["data_service"]
+
+    async def get_threads(self, userID: int, limit: int) -> List[ThreadSummaryRspModel]:
+
+        result = await self.data_service.get_threads(userID, limit)
+
+        return result
+
+    async def mark_read(self, userID: int, messageThreadID: int) -> list:
+
+        result = await self.data_service.mark_read(userID, messageThreadID)
+
+        return result
+
+    @staticmethod
+    def _etag(version: dict) -> str:
+        last = version["lastMessageDT"].isoformat() if version["lastMessageDT"] is not None else ""
+        # Weak: every representation of the same thread version (window, timestamps) shares it.
+        return f'W/"{version["messageID"]}-{version["messageCount"]}-{version["lastUserMessageID"]}-{last}"'
+
+    async def get_etag(self, messageThreadID: int) -> str:
+        """
+
+        Returns an ETag for the thread's current contents, from its summary row alone, or None if
+        the thread doesn't exist.
+        """
+        version = await self.data_service.get_thread_version(messageThreadID)
+
+        return self._etag(version) if version is not None else None
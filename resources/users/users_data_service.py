@@ -1,46 +1,96 @@
 from resources.abstract_base_data_service import BaseDataService
-from resources.database.database_data_service import DatabaseDataService
-import json
+from resources.database.async_database_data_service import AsyncDatabaseDataService
+from resources.database.memory_database_data_service import MemoryDatabaseDataService
+from resources.database.routing_database_data_service import primary_reads, writes_as_user
+from resources.messages.message_data_service import MESSAGE_CHANNEL
+from resources.metrics import instrumented
+from resources.database.query_builder import where, select_statement
+from resources.pagination import encode_cursor, decode_cursor
+from bisect import bisect_right
+
+
+# Named rather than *, so prepared statements keep their result shape across schema changes.
+USER_COLUMNS = """\"userID\", \"firstName\", \"lastName\", \"isAdmin\""""
+# Keyset of user pages: ("userID",).
+USER_CURSOR = (int,)
+
+
+def _with_notify(statement: str, op: str) -> str:
+    # Announced on MESSAGE_CHANNEL (with no thread) so every worker's CachedUserDataService hears it.
+    return f"""WITH changed AS ({statement} RETURNING \"userID\") SELECT changed.\"userID\" FROM changed CROSS JOIN LATERAL (SELECT pg_notify('{MESSAGE_CHANNEL}', json_build_object('op', '{op}', 'userMessageID', NULL, 'userID', changed.\"userID\", 'messageID', NULL)::text)) notified"""
 
 
 class UserDataService(BaseDataService):
+    """
 
-    def __init__(self, config: dict):
-        """
+    Queries and result shaping shared by the Postgres data services; AsyncUserDataService runs
+    them. Nothing here talks to a database.
+    """
 
-        :param config: A dictionary of configuration parameters.
-        """
-        super().__init__()
+    def _get_users_query(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int, cursor: str = None) -> tuple:
+        conditions, values = where(
+            ("""\"userID\" = %s""", userID),
+            ("""\"firstName\" = %s""", firstName),
+            ("""\"lastName\" = %s""", lastName),
+            ("""\"isAdmin\" = %s""", isAdmin),
+        )
+        if cursor is not None:
+            conditions += ("""\"userID\" > %s""",)
+            values.extend(decode_cursor(cursor, USER_CURSOR))
+
+        paged = cursor is not None or offset is not None or limit is not None
+        query = select_statement("messageUsers", USER_COLUMNS, conditions,
+                                 """\"userID\"""" if paged else None,
+                                 limit is not None, offset is not None)
+        values.extend(value for value in (limit, offset) if value is not None)
+
+        return query, tuple(values)
 
-        #self.data_dir = config['data_directory']
-        #self.data_file = config["data_file"]
-        #self.students = []
+    @staticmethod
+    def _page(users: list, limit: int) -> dict:
+        cursors = [encode_cursor(s['userID']) for s in users]
+        next_cursor = cursors[-1] if limit is not None and cursors and len(users) == limit else None
 
-        self.database = DatabaseDataService(config)
-        self._load()
+        return {"items": users, "cursors": cursors, "next_cursor": next_cursor}
 
-    def _load(self):
+    @staticmethod
+    def _get_users_by_ids_query(userIDs: list) -> tuple:
+        return f"""SELECT {USER_COLUMNS} FROM \"messageUsers\" WHERE \"userID\" = ANY(%s);""", (list(userIDs),)
 
-        users = """CREATE TABLE IF NOT EXISTS "messageUsers" (
-        "userID" serial,
-        "firstName" text,
-        "lastName" text,
-        "isAdmin" boolean,
-        PRIMARY KEY ("userID")
-        );"""
-        
-        self.database.execute_query(users)
+    @staticmethod
+    def _add_user_query(request) -> tuple:
+        return _with_notify("""INSERT INTO \"messageUsers\" (\"userID\", \"firstName\", \"lastName\", \"isAdmin\") VALUES (DEFAULT, %s, %s, %s)""", "user_added"), (request.firstName, request.lastName, request.isAdmin)
+
+    @staticmethod
+    def _delete_user_query(request) -> tuple:
+        return _with_notify("DELETE FROM \"messageUsers\" WHERE \"userID\" = %s", "user_deleted"), (request.userID,)
+
+
+class AsyncUserDataService(UserDataService):
+    """
+
+    Same queries as UserDataService, awaited on an AsyncDatabaseDataService so route handlers
+    do not block the event loop. Call open() before first use.
+    """
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary of configuration parameters. If it has a "database" entry, that
+            AsyncDatabaseDataService (and its pool) is shared instead of creating a new one.
+        """
+        BaseDataService.__init__(self)
 
+        self.database = config.get("database") or AsyncDatabaseDataService(config)
 
-    def _save(self):
-        fn = self._get_data_file_name()
-        with open(fn, "w") as out_file:
-            json.dump(self.students, out_file)
+    async def open(self):
+        await self.database.open()
 
-    def get_database(self):
-        return self.database
+    async def close(self):
+        await self.database.close()
 
-    def get_users(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int) -> list:
+    @instrumented("get_users")
+    async def get_users(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int) -> list:
         """
 
         Returns users with properties matching the values. Only non-None parameters apply to
@@ -49,29 +99,36 @@ class UserDataService(BaseDataService):
         :param userID: userID to match.
         :return: A list of matching JSON records.
         """
-        result = []
-        users = {}
-        # Define a list of parameters and their values
-        params = ["""\"userID\"""", """\"firstName\"""", """\"lastName\"""", """\"isAdmin\"""", """\"offset\"""", """\"limit\""""]
-        values = [userID, firstName, lastName, isAdmin, offset, limit]
-
-        query = """SELECT * FROM "messageUsers" """
-        conditions = []
-        for param, value in zip(params, values):
-            if value is not None:
-                conditions.append(f"{param} = %s")
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-        query += ";"
-
-        
-        users = self.database.fetchallquery(query, tuple(value for value in values if value is not None))
-        for s in users:
-            result.append(s)
+        query, values = self._get_users_query(userID, firstName, lastName, isAdmin, offset, limit)
+        return await self.database.fetchallquery(query, values)
 
-        return result
-    
-    def add_user(self, request: dict) -> list:
+    @instrumented("get_users_page")
+    async def get_users_page(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int, cursor: str) -> dict:
+        """
+
+        Like get_users, but returns one page ordered by userID together with a keyset cursor
+        per row and the cursor to pass back for the next page (None on the last page).
+
+        :param cursor: next_cursor of the previous page, or None for the first page.
+        :return: {"items": [...], "cursors": [...], "next_cursor": str}
+        """
+        query, values = self._get_users_query(userID, firstName, lastName, isAdmin, offset, limit, cursor)
+
+        return self._page(await self.database.fetchallquery(query, values), limit)
+
+    @instrumented("get_users_by_ids")
+    async def get_users_by_ids(self, userIDs: list) -> list:
+        """
+
+        Returns the users with any of the given userIDs in a single query, in no particular order.
+
+        :param userIDs: userIDs to fetch.
+        """
+        return await self.database.fetchallquery(*self._get_users_by_ids_query(userIDs))
+
+    @instrumented("add_user")
+    @writes_as_user
+    async def add_user(self, request: dict) -> list:
         """
 
         Adds students with properties matching the values. Only non-None parameters apply to
@@ -80,20 +137,155 @@ class UserDataService(BaseDataService):
         :param request: A dictionary of the UserModel
         :return: userID of the newly created user.
         """
-    
-        users = self.database.execute_query("""INSERT INTO \"messageUsers\" (\"userID\", \"firstName\", \"lastName\", \"isAdmin\") VALUES (DEFAULT, %s, %s, %s) RETURNING \"userID\"""", (request.firstName, request.lastName, request.isAdmin))
-        result = users.fetchone()
+        return await self.database.fetchonequery(*self._add_user_query(request))
 
-        return result
-
-    def delete_user(self, request: dict) -> list:
+    @instrumented("delete_user")
+    @writes_as_user
+    async def delete_user(self, request: dict) -> list:
         """
 
         Deletes a message from a thread.
 
         :param request: DELETE request with message ID.
         """
-        users = self.database.execute_query("DELETE FROM \"messageUsers\" WHERE \"userID\" = %s RETURNING \"userID\"", (request.userID,))
-        result = users.fetchone()
+        return await self.database.fetchonequery(*self._delete_user_query(request))
+
+
+class CachedUserDataService(BaseDataService):
+    """
+
+    Read-through cache in front of an AsyncUserDataService. Lookups by userID alone (profiles,
+    /api/users/{userID}, the GraphQL user field) are answered from cache; add_user and
+    delete_user invalidate the affected userID, in this worker right away and in the others
+    through on_event. Everything else goes straight to the wrapped service.
+    """
+
+    def __init__(self, data_service, cache):
+        super().__init__()
+
+        self.data_service = data_service
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.data_service, name)
+
+    @staticmethod
+    def _key(userID: int) -> str:
+        return f"user:{userID}"
+
+    def get_cache_stats(self) -> dict:
+        return self.cache.get_stats()
+
+    def on_event(self, event: dict):
+        """
+
+        MessageEventBroker watcher: forgets users added or deleted by any worker, or every cached
+        user if events may have been missed. Only the in-process tier needs it; a shared tier was
+        already updated by the worker that wrote.
+        """
+        local = getattr(self.cache, "local", self.cache)
+        if not hasattr(local, "delete_sync"):
+            return
+        if event is None:
+            local.clear_sync()
+        elif event["op"] in ("user_added", "user_deleted"):
+            local.delete_sync(self._key(event["userID"]))
+
+    async def get_users(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int) -> list:
+        if userID is None or any(v is not None for v in (firstName, lastName, isAdmin, offset, limit)):
+            return await self.data_service.get_users(userID, firstName, lastName, isAdmin, offset, limit)
+
+        key = self._key(userID)
+        result = await self.cache.get(key)
+        if result is None:
+            # From the primary: a lagging replica would cache a deleted user again after the NOTIFY
+            # dropped it, or cache "no such user" for one just added.
+            with primary_reads():
+                result = await self.data_service.get_users(userID, None, None, None, None, None)
+            await self.cache.set(key, result)
+
+        # Callers add links to the rows they get, which must not end up in the cached ones.
+        return [dict(s) for s in result]
+
+    async def add_user(self, request: dict) -> list:
+        result = await self.data_service.add_user(request)
+        # A miss for the new userID may have been cached before the insert.
+        if result:
+            await self.cache.delete(self._key(result[0]))
+
+        return result
+
+    async def delete_user(self, request: dict) -> list:
+        result = await self.data_service.delete_user(request)
+        await self.cache.delete(self._key(request.userID))
 
         return result
+
+
+class MemoryUserDataService(BaseDataService):
+    """
+
+    Same interface and results as AsyncUserDataService, answered from a MemoryDatabaseDataService.
+    """
+
+    def __init__(self, config: dict):
+        """
+
+        :param config: A dictionary of configuration parameters. If it has a "database" entry, that
+            MemoryDatabaseDataService is shared instead of creating a new one.
+        """
+        super().__init__()
+
+        self.database = config.get("database") or MemoryDatabaseDataService(config)
+
+    async def open(self):
+        await self.database.open()
+
+    async def close(self):
+        await self.database.close()
+
+    def _query(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int, cursor: str = None) -> list:
+        if userID is not None:
+            userIDs = [userID] if userID in self.database.users else []
+        else:
+            userIDs = self.database.user_ids
+        if cursor is not None:
+            userIDs = userIDs[bisect_right(userIDs, *decode_cursor(cursor, USER_CURSOR)):]
+
+        users = []
+        for i in userIDs:
+            s = self.database.users[i]
+            if all(value is None or s[column] == value for column, value in (("firstName", firstName), ("lastName", lastName), ("isAdmin", isAdmin))):
+                users.append(dict(s))
+        start = offset or 0
+        return users[start:start + limit if limit is not None else None]
+
+    def _notify(self, op: str, userID: int):
+        self.database.notify(MESSAGE_CHANNEL, {"op": op, "userMessageID": None, "userID": userID, "messageID": None})
+
+    async def get_users(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int) -> list:
+        return self._query(userID, firstName, lastName, isAdmin, offset, limit)
+
+    async def get_users_page(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int, cursor: str) -> dict:
+        return UserDataService._page(self._query(userID, firstName, lastName, isAdmin, offset, limit, cursor), limit)
+
+    async def get_users_by_ids(self, userIDs: list) -> list:
+        return [dict(self.database.users[i]) for i in set(userIDs) if i in self.database.users]
+
+    async def add_user(self, request: dict) -> list:
+        row = self.database.insert_user({
+            "userID": self.database.next_id("userID"),
+            "firstName": request.firstName,
+            "lastName": request.lastName,
+            "isAdmin": request.isAdmin,
+        })
+        self._notify("user_added", row["userID"])
+
+        return (row["userID"],)
+
+    async def delete_user(self, request: dict) -> list:
+        row = self.database.delete_user(request.userID)
+        if row is not None:
+            self._notify("user_deleted", row["userID"])
+
+        return (row["userID"],) if row is not None else None
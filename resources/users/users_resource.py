@@ -1,9 +1,14 @@
 from resources.abstract_base_resource import BaseResource
 from resources.users.users_models import UserRspModel, UserModel
-from resources.rest_models import Link
 from typing import List
 
 
+LINK_TEMPLATES = (
+    ("self", "/api/users/{userID}"),
+    ("messages", "/api/messages/{userID}"),
+)
+
+
 class UserResource(BaseResource):
     #
     # This code is just to get us started.
@@ -16,39 +21,44 @@ class UserResource(BaseResource):
         self.data_service = config["data_service"]
 
     @staticmethod
-    def _generate_links(s: dict) -> UserRspModel:
-
-        self_link = Link(**{
-            "rel": "self",
-            "href": "/users/" + str(s['userID'])
-        })
+    def _generate_links(s: dict) -> dict:
+        # Rows come straight from Postgres and are already typed, so the links are filled in from
+        # LINK_TEMPLATES on the dict itself instead of building Link / UserRspModel objects per row.
+        s["links"] = [{"rel": rel, "href": href.format_map(s)} for rel, href in LINK_TEMPLATES]
+        return s
 
-        links = [
-            self_link
-        ]
-        rsp = UserRspModel(**s, links=links)
-        return rsp
+    async def get_users(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int) -> List[UserRspModel]:
 
-    def get_users(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int) -> List[UserRspModel]:
-
-        result = self.data_service.get_users(userID, firstName, lastName, isAdmin, offset, limit)
+        result = await self.data_service.get_users(userID, firstName, lastName, isAdmin, offset, limit)
         final_result = []
 
         for s in result:
-            #m = self._generate_links(s)
-            #final_result.append(m)
-            final_result.append(s)
+            final_result.append(self._generate_links(s))
 
         return final_result
+
+    async def get_users_page(self, userID: int, firstName: str, lastName: str, isAdmin: bool, offset: int, limit: int, cursor: str) -> dict:
+
+        result = await self.data_service.get_users_page(userID, firstName, lastName, isAdmin, offset, limit, cursor)
+        for s in result["items"]:
+            self._generate_links(s)
+
+        return result
+    
+    async def get_users_by_ids(self, userIDs: list) -> List[UserRspModel]:
+
+        result = await self.data_service.get_users_by_ids(userIDs)
+
+        return result
     
-    def add_user(self, request: UserModel) -> List[UserRspModel]:
+    async def add_user(self, request: UserModel) -> List[UserRspModel]:
 
-        result = self.data_service.add_user(request)
+        result = await self.data_service.add_user(request)
 
         return result
     
-    def delete_user(self, request: UserModel) -> List[UserRspModel]:
+    async def delete_user(self, request: UserModel) -> List[UserRspModel]:
 
-        result = self.data_service.delete_user(request)
+        result = await self.data_service.delete_user(request)
 
         return result
@@ -0,0 +1,45 @@
+#
+# The app on the in-memory backend (DATA_BACKEND = "memory"), so the tests need no database.
+#
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "DATA_BACKEND", "memory")
+    monkeypatch.setattr(main, "WRITE_QUEUE_JOURNAL_DIR", str(tmp_path / "journal"))
+    monkeypatch.setattr(main, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    with TestClient(main.app) as client:
+        yield client
+
+
+def add_user(client, userID: int, firstName: str = "Ada"):
+    response = client.post("/api/users/newUser", json={"userID": userID, "firstName": firstName, "lastName": "Lovelace", "isAdmin": False})
+    assert response.status_code == 200
+    return response.json()
+
+
+def add_message(client, userID: int, messageID: int, messageContents: str):
+    response = client.post("/api/messages/newMessage", json={"userMessageID": 0, "userID": userID, "messageID": messageID, "messageContents": messageContents})
+    assert response.status_code == 200
+    return response.json()
+
+
+class FakeDatabase():
+    """
+
+    Stands in for one Postgres server behind RoutingDatabaseDataService: every read returns its
+    name, so a test can tell where a query went.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def fetchallquery(self, query: str = None, params: () = None):
+        return [self.name]
+
+    async def fetchonequery(self, query: str = None, params: () = None):
+        return self.name
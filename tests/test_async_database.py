@@ -0,0 +1,68 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+from resources.database.async_database_data_service import AsyncDatabaseDataService
+
+
+class FakeCursor():
+
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.description = [SimpleNamespace(name="userMessageID")]
+
+    async def execute(self, query, params=None):
+        pass
+
+    async def fetchmany(self, size: int):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+class FakeConnection():
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    @asynccontextmanager
+    async def cursor(self, name: str = None):
+        yield FakeCursor(self.rows)
+
+
+def database(rows: list) -> AsyncDatabaseDataService:
+    database = AsyncDatabaseDataService({"db_dsn": "postgresql://primary"})
+    database.observed = []
+
+    @asynccontextmanager
+    async def connection():
+        yield FakeConnection(rows)
+    database._connection = connection
+    database._observe = lambda query, elapsed, rows: database.observed.append((query, rows))
+    return database
+
+
+def test_stream_is_observed_once_with_all_its_rows():
+    db = database([(i,) for i in range(5)])
+
+    async def run():
+        return [batch async for batch in db.streamquery("SELECT", None, 2)]
+    batches = asyncio.run(run())
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert db.observed == [("SELECT", 5)]
+
+
+def test_stream_closed_early_is_observed_with_the_rows_sent():
+    db = database([(i,) for i in range(5)])
+
+    async def run():
+        stream = db.streamquery("SELECT", None, 2)
+        await stream.__anext__()
+        await stream.aclose()
+    asyncio.run(run())
+
+    assert db.observed == [("SELECT", 2)]
@@ -0,0 +1,25 @@
+import asyncio
+import json
+
+from benchmarks.run import call
+
+
+def app_returning(status: int, body: dict):
+    async def app(scope, receive, send):
+        await receive()
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": json.dumps(body).encode()})
+    return app
+
+
+def test_graphql_errors_count_as_failures():
+    failing = app_returning(200, {"data": {"user": None}, "errors": [{"message": "boom"}]})
+    working = app_returning(200, {"data": {"user": None}})
+
+    assert asyncio.run(call(failing, "POST", "/graphql", b"{}"))[2] is True
+    assert asyncio.run(call(working, "POST", "/graphql", b"{}"))[2] is False
+
+
+def test_http_status_decides_for_rest():
+    assert asyncio.run(call(app_returning(404, {}), "GET", "/api/users/1"))[2] is True
+    assert asyncio.run(call(app_returning(200, {"errors": ["not graphql"]}), "GET", "/api/users/1"))[2] is False
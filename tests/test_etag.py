@@ -0,0 +1,38 @@
+import asyncio
+
+from conftest import FakeDatabase, add_message, add_user
+from resources.database.routing_database_data_service import RoutingDatabaseDataService
+from resources.threads.thread_data_service import AsyncThreadDataService
+
+
+def test_conversation_is_not_modified_until_the_thread_changes(client):
+    add_user(client, 1)
+    add_message(client, 1, 7, "hello")
+
+    response = client.get("/api/threads/7/messages")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get("/api/threads/7/messages", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    add_message(client, 1, 7, "again")
+    response = client.get("/api/threads/7/messages", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert [m["messageContents"] for m in response.json()] == ["hello", "again"]
+
+
+def test_unknown_thread_has_no_etag(client):
+    assert client.get("/api/threads/7/messages").status_code == 404
+
+
+def test_thread_version_is_read_from_the_primary():
+    database = RoutingDatabaseDataService({"db_dsn": "postgresql://primary", "db_replica_dsns": ["postgresql://replica"]})
+    database.primary = FakeDatabase("primary")
+    database.replicas[0].database = FakeDatabase("replica")
+    threads = AsyncThreadDataService({"database": database})
+
+    assert asyncio.run(database.fetchallquery("SELECT 1")) == ["replica"]
+    assert asyncio.run(threads.get_thread_version(7)) == "primary"
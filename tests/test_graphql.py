@@ -0,0 +1,46 @@
+from conftest import add_message, add_user
+
+
+def graphql(client, query: str) -> dict:
+    response = client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    body = response.json()
+    assert not body.get("errors"), body["errors"]
+    return body["data"]
+
+
+def test_user_with_messages(client):
+    add_user(client, 1, "Ada")
+    add_message(client, 1, 1, "hello")
+
+    data = graphql(client, "{ user(userID: 1) { userID firstName messages { messageContents } } }")
+
+    assert data["user"] == {"userID": 1, "firstName": "Ada", "messages": [{"messageContents": "hello"}]}
+
+
+def test_unknown_user_is_null(client):
+    assert graphql(client, "{ user(userID: 99) { userID } }") == {"user": None}
+
+
+def test_messages_with_authors_and_connection(client):
+    add_user(client, 1, "Ada")
+    for text in ("one", "two", "three"):
+        add_message(client, 1, 1, text)
+
+    data = graphql(client, "{ messages(messageThreadID: 1) { messageContents author { firstName } } }")
+    assert [m["messageContents"] for m in data["messages"]] == ["one", "two", "three"]
+    assert {m["author"]["firstName"] for m in data["messages"]} == {"Ada"}
+
+    page = graphql(client, "{ messagesConnection(first: 2) { edges { cursor node { messageContents } } pageInfo { hasNextPage endCursor } } }")["messagesConnection"]
+    assert [e["node"]["messageContents"] for e in page["edges"]] == ["one", "two"]
+    assert page["pageInfo"] == {"hasNextPage": True, "endCursor": page["edges"][-1]["cursor"]}
+
+
+def test_search_messages(client):
+    add_user(client, 1)
+    add_message(client, 1, 1, "the quick brown fox")
+    add_message(client, 1, 1, "lazy dogs")
+
+    data = graphql(client, '{ searchMessages(q: "qui") { messageContents } }')
+
+    assert data["searchMessages"] == [{"messageContents": "the quick brown fox"}]
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+
+from resources.messages.message_archive import MessageArchive
+
+
+class SlowArchive(MessageArchive):
+    """
+
+    One archived month whose second batch takes until release is set to read.
+    """
+
+    def __init__(self):
+        super().__init__("unused")
+        self.release = threading.Event()
+        self.reading = threading.Event()
+        self.closed = threading.Event()
+
+    def manifests(self) -> list:
+        return [{"from": None, "to": None}]
+
+    def _read(self, *args):
+        try:
+            yield [{"userMessageID": 1}]
+            self.reading.set()
+            self.release.wait(5)
+            yield [{"userMessageID": 2}]
+        finally:
+            self.closed.set()
+
+
+def test_cancelling_during_a_read_closes_the_file_once_the_read_returns():
+    archive = SlowArchive()
+
+    async def run():
+        stream = archive.stream_messages(None, None, None)
+        assert await stream.__anext__() == [{"userMessageID": 1}]
+        task = asyncio.create_task(stream.__anext__())
+        await asyncio.to_thread(archive.reading.wait, 5)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert not archive.closed.is_set()
+
+        archive.release.set()
+        await asyncio.to_thread(archive.closed.wait, 5)
+    asyncio.run(run())
+
+    assert archive.closed.is_set()
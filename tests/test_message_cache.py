@@ -0,0 +1,72 @@
+import time
+
+import main
+from conftest import add_message, add_user
+from resources.messages.message_cache import MessageResponseCache
+from resources.messages.message_data_service import MemoryMessageDataService
+from resources.messages.message_models import MessageModel
+
+
+def contents(client, messageThreadID: int) -> list:
+    return [m["messageContents"] for m in client.get(f"/api/threads/{messageThreadID}/messages").json()]
+
+
+def test_fill_read_before_an_invalidation_is_not_stored():
+    cache = MessageResponseCache(1024)
+    generation = cache.generation(7)
+    cache.invalidate(7)
+    cache.set(7, ("conversation",), b"[]", generation)
+
+    assert cache.get(7, ("conversation",)) is None
+    assert cache.get_stats()["stale_fills"] == 1
+
+
+def test_events_drop_their_thread_or_everything():
+    cache = MessageResponseCache(1024)
+    for messageThreadID in (7, 8):
+        cache.set(messageThreadID, ("conversation",), b"[]", cache.generation(messageThreadID))
+
+    cache.on_event({"op": "user_deleted", "userMessageID": None, "userID": 1, "messageID": None})
+    cache.on_event({"op": "added", "userMessageID": 1, "userID": 1, "messageID": 7})
+    assert cache.get(7, ("conversation",)) is None
+    assert cache.get(8, ("conversation",)) == b"[]"
+
+    cache.on_event(None)
+    assert cache.get(8, ("conversation",)) is None
+
+
+def test_size_bound_evicts_least_recently_used():
+    cache = MessageResponseCache(max_bytes=10, max_entry_bytes=10)
+    for messageThreadID in (1, 2, 3):
+        cache.set(messageThreadID, (), b"1234", cache.generation(messageThreadID))
+
+    assert cache.get(1, ()) is None
+    assert cache.get_stats()["bytes"] == 8
+
+
+def test_own_write_invalidates_the_conversation(client):
+    add_user(client, 1)
+    add_message(client, 1, 7, "hello")
+    assert contents(client, 7) == ["hello"]
+    [message] = client.get("/api/threads/7/messages").json()
+    assert main.message_cache.get_stats()["hits"] == 1
+
+    body = {"userMessageID": message["userMessageID"], "userID": 1, "messageID": 7, "messageContents": "edited"}
+    response = client.put("/api/messages/newMessage", json=body)
+    assert response.status_code == 200
+    assert contents(client, 7) == ["edited"]
+
+
+def test_write_by_another_worker_invalidates_the_conversation(client):
+    add_user(client, 1)
+    add_message(client, 1, 7, "hello")
+    assert contents(client, 7) == ["hello"]
+
+    # Another worker: same database, so only its NOTIFY reaches this worker's cache.
+    other = MemoryMessageDataService({"database": main.database})
+    client.portal.call(other.add_message, MessageModel(userMessageID=0, userID=1, messageID=7, messageContents="again"))
+
+    deadline = time.monotonic() + 2
+    while contents(client, 7) != ["hello", "again"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert contents(client, 7) == ["hello", "again"]
@@ -0,0 +1,69 @@
+import asyncio
+
+from resources.database.memory_database_data_service import MemoryDatabaseDataService
+from resources.messages.message_data_service import MESSAGE_CHANNEL
+from resources.messages.message_events import MessageEventBroker
+
+
+class FlakyMessages():
+    """
+
+    get_messages fails for userMessageID 1 and blocks for 2 until released.
+    """
+
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def get_messages(self, userID, messageThreadID, messageID, *args):
+        if messageID == 1:
+            raise RuntimeError("database went away")
+        if messageID == 2:
+            await self.release.wait()
+        return [{"userMessageID": messageID}]
+
+
+def event(userMessageID: int) -> dict:
+    return {"op": "added", "userMessageID": userMessageID, "userID": 1, "messageID": 7}
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_delivery_survives_failures_and_does_not_hold_up_watchers():
+    async def main():
+        database = MemoryDatabaseDataService()
+        messages = FlakyMessages()
+        broker = MessageEventBroker({"database": database, "data_service": messages})
+        watched, received = [], []
+
+        def failing_watcher(e):
+            raise ValueError("broken watcher")
+
+        broker.add_watcher(failing_watcher)
+        broker.add_watcher(watched.append)
+        await broker.start()
+
+        async def subscriber():
+            async for e in broker.subscribe(7):
+                received.append(e["userMessageID"])
+
+        task = asyncio.create_task(subscriber())
+        await settle()
+
+        for userMessageID in (1, 2, 3):
+            database.notify(MESSAGE_CHANNEL, event(userMessageID))
+        await settle()
+        # Loading 2 is stuck, yet every event has reached the watchers.
+        assert [e["userMessageID"] for e in watched] == [1, 2, 3]
+        assert received == []
+
+        messages.release.set()
+        await settle()
+        assert received == [2, 3]
+
+        task.cancel()
+        await broker.stop()
+
+    asyncio.run(main())
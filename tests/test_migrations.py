@@ -0,0 +1,41 @@
+from resources.database.migrations import MIGRATIONS, MigrationRunner
+
+
+class RecordingDatabase():
+    """
+
+    Stands in for DatabaseDataService: records statements and reports every index as invalid.
+    """
+
+    def __init__(self, invalid: bool):
+        self.invalid = invalid
+        self.statements = []
+
+    def fetchallquery(self, query, params=None):
+        if "pg_index" in query:
+            return [{"indisvalid": not self.invalid}]
+        return []
+
+    def execute_query(self, query, params=None):
+        self.statements.append(query)
+        return 0
+
+
+def migration(version: int) -> dict:
+    return next(m for m in MIGRATIONS if m["version"] == version)
+
+
+def test_invalid_concurrent_index_is_rebuilt():
+    database = RecordingDatabase(invalid=True)
+    MigrationRunner(database)._apply(migration(2))
+
+    create = next(i for i, s in enumerate(database.statements) if '"userMessages_userID_creationDT_idx" ON' in s)
+    assert database.statements[create - 1] == 'DROP INDEX CONCURRENTLY IF EXISTS "userMessages_userID_creationDT_idx";'
+    assert sum(s.startswith("DROP INDEX") for s in database.statements) == 4
+
+
+def test_valid_index_is_kept():
+    database = RecordingDatabase(invalid=False)
+    MigrationRunner(database)._apply(migration(3))
+
+    assert not any(s.startswith("DROP INDEX") for s in database.statements)
@@ -0,0 +1,59 @@
+import base64
+import json
+
+import pytest
+
+from conftest import add_message, add_user
+
+
+def test_keyset_cursor_walks_every_message_once(client):
+    add_user(client, 1)
+    for i in range(5):
+        add_message(client, 1, 1, f"message {i}")
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2}
+        if cursor is not None:
+            params["cursor"] = cursor
+        response = client.get("/api/messages", params=params)
+        assert response.status_code == 200
+        seen.extend(m["messageContents"] for m in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert seen == [f"message {i}" for i in range(5)]
+
+
+def test_invalid_cursor_is_rejected(client):
+    assert client.get("/api/messages", params={"limit": 2, "cursor": "not-a-cursor"}).status_code == 400
+
+
+def raw_cursor(key: list, types: list) -> str:
+    raw = json.dumps({"k": key, "t": types}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("path, key, types", [
+    ("/api/messages", [1], [""]),
+    ("/api/messages", ["2024-01-01T00:00:00", "7"], ["dt", ""]),
+    ("/api/messages", [1, 7], ["", ""]),
+    ("/api/users", [], []),
+    ("/api/users", [1, 2], ["", ""]),
+    ("/api/users", [True], [""]),
+    ("/api/users", ["2024-01-01T00:00:00"], ["dt"]),
+])
+def test_cursor_of_the_wrong_shape_is_rejected(client, path, key, types):
+    add_user(client, 1)
+    add_message(client, 1, 1, "hello")
+
+    assert client.get(path, params={"limit": 2, "cursor": raw_cursor(key, types)}).status_code == 400
+
+
+def test_cursor_with_a_time_zone_is_accepted(client):
+    add_user(client, 1)
+    add_message(client, 1, 1, "hello")
+
+    cursor = raw_cursor(["2000-01-01T00:00:00+00:00", 0], ["dt", ""])
+    assert [m["messageContents"] for m in client.get("/api/messages", params={"limit": 2, "cursor": cursor}).json()] == ["hello"]
@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+from resources.database.partitions import PartitionManager
+
+
+class RecordingCursor():
+
+    def __init__(self, rows: int, fail_on: str = None):
+        self.rows = rows
+        self.fail_on = fail_on
+        self.statements = []
+
+    def execute(self, query, params=None):
+        if self.fail_on is not None and self.fail_on in query:
+            raise RuntimeError("lock timeout")
+        self.statements.append(query)
+
+    def fetchone(self):
+        return (self.rows,)
+
+    def copy_expert(self, query, f):
+        self.statements.append(query)
+        if "TO STDOUT" in query:
+            f.write('"userMessageID","userID","messageID","messageContents","creationDT"\n')
+            for i in range(self.rows):
+                f.write(f'{i},1,7,hello,2020-01-01 00:00:00\n')
+
+
+class RecordingDatabase():
+    """
+
+    Stands in for DatabaseDataService with a single January 2020 partition of two rows.
+    """
+
+    def __init__(self, fail_on: str = None):
+        self.cursor_ = RecordingCursor(2, fail_on)
+        self.live = True
+
+    def fetchallquery(self, query, params=None):
+        if not self.live:
+            return []
+        return [{"name": "userMessages_2020_01", "bound": "FOR VALUES FROM ('2020-01-01 00:00:00') TO ('2020-02-01 00:00:00')"}]
+
+    @contextmanager
+    def cursor(self):
+        yield RecordingCursor(0)
+
+    @contextmanager
+    def transaction(self):
+        yield self.cursor_
+
+
+def position(statements: list, text: str) -> int:
+    return next(i for i, s in enumerate(statements) if text in s)
+
+
+def test_archive_takes_messages_out_of_the_thread_summaries(tmp_path):
+    database = RecordingDatabase()
+    archived = PartitionManager(database).archive(str(tmp_path), now=datetime(2022, 1, 1))
+    statements = database.cursor_.statements
+
+    assert archived == [{"partition": "userMessages_2020_01", "rows": 2}]
+    count = position(statements, '"messageCount" = t."messageCount" - m."messageCount"')
+    participants = position(statements, '-count(*) FROM "userMessages_2020_01"')
+    detach = position(statements, "DETACH PARTITION")
+    last = position(statements, 'SET ("lastUserMessageID", "lastMessageDT")')
+    drop = position(statements, "DROP TABLE")
+    assert count < detach and participants < detach
+    # The last message is looked up without the detached rows, but while they can still be read.
+    assert detach < last < drop
+
+
+def test_restore_counts_messages_again(tmp_path):
+    database = RecordingDatabase()
+    PartitionManager(database).archive(str(tmp_path), now=datetime(2022, 1, 1))
+    database.cursor_ = RecordingCursor(2)
+    assert PartitionManager(database).restore(str(tmp_path), "userMessages_2020_01") == 2
+    statements = database.cursor_.statements
+
+    attach = position(statements, "ATTACH PARTITION")
+    assert attach < position(statements, '"messageCount" = t."messageCount" + m."messageCount"')
+    assert attach < position(statements, '+count(*) FROM "userMessages_2020_01"')
+    assert attach < position(statements, 'SET ("lastUserMessageID", "lastMessageDT")')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_archive_leaves_no_files(tmp_path):
+    database = RecordingDatabase(fail_on="DETACH PARTITION")
+    with pytest.raises(RuntimeError):
+        PartitionManager(database).archive(str(tmp_path), now=datetime(2022, 1, 1))
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_export_left_by_an_interrupted_run_is_published_or_discarded(tmp_path):
+    for suffix in (".csv.gz.tmp", ".json.tmp"):
+        (tmp_path / ("userMessages_2020_01" + suffix)).write_text("")
+
+    # The partition is still there: the drop never committed.
+    PartitionManager(RecordingDatabase())._recover(str(tmp_path), [{"name": "userMessages_2020_01"}])
+    assert list(tmp_path.iterdir()) == []
+
+    for suffix in (".csv.gz.tmp", ".json.tmp"):
+        (tmp_path / ("userMessages_2020_01" + suffix)).write_text("")
+    database = RecordingDatabase()
+    database.live = False
+    assert PartitionManager(database).archive(str(tmp_path), now=datetime(2022, 1, 1)) == []
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["userMessages_2020_01.csv.gz", "userMessages_2020_01.json"]
@@ -0,0 +1,61 @@
+#
+# The SQL the Postgres data services send, checked without a database.
+#
+from datetime import datetime
+
+from resources.messages.message_data_service import MessageDataService
+from resources.pagination import encode_cursor
+from resources.threads.thread_data_service import ThreadDataService
+from resources.users.users_data_service import UserDataService
+
+
+def test_messages_query_filters_and_pages():
+    query, values = MessageDataService()._get_messages_query(1, None, None, None, None, 10)
+
+    assert query == """SELECT "userMessageID", "userID", "messageID", "messageContents", "creationDT" FROM "userMessages" WHERE "userID" = %s ORDER BY "creationDT", "userMessageID" LIMIT %s;"""
+    assert values == (1, 10)
+
+
+def test_messages_query_cursor_bounds_creation_time():
+    # The plain "creationDT" >= bound is what lets Postgres prune old partitions.
+    created = datetime(2024, 1, 2, 3, 4, 5)
+    query, values = MessageDataService()._get_messages_query(None, 2, None, None, None, 10, encode_cursor(created, 7))
+
+    assert """"creationDT" >= %s AND ("creationDT", "userMessageID") > (%s, %s)""" in query
+    assert values == (2, created, created, 7, 10)
+
+
+def test_search_terms_are_prefix_matches():
+    assert MessageDataService._search_terms("hel, wor!") == "hel:* & wor:*"
+    assert MessageDataService._search_terms("!!") == ""
+
+
+def test_conversation_latest_window():
+    query, values = MessageDataService._get_conversation_query(3, None, 5, None)
+
+    assert "ORDER BY \"creationDT\" DESC, \"userMessageID\" DESC LIMIT %s" in query
+    assert values == (3, 5)
+
+
+def test_users_query():
+    query, values = UserDataService()._get_users_query(None, "Ada", None, None, None, 5)
+
+    assert query == """SELECT "userID", "firstName", "lastName", "isAdmin" FROM "messageUsers" WHERE "firstName" = %s ORDER BY "userID" LIMIT %s;"""
+    assert values == ("Ada", 5)
+
+
+def test_thread_version_query():
+    query, values = ThreadDataService._get_thread_version_query(4)
+
+    assert query.startswith("""SELECT "messageID", "messageCount", "lastUserMessageID", "lastMessageDT" FROM "messageThread\"""")
+    assert values == (4,)
+
+
+def test_threads_query_formats_timestamps_in_postgres():
+    query, values = ThreadDataService._get_threads_query(3, 20)
+
+    assert """to_char(t."lastMessageDT", 'MM/DD/YYYY, HH24:MI:SS') AS "lastMessageDT\"""" in query
+    assert """to_char(p."lastReadDT", 'MM/DD/YYYY, HH24:MI:SS') AS "lastReadDT\"""" in query
+    # Ordered by the timestamp itself, not by its text.
+    assert """ORDER BY t."lastMessageDT" DESC NULLS LAST""" in query
+    assert values == (3, 20)
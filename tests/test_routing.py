@@ -0,0 +1,63 @@
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from conftest import FakeDatabase
+from resources.database.routing_database_data_service import STICKY_COOKIE, RoutingDatabaseDataService, StickyReadsMiddleware
+
+
+def worker():
+    # One gunicorn worker: its own routing service, so nothing is shared but the client.
+    database = RoutingDatabaseDataService({"db_dsn": "postgresql://primary", "db_replica_dsns": ["postgresql://replica"], "db_replica_sticky_seconds": 5})
+    database.primary = FakeDatabase("primary")
+    database.replicas[0].database = FakeDatabase("replica")
+
+    app = FastAPI()
+    app.add_middleware(StickyReadsMiddleware, sticky_seconds=5)
+
+    @app.get("/read")
+    async def read():
+        return (await database.fetchallquery("SELECT 1"))[0]
+
+    @app.post("/write")
+    async def write():
+        await database.fetchonequery("INSERT")
+        database.note_write(1)
+        return "ok"
+
+    return app
+
+
+def test_reads_after_a_write_see_the_primary_on_another_worker():
+    first, second = TestClient(worker()), TestClient(worker())
+    assert second.get("/read").json() == "replica"
+
+    response = first.post("/write")
+    assert STICKY_COOKIE in response.cookies
+
+    # The second worker never saw the write; the cookie alone sends the read to the primary.
+    second.cookies.set(STICKY_COOKIE, response.cookies[STICKY_COOKIE])
+    assert second.get("/read").json() == "primary"
+    second.cookies.clear()
+    assert second.get("/read").json() == "replica"
+
+
+def test_expired_and_forged_cookies():
+    client = TestClient(worker())
+
+    client.cookies.set(STICKY_COOKIE, str(time.time() - 1))
+    assert client.get("/read").json() == "replica"
+    client.cookies.set(STICKY_COOKIE, "soon")
+    assert client.get("/read").json() == "replica"
+    # Clamped to the sticky window rather than honoured for a day.
+    client.cookies.set(STICKY_COOKIE, str(time.time() + 86400))
+    assert client.get("/read").json() == "primary"
+    assert STICKY_COOKIE not in client.get("/read").cookies
+
+
+def test_replica_pools_have_their_own_size():
+    database = RoutingDatabaseDataService({"db_dsn": "postgresql://primary", "db_pool_max": 10, "db_replica_dsns": ["postgresql://replica"], "db_replica_pool_max": 4})
+
+    assert database.primary.pool_max == 10
+    assert database.replicas[0].database.pool_max == 4
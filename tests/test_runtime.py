@@ -0,0 +1,45 @@
+import pytest
+
+from resources import runtime
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(runtime, "DB_MAX_CONNECTIONS", 100)
+    monkeypatch.setattr(runtime, "DB_REPLICA_MAX_CONNECTIONS", 100)
+    monkeypatch.setattr(runtime, "DB_RESERVED_CONNECTIONS", 10)
+    monkeypatch.setattr(runtime, "DB_POOL_MAX", 50)
+
+
+def test_pool_budget_is_split_across_workers_and_instances():
+    assert runtime.pool_max(workers=2, instances=1) == 44
+    assert runtime.pool_max(workers=2, instances=4) == 10
+    # Every connection of every instance fits, LISTEN sessions included.
+    for workers, instances in ((1, 1), (2, 4), (4, 3), (8, 5)):
+        pool = runtime.pool_max(workers, instances)
+        assert workers * instances * (pool + runtime.WORKER_EXTRA_CONNECTIONS) <= 90
+
+
+def test_pool_is_capped(monkeypatch):
+    monkeypatch.setattr(runtime, "DB_POOL_MAX", 10)
+
+    assert runtime.pool_max(workers=1, instances=1) == 10
+
+
+def test_budget_too_small_for_one_connection_each_fails():
+    # 45 connections per worker would be 1 for its pool plus 1 for LISTEN; 46 workers can't have that.
+    assert runtime.pool_max(workers=45, instances=1) == 1
+    with pytest.raises(ValueError):
+        runtime.pool_max(workers=46, instances=1)
+    with pytest.raises(ValueError):
+        runtime.pool_max(workers=8, instances=8)
+
+
+def test_replica_pools_are_sized_against_the_replica(monkeypatch):
+    monkeypatch.setattr(runtime, "DB_REPLICA_MAX_CONNECTIONS", 50)
+
+    # No LISTEN session on replicas.
+    assert runtime.replica_pool_max(workers=2, instances=4) == 5
+    assert runtime.pool_max(workers=2, instances=4) == 10
+    with pytest.raises(ValueError):
+        runtime.replica_pool_max(workers=8, instances=8)
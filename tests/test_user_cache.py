@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import main
+from conftest import FakeDatabase, add_user
+from resources.cache import LRUCache
+from resources.database.routing_database_data_service import RoutingDatabaseDataService
+from resources.users.users_data_service import AsyncUserDataService, CachedUserDataService
+from resources.users.users_data_service import MemoryUserDataService
+from resources.users.users_models import UserModel
+
+
+def cached(userID: int):
+    return main.user_resource.data_service.cache.get_sync(f"user:{userID}")
+
+
+def test_links_are_not_written_into_cached_rows(client):
+    add_user(client, 1)
+
+    first = client.get("/api/users/1").json()
+    second = client.get("/api/users/1").json()
+
+    assert first == second
+    assert len(second["links"]) == len(first["links"])
+    assert "links" not in cached(1)[0]
+
+
+def test_delete_by_another_worker_reaches_the_cache(client):
+    add_user(client, 1)
+    client.get("/api/users/1")
+    assert cached(1)
+
+    # Another worker: same database, its own (uncached) data service.
+    other = MemoryUserDataService({"database": main.database})
+    client.portal.call(other.delete_user, UserModel(userID=1, firstName="", lastName="", isAdmin=False))
+
+    deadline = time.monotonic() + 2
+    while cached(1) is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cached(1) is None
+    assert client.get("/api/users/1").status_code == 404
+
+
+class UserRows(FakeDatabase):
+
+    async def fetchallquery(self, query: str = None, params: () = None):
+        return [{"userID": 1, "server": self.name}]
+
+
+def routed_users() -> CachedUserDataService:
+    database = RoutingDatabaseDataService({"db_dsn": "postgresql://primary", "db_replica_dsns": ["postgresql://replica"]})
+    database.primary = UserRows("primary")
+    database.replicas[0].database = UserRows("replica")
+    return CachedUserDataService(AsyncUserDataService({"database": database}), LRUCache(10, 60))
+
+
+def test_cache_is_filled_from_the_primary():
+    users = routed_users()
+
+    assert asyncio.run(users.get_users(1, None, None, None, None, None)) == [{"userID": 1, "server": "primary"}]
+    # Other reads still go to replicas.
+    assert asyncio.run(users.get_users(None, "Ada", None, None, None, None)) == [{"userID": 1, "server": "replica"}]
+
+
+def test_user_writes_make_reads_sticky():
+    users = routed_users()
+    asyncio.run(users.delete_user(UserModel(userID=1, firstName="", lastName="", isAdmin=False)))
+
+    assert 1 in users.data_service.database._written
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+import main
+from conftest import add_user
+from resources.messages.message_data_service import MemoryMessageDataService
+from resources.messages.message_write_queue import MessageWriteQueue
+
+
+def message(userMessageID: int, userID: int, contents: str) -> dict:
+    return {"userMessageID": userMessageID, "userID": userID, "messageID": 1, "messageContents": contents, "creationDT": datetime(2024, 1, 1).isoformat()}
+
+
+def data_service(*userIDs) -> MemoryMessageDataService:
+    service = MemoryMessageDataService({})
+    for userID in userIDs:
+        service.database.insert_user({"userID": userID, "firstName": "Ada", "lastName": "Lovelace", "isAdmin": False})
+    return service
+
+
+def test_journal_left_by_a_crashed_worker_is_replayed(tmp_path):
+    # Message 1 was committed before the crash; 2 was not; 3 was cut off mid-write.
+    lines = [json.dumps(message(1, 1, "one")), json.dumps({"committed": [1]}), json.dumps(message(2, 1, "two")), '{"userMessageID": 3']
+    (tmp_path / "12345-1.jsonl").write_text("\n".join(lines) + "\n")
+    service = data_service(1)
+    queue = MessageWriteQueue({"data_service": service, "journal_dir": str(tmp_path)})
+
+    async def run():
+        await queue.start()
+        await queue.stop()
+    asyncio.run(run())
+
+    assert [row["userMessageID"] for row in service.database.messages.values()] == [2]
+    assert queue.get_metrics()["replayed"] == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_rejected_messages_are_not_counted_as_committed(tmp_path):
+    service = data_service(1)
+    queue = MessageWriteQueue({"data_service": service, "journal_dir": str(tmp_path), "flush_interval": 60})
+
+    class Request():
+        def __init__(self, userID):
+            self.userID, self.messageID, self.messageContents = userID, 1, "hello"
+
+    async def run():
+        await queue.start()
+        for userID in (1, 2, 1):
+            await queue.add_message(Request(userID))
+        await queue.stop()
+    asyncio.run(run())
+
+    metrics = queue.get_metrics()
+    assert (metrics["accepted"], metrics["committed"], metrics["rejected"]) == (3, 2, 1)
+    assert len(service.database.messages) == 2
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_write_behind_refuses_unknown_users_before_accepting(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "DATA_BACKEND", "memory")
+    monkeypatch.setattr(main, "WRITE_BEHIND", True)
+    monkeypatch.setattr(main, "WRITE_QUEUE_JOURNAL_DIR", str(tmp_path / "journal"))
+    monkeypatch.setattr(main, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    with TestClient(main.app) as client:
+        add_user(client, 1)
+        body = {"userMessageID": 0, "messageID": 1, "messageContents": "hello"}
+
+        assert client.post("/api/messages/newMessage", json={**body, "userID": 2}).status_code == 404
+        response = client.post("/api/messages/newMessage", json={**body, "userID": 1})
+        assert response.status_code == 202
+
+        deadline = time.monotonic() + 5
+        while not client.get("/api/messages", params={"userID": 1}).json() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [m["userMessageID"] for m in client.get("/api/messages", params={"userID": 1}).json()] == [int(response.headers["X-User-Message-ID"])]
+        assert main.message_write_queue.get_metrics()["accepted"] == 1